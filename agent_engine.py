@@ -1,67 +1,395 @@
 import json
 import uuid
+import hashlib
 import time
-from utils import get_db_connection
+from utils import get_db_connection, load_config
+from compliance_scanner import scan_text, format_matches
 
-def create_task(user_id: str, action: str, source_data: dict, cost_points: int):
-    """创建任务并扣减积分"""
-    task_id = f"ozon_{uuid.uuid4().hex[:8]}"
-    payload = json.dumps({"action": action, "data": source_data}, ensure_ascii=False)
-    
+def _new_task_id():
+    return f"ozon_{uuid.uuid4().hex[:12]}"
+
+# 积分：只追加的 credit_ledger 流水 + credit_snapshots 快照，余额 = 快照 + 快照之后的流水合计
+# 扣减/退款/平台抽成都只 INSERT 流水，不再更新同一行余额
+PLATFORM_USER_ID = "platform"
+# 某用户快照之后累计超过该条数的流水时生成新快照
+CREDIT_SNAPSHOT_MIN_ENTRIES = 100
+
+def _credit_balance(cursor, user_id: str):
+    """精确余额（快照 + 之后的流水），返回 (余额, 已计入的最大流水 id)"""
+    cursor.execute("""
+        SELECT COALESCE(s.balance, 0) + COALESCE(SUM(l.delta), 0), MAX(COALESCE(l.id, s.ledger_id, 0))
+        FROM (SELECT ? AS user_id) u
+        LEFT JOIN credit_snapshots s ON s.user_id = u.user_id
+        LEFT JOIN credit_ledger l ON l.user_id = u.user_id AND l.id > COALESCE(s.ledger_id, 0)
+    """, (user_id,))
+    balance, last_id = cursor.fetchone()
+    return balance, last_id or 0
+
+def _append_ledger(cursor, entries):
+    """追加积分流水：entries 为 (user_id, delta, reason, task_id) 列表"""
+    cursor.executemany("INSERT INTO credit_ledger (user_id, delta, reason, task_id) VALUES (?, ?, ?, ?)", entries)
+
+def get_credits(user_id: str):
+    """
+    获取用户积分：快照相当于持久化的余额缓存，一条查询读出快照并累加之后的少量流水（不超过快照阈值），
+    结果精确，也不受恢复备份、其它进程写入的影响
+    """
+    with get_db_connection() as conn:
+        balance, _ = _credit_balance(conn.cursor(), user_id)
+    return balance
+
+def snapshot_credit_balances(min_entries: int = CREDIT_SNAPSHOT_MIN_ENTRIES):
+    """
+    生成积分快照：快照之后流水不少于 min_entries 条的用户，把余额固化为新快照
+    流水本身保留不删，余额查询只需累加快照之后的少量流水
+
+    返回:
+        int: 更新快照的用户数
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # 检查积分
-        cursor.execute("SELECT credits FROM user_credits WHERE user_id=?", (user_id,))
-        row = cursor.fetchone()
-        if not row or row['credits'] < cost_points:
-            return None, "❌ 积分不足！"
-        
-        # 扣减积分并写入任务
-        cursor.execute("UPDATE user_credits SET credits = credits - ? WHERE user_id=?", (cost_points, user_id))
         cursor.execute("""
-            INSERT INTO ai_tasks (task_id, status, user_id, payload, cost)
-            VALUES (?, 'pending', ?, ?, ?)
-        """, (task_id, user_id, payload, cost_points))
-        
+            INSERT INTO credit_snapshots (user_id, balance, ledger_id, created_at)
+            SELECT l.user_id, COALESCE(s.balance, 0) + SUM(l.delta), MAX(l.id), CURRENT_TIMESTAMP
+            FROM credit_ledger l
+            LEFT JOIN credit_snapshots s ON s.user_id = l.user_id
+            WHERE l.id > COALESCE(s.ledger_id, 0)
+            GROUP BY l.user_id
+            HAVING COUNT(*) >= ?
+            ON CONFLICT(user_id) DO UPDATE SET
+                balance = excluded.balance, ledger_id = excluded.ledger_id, created_at = excluded.created_at
+        """, (max(int(min_entries), 1),))
+        return cursor.rowcount
+
+# 结果去重：相同任务类型 + 数据（规范化后）在有效期内已有完成结果时直接复用，不扣积分也不再处理
+TASK_DEDUP_TTL_HOURS_DEFAULT = 24
+# IN (...) 查询每批的哈希数量
+_DEDUP_LOOKUP_CHUNK = 500
+
+def _normalize_payload(value):
+    """规范化任务数据：字符串去首尾空白并合并连续空白，字典按键排序（由 json.dumps 完成）"""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {str(k): _normalize_payload(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_payload(v) for v in value]
+    return value
+
+def task_payload_hash(action: str, source_data) -> str:
+    """任务内容指纹：规范化后的 任务类型 + 数据 的 sha256"""
+    canonical = json.dumps(
+        [_normalize_payload(action), _normalize_payload(source_data)],
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def task_dedup_ttl_hours() -> float:
+    """结果复用有效期（小时，配置 task_dedup_ttl_hours；0 表示关闭去重）"""
+    try:
+        return max(float(load_config('task_dedup_ttl_hours', TASK_DEDUP_TTL_HOURS_DEFAULT)), 0.0)
+    except (TypeError, ValueError):
+        return float(TASK_DEDUP_TTL_HOURS_DEFAULT)
+
+def _find_completed_results(cursor, user_id: str, hashes, ttl_hours: float):
+    """查找该用户有效期内已完成的原始任务（非复用任务），返回 {payload_hash: task_id}，同一哈希取最新一次"""
+    found = {}
+    hashes = list(hashes)
+    for i in range(0, len(hashes), _DEDUP_LOOKUP_CHUNK):
+        chunk = hashes[i:i + _DEDUP_LOOKUP_CHUNK]
+        cursor.execute(f"""
+            SELECT payload_hash, task_id FROM ai_tasks
+            WHERE payload_hash IN ({",".join("?" * len(chunk))})
+              AND user_id=? AND status='completed' AND dedup_of IS NULL
+              AND updated_at >= datetime('now', ?)
+            ORDER BY updated_at
+        """, chunk + [user_id, f"-{ttl_hours * 3600:.0f} seconds"])
+        found.update((row['payload_hash'], row['task_id']) for row in cursor.fetchall())
+    return found
+
+def create_task(user_id: str, action: str, source_data: dict, cost_points: int):
+    """创建任务并扣减积分（有效期内已有相同任务的完成结果时直接复用，不扣积分）"""
+    task_ids, msg, hits = _create_tasks(user_id, action, [source_data], cost_points)
+    if not task_ids:
+        return None, msg
+    if hits:
+        return task_ids[0], "✅ 相同内容近期已处理过，已直接复用结果，未扣除积分"
+    return task_ids[0], "✅ 发布成功！任务已进入队列，后台 Worker 正在处理..."
+
+def create_tasks_bulk(user_id: str, action: str, items: list, cost_points: int):
+    """
+    批量创建任务：一次性检查并扣减总积分，任务和合规日志在同一事务内 executemany 写入
+    积分不足时整批拒绝，不会出现只创建了一部分的情况；有效期内已有完成结果的任务直接复用，不计积分
+    同一批内内容相同的任务只处理、扣费第一个，其余以 pending 状态链接到它（不会被 Worker 认领），
+    第一个任务结束时由 _settle_linked_tasks 同步最终状态
+
+    参数:
+        items: 每个任务的 source_data 列表
+        cost_points: 单个任务的积分
+
+    返回:
+        tuple: (任务 ID 列表或 None, 提示信息)
+    """
+    task_ids, msg, _ = _create_tasks(user_id, action, items, cost_points)
+    return task_ids, msg
+
+def _create_tasks(user_id: str, action: str, items: list, cost_points: int):
+    """创建任务的公共实现，返回 (任务 ID 列表或 None, 提示信息, 复用结果的任务数)"""
+    if not items:
+        return None, "⚠️ 没有可提交的任务", 0
+
+    ttl_hours = task_dedup_ttl_hours()
+    task_ids = [_new_task_id() for _ in items]
+    hashes = [task_payload_hash(action, source_data) for source_data in items]
+    payloads = [json.dumps({"action": action, "data": source_data}, ensure_ascii=False) for source_data in items]
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 检查余额和写入扣减流水在同一写事务内完成，并发提交也不会扣成负数
+        if not conn.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+
+        completed = _find_completed_results(cursor, user_id, set(hashes), ttl_hours) if ttl_hours > 0 else {}
+        batch_first = {}
+        new_rows, dedup_rows = [], []
+        for task_id, payload_hash, payload in zip(task_ids, hashes, payloads):
+            if payload_hash in completed:
+                dedup_rows.append((task_id, 'completed', user_id, payload, payload_hash, completed[payload_hash]))
+            elif payload_hash in batch_first:
+                # 同批的相同任务：链接到第一个，等它结束后再同步状态
+                dedup_rows.append((task_id, 'pending', user_id, payload, payload_hash, batch_first[payload_hash]))
+            else:
+                new_rows.append((task_id, user_id, payload, cost_points, payload_hash))
+                if ttl_hours > 0:
+                    batch_first[payload_hash] = task_id
+
+        total_cost = cost_points * len(new_rows)
+        balance, _ = _credit_balance(cursor, user_id)
+        if balance < total_cost:
+            return None, f"❌ 积分不足！本次需要 {total_cost:,} 积分", 0
+
+        _append_ledger(cursor, [(user_id, -cost_points, 'task_debit', row[0]) for row in new_rows])
+        cursor.executemany("""
+            INSERT INTO ai_tasks (task_id, status, user_id, payload, cost, payload_hash)
+            VALUES (?, 'pending', ?, ?, ?, ?)
+        """, new_rows)
+        cursor.executemany("""
+            INSERT INTO ai_tasks (task_id, status, user_id, payload, cost, payload_hash, dedup_of)
+            VALUES (?, ?, ?, ?, 0, ?, ?)
+        """, dedup_rows)
+
         # 合规日志
-        cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'create', '任务创建成功')", (task_id,))
-        
-    return task_id, "✅ 发布成功！后台正在处理..."
+        cursor.executemany("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'create', '任务创建成功')", [(row[0],) for row in new_rows])
+        cursor.executemany("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'dedup_hit', ?)", [(row[0], f"复用任务 {row[5]} 的结果") for row in dedup_rows])
 
-def process_task(task_id: str):
-    """Agent处理引擎（含中国合规风控）"""
+        if ttl_hours > 0:
+            cursor.execute("""
+                INSERT INTO task_dedup_stats (day, hits, misses, credits_saved)
+                VALUES (date('now', 'localtime'), ?, ?, ?)
+                ON CONFLICT(day) DO UPDATE SET
+                    hits = hits + excluded.hits,
+                    misses = misses + excluded.misses,
+                    credits_saved = credits_saved + excluded.credits_saved
+            """, (len(dedup_rows), len(new_rows), cost_points * len(dedup_rows)))
+
+    msg = f"✅ 已提交 {len(task_ids):,} 个任务，共扣除 {total_cost:,} 积分，后台 Worker 正在处理..."
+    if dedup_rows:
+        msg += f"（其中 {len(dedup_rows):,} 个与近期或同批任务相同，沿用其处理结果，未扣积分）"
+    return task_ids, msg, len(dedup_rows)
+
+def get_task_dedup_stats(days: int = None):
+    """
+    结果去重统计
+
+    参数:
+        days: 最近多少天（含今天），None 表示全部
+
+    返回:
+        dict: {'hits', 'misses', 'credits_saved', 'hit_rate'}
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM ai_tasks WHERE task_id=?", (task_id,))
+        sql = "SELECT COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0), COALESCE(SUM(credits_saved), 0) FROM task_dedup_stats"
+        if days is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql + " WHERE day >= date('now', 'localtime', ?)", (f"-{max(int(days), 1) - 1} days",))
+        hits, misses, credits_saved = cursor.fetchone()
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'credits_saved': credits_saved,
+        'hit_rate': hits / total if total else 0.0,
+    }
+
+# 任务租约时长（秒）：Worker 认领任务后须在租约内写回结果，否则结果会被拒绝，任务由回收器重新排队
+TASK_LEASE_SECONDS = 60
+# 重试退避：第 n 次失败后等待 TASK_RETRY_BASE_SECONDS * 2^(n-1) 秒，最长 TASK_RETRY_MAX_SECONDS
+TASK_RETRY_BASE_SECONDS = 10
+TASK_RETRY_MAX_SECONDS = 600
+
+_CLAIM_SET_SQL = """
+    UPDATE ai_tasks
+    SET status='processing', lease_owner=?, lease_expires_at=datetime('now', ?),
+        attempts=attempts + 1, updated_at=CURRENT_TIMESTAMP
+"""
+
+# 可认领：pending、不是链接到其它任务的复用任务，且已过重试等待时间
+_CLAIMABLE_SQL = "status='pending' AND dedup_of IS NULL AND (next_attempt_at IS NULL OR next_attempt_at <= datetime('now'))"
+
+# 按已尝试次数计算下一次重试时间（attempts 已在认领时 +1）
+_NEXT_ATTEMPT_SQL = f"""datetime('now', '+' || MIN({TASK_RETRY_BASE_SECONDS} << (attempts - 1), {TASK_RETRY_MAX_SECONDS}) || ' seconds')"""
+
+def _lease_modifier(lease_seconds: int):
+    return f"{int(lease_seconds):+d} seconds"
+
+def claim_task(worker_id: str, lease_seconds: int = TASK_LEASE_SECONDS):
+    """原子认领最早的一个待处理任务（单条 UPDATE ... RETURNING，多进程并发认领也不会重复）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_CLAIM_SET_SQL + f"""
+            WHERE task_id = (SELECT task_id FROM ai_tasks WHERE {_CLAIMABLE_SQL} ORDER BY created_at LIMIT 1)
+              AND {_CLAIMABLE_SQL}
+            RETURNING task_id, user_id, payload, cost, attempts, max_attempts
+        """, (worker_id, _lease_modifier(lease_seconds)))
+        task = cursor.fetchone()
+        if task:
+            task = dict(task)
+            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'start_processing', ?)", (task['task_id'], f"Agent接单: {worker_id}"))
+        return task
+
+def _claim_task_by_id(task_id: str, worker_id: str, lease_seconds: int = TASK_LEASE_SECONDS):
+    """原子认领指定任务（仅当其仍为 pending）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_CLAIM_SET_SQL + """
+            WHERE task_id=? AND status='pending' AND dedup_of IS NULL
+            RETURNING task_id, user_id, payload, cost, attempts, max_attempts
+        """, (worker_id, _lease_modifier(lease_seconds), task_id))
         task = cursor.fetchone()
-        
-        if not task or task['status'] != 'pending':
-            return
-            
-        cursor.execute("UPDATE ai_tasks SET status='processing', updated_at=CURRENT_TIMESTAMP WHERE task_id=?", (task_id,))
-        cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'start_processing', 'Agent接单')", (task_id,))
+        if task:
+            task = dict(task)
+            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'start_processing', ?)", (task_id, f"Agent接单: {worker_id}"))
+        return task
+
+def _finish_task(cursor, task: dict, worker_id: str, status: str, result: str):
+    """写回任务结果：以 lease_owner 为栅栏，租约已被他人接手时返回 False 且不做任何修改"""
+    cursor.execute("""
+        UPDATE ai_tasks
+        SET status=?, result=?, lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP
+        WHERE task_id=? AND status='processing' AND lease_owner=?
+    """, (status, result, task['task_id'], worker_id))
+    return cursor.rowcount == 1
+
+def _settle_linked_tasks(cursor, task_ids, status, result=None, error=None):
+    """
+    原任务结束时同步链接到它的同批复用任务（只处理仍为 pending 的）
+    completed 时不复制结果正文，读取时沿 dedup_of 链接；失败状态写入各自的说明，复用任务未扣积分也无需退款
+    """
+    rows = [(status, result, error, task_id) for task_id in task_ids]
+    cursor.executemany("""
+        UPDATE ai_tasks
+        SET status=?, result=?, last_error=?, updated_at=CURRENT_TIMESTAMP
+        WHERE dedup_of=? AND status='pending'
+    """, rows)
+
+def _dead_letter_refund(cursor, tasks):
+    """进入死信的任务全额退回积分并记录日志"""
+    _append_ledger(cursor, [(t['user_id'], t['cost'], 'dead_letter_refund', t['task_id']) for t in tasks])
+    cursor.executemany("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'dead_letter', ?)", [(t['task_id'], f"重试 {t['attempts']} 次仍失败，已退回积分") for t in tasks])
+    for t in tasks:
+        _settle_linked_tasks(cursor, [t['task_id']], 'dead_letter', error=f"原任务 {t['task_id']} 多次失败: {t['last_error']}")
+
+def fail_task(task: dict, worker_id: str, error: str):
+    """
+    任务处理失败：未达最大尝试次数时按指数退避重新排队，否则进入死信并退回积分
+    以 lease_owner 为栅栏，租约已失效（已被回收器处理）时不做任何修改
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE ai_tasks
+            SET status = CASE WHEN attempts >= max_attempts THEN 'dead_letter' ELSE 'pending' END,
+                next_attempt_at = CASE WHEN attempts >= max_attempts THEN NULL ELSE {_NEXT_ATTEMPT_SQL} END,
+                last_error=?, lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP
+            WHERE task_id=? AND status='processing' AND lease_owner=?
+            RETURNING task_id, user_id, cost, status, attempts, next_attempt_at, last_error
+        """, (error[:500], task['task_id'], worker_id))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        if row['status'] == 'dead_letter':
+            _dead_letter_refund(cursor, [row])
+        else:
+            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'retry_scheduled', ?)", (row['task_id'], f"第 {row['attempts']} 次失败，{row['next_attempt_at']} 后重试: {error[:200]}"))
+        return row['status']
+
+def reap_expired_leases():
+    """
+    回收租约已过期的任务（Worker 崩溃或卡死）：按与失败相同的规则重新排队或进入死信
+    多个进程同时回收也安全：每条 UPDATE 都只会命中仍处于过期状态的任务
+    """
+    expired = "status='processing' AND lease_expires_at < datetime('now')"
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE ai_tasks
+            SET status='dead_letter', next_attempt_at=NULL, last_error='租约超时（Worker 未在期限内写回结果）',
+                lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP
+            WHERE {expired} AND attempts >= max_attempts
+            RETURNING task_id, user_id, cost, attempts, last_error
+        """)
+        dead = [dict(row) for row in cursor.fetchall()]
+        _dead_letter_refund(cursor, dead)
+
+        cursor.execute(f"""
+            UPDATE ai_tasks
+            SET status='pending', next_attempt_at={_NEXT_ATTEMPT_SQL}, last_error='租约超时（Worker 未在期限内写回结果）',
+                lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP
+            WHERE {expired} AND attempts < max_attempts
+            RETURNING task_id
+        """)
+        requeued = [row['task_id'] for row in cursor.fetchall()]
+        cursor.executemany("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'lease_expired', '租约超时，重新排队')", [(task_id,) for task_id in requeued])
+    return {'requeued': len(requeued), 'dead_letter': len(dead)}
+
+def run_claimed_task(task: dict, worker_id: str):
+    """处理一个已认领的任务；处理过程抛出异常时交给 fail_task 重试或进入死信"""
+    try:
+        return _execute_claimed_task(task, worker_id)
+    except Exception as e:
+        fail_task(task, worker_id, f"{type(e).__name__}: {e}")
+        raise
+
+def _execute_claimed_task(task: dict, worker_id: str):
+    """Agent处理引擎（含中国合规风控）"""
+    task_id = task['task_id']
 
     # 提取数据（防崩处理）
     try:
         payload_dict = json.loads(task['payload'])
-        text_data = str(payload_dict.get('data', ''))
+        source_data = payload_dict.get('data', '')
+        text_data = "\n".join(map(str, source_data.values())) if isinstance(source_data, dict) else str(source_data)
     except Exception:
         text_data = ""
 
-    # 合规拦截
-    sensitive_words = ["违禁词", "政治敏感", "刷单", "翻墙"]
-    if any(kw in text_data for kw in sensitive_words):
+    # 合规拦截（词库来自 sensitive_words 表，Aho-Corasick 一次扫描找出全部命中词）
+    matches = scan_text(text_data)
+    if matches:
+        terms = "、".join(dict.fromkeys(m.term for m in matches))
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("UPDATE ai_tasks SET status='failed_compliance', result='触发风控，已退回积分', updated_at=CURRENT_TIMESTAMP WHERE task_id=?", (task_id,))
-            cursor.execute("UPDATE user_credits SET credits = credits + ? WHERE user_id=?", (task['cost'], task['user_id']))
-            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'failed_compliance', '包含敏感词拦截')", (task_id,))
-        return
+            if not _finish_task(cursor, task, worker_id, 'failed_compliance', f'触发风控（命中: {terms}），已退回积分'):
+                return False
+            _append_ledger(cursor, [(task['user_id'], task['cost'], 'compliance_refund', task_id)])
+            _settle_linked_tasks(cursor, [task_id], 'failed_compliance', f'触发风控（命中: {terms}），与原任务 {task_id} 一并拦截，未扣积分')
+            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'failed_compliance', ?)", (task_id, f"包含敏感词拦截: {format_matches(matches)}"))
+        return True
 
     # 模拟 AI 处理时长
     time.sleep(1.5)
-    
+
     # 模拟成功结果
     result_data = {
         "title_ru": "Беспроводные наушники с шумоподавлением и долгим временем работы",
@@ -72,18 +400,98 @@ def process_task(task_id: str):
 
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE ai_tasks SET status='completed', result=?, updated_at=CURRENT_TIMESTAMP WHERE task_id=?", (result_json, task_id))
+        if not _finish_task(cursor, task, worker_id, 'completed', result_json):
+            cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'lease_lost', ?)", (task_id, f"租约已失效，丢弃结果: {worker_id}"))
+            return False
         cursor.execute("INSERT INTO compliance_log (task_id, action, detail) VALUES (?, 'completed', 'AI生成结果通过审核')", (task_id,))
-        
+        _settle_linked_tasks(cursor, [task_id], 'completed')
+
         # 平台抽成 10%
         platform_take = int(task['cost'] * 0.1)
-        cursor.execute("UPDATE user_credits SET credits = credits + ? WHERE user_id='platform'", (platform_take,))
+        _append_ledger(cursor, [(PLATFORM_USER_ID, platform_take, 'platform_take', task_id)])
+    return True
+
+def process_task(task_id: str, worker_id: str = "inline"):
+    """认领并处理指定任务（任务已被其他 Worker 认领时直接返回）"""
+    task = _claim_task_by_id(task_id, worker_id)
+    if not task:
+        return False
+    return run_claimed_task(task, worker_id)
+
+# 输出列 created_at 是本地时间，会遮蔽同名列：排序和游标条件必须写 ai_tasks.created_at 才能走索引
+_TASK_LIST_COLUMNS = """
+    task_id, status, attempts, last_error, dedup_of,
+    result IS NOT NULL OR EXISTS (
+        SELECT 1 FROM ai_tasks src
+        WHERE src.task_id = ai_tasks.dedup_of AND src.user_id = ai_tasks.user_id
+          AND src.status = 'completed' AND src.result IS NOT NULL
+    ) AS has_result,
+    datetime(next_attempt_at, 'localtime') AS next_attempt_at,
+    created_at AS created_at_utc, datetime(created_at, 'localtime') AS created_at
+"""
 
 def get_user_tasks(user_id: str):
-    """获取用户任务列表"""
+    """获取用户全部任务（不含结果正文，结果用 get_task_result 按需读取）"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT task_id, status, result, datetime(created_at, 'localtime') as created_at FROM ai_tasks WHERE user_id=? ORDER BY created_at DESC", (user_id,))
+        cursor.execute(f"SELECT {_TASK_LIST_COLUMNS} FROM ai_tasks WHERE user_id=? ORDER BY ai_tasks.created_at DESC, task_id DESC", (user_id,))
         rows = cursor.fetchall()
         return [dict(row) for row in rows]
 
+def get_user_tasks_page(user_id: str, after=None, page_size: int = 20, status: str = None):
+    """
+    键集分页获取用户任务（按 created_at、task_id 倒序，走 (user_id, created_at) 索引，不使用 OFFSET）
+    索引只负责定位和排序，不是覆盖索引：状态、错误信息和 has_result 等列按主键回表读取，每页只回表 page_size + 1 行
+
+    参数:
+        after: 上一页最后一条任务的游标 (created_at, task_id)，None 表示第一页
+        page_size: 每页条数
+        status: 只看某个状态，None 表示全部
+
+    返回:
+        tuple: (任务列表, 下一页游标)；没有下一页时游标为 None
+    """
+    clauses, params = ["user_id = ?"], [user_id]
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if after is not None:
+        clauses.append("(ai_tasks.created_at, task_id) < (?, ?)")
+        params.extend(after)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 多取一条用于判断是否还有下一页
+        cursor.execute(f"""
+            SELECT {_TASK_LIST_COLUMNS}
+            FROM ai_tasks
+            WHERE {' AND '.join(clauses)}
+            ORDER BY ai_tasks.created_at DESC, task_id DESC
+            LIMIT ?
+        """, params + [page_size + 1])
+        rows = [dict(row) for row in cursor.fetchall()]
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1]['created_at_utc'], rows[-1]['task_id'])
+    return rows, next_cursor
+
+def get_task_result(task_id: str, user_id: str = None):
+    """读取单个任务的结果正文（user_id 不为空时只返回该用户自己的任务），不存在时返回 None"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 复用结果的任务不保存结果正文，沿 dedup_of 链接读取原任务的结果（只认同一用户、已完成的原任务）
+        sql = """
+            SELECT COALESCE(t.result, src.result) AS result
+            FROM ai_tasks t LEFT JOIN ai_tasks src
+              ON src.task_id = t.dedup_of AND src.user_id = t.user_id AND src.status = 'completed'
+            WHERE t.task_id=?
+        """
+        if user_id is None:
+            cursor.execute(sql, (task_id,))
+        else:
+            cursor.execute(sql + " AND t.user_id=?", (task_id, user_id))
+        row = cursor.fetchone()
+        return row['result'] if row else None
+
@@ -5,7 +5,11 @@ Ozon Seller Pro v4.0 - 主入口
 """
 import platform
 import streamlit as st
-from utils import load_config, save_config, sidebar_footer, check_remote_config, init_database
+from utils import (
+    load_config, save_config, sidebar_footer, check_remote_config, init_database,
+    start_backup_scheduler
+)
+from task_worker import ensure_worker_pool
 import os
 
 # ==================== Mac 系统物理阻断 ====================
@@ -20,6 +24,18 @@ except Exception as e:
     st.error(f"❌ 数据库初始化失败: {e}")
     st.stop()
 
+# ==================== 定时轮转备份（后台线程，每个进程只启动一次） ====================
+try:
+    start_backup_scheduler()
+except Exception as e:
+    print(f"⚠️ 定时备份线程启动失败: {e}")
+
+# ==================== AI 任务后台 Worker（线程池，按配置 task_workers 启动） ====================
+try:
+    ensure_worker_pool()
+except Exception as e:
+    print(f"⚠️ AI 任务 Worker 启动失败: {e}")
+
 # ==================== 云端配置热更新 ====================
 # 在页面加载初期检查云端配置更新
 try:
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Ozon Seller Pro v4.0 - 合规扫描
+把 sensitive_words 表中的词库编译成 Aho-Corasick 自动机，一次线性扫描找出文本中所有命中的敏感词及位置
+词库变更由触发器维护版本号，自动机只在版本变化时重建（多个进程之间同样有效）
+"""
+import threading
+from collections import deque, namedtuple
+
+from utils import get_db_connection
+
+ComplianceMatch = namedtuple("ComplianceMatch", ["term", "start", "end"])
+
+
+def _fold(text):
+    """大小写折叠（逐字符、保持长度不变，命中位置可直接对应原文）"""
+    return "".join(lower if len(lower := ch.lower()) == 1 else ch for ch in text)
+
+
+class AhoCorasick:
+    """Aho-Corasick 多模式匹配自动机（大小写不敏感，适用于中文/俄语混合词库）"""
+
+    def __init__(self, words):
+        self.words = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for word in dict.fromkeys(w.strip() for w in words):
+            if word:
+                self._add(word)
+        self._build_failure_links()
+
+    def __len__(self):
+        return len(self.words)
+
+    def _add(self, word):
+        state = 0
+        for ch in _fold(word):
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = self._output[state] + (len(self.words),)
+        self.words.append(word)
+
+    def _build_failure_links(self):
+        """广度优先建立失败指针，并把失败链上的输出合并到当前状态"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                if self._output[self._fail[next_state]]:
+                    self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def scan(self, text):
+        """
+        扫描文本，返回所有命中（可重叠）
+
+        返回:
+            list: [ComplianceMatch(term, start, end)]，按结束位置排序，end 为开区间
+        """
+        matches = []
+        if not text or not self.words:
+            return matches
+
+        goto, fail, output, words = self._goto, self._fail, self._output, self.words
+        state = 0
+        for i, ch in enumerate(_fold(text)):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                for index in output[state]:
+                    word = words[index]
+                    matches.append(ComplianceMatch(word, i + 1 - len(word), i + 1))
+        return matches
+
+
+_scanner_lock = threading.Lock()
+_scanner_cache = (None, AhoCorasick([]))
+
+
+def get_words_version():
+    """当前词库版本号（由 sensitive_words 表上的触发器维护）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM sensitive_words_version WHERE id = 1")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+
+def get_scanner():
+    """获取编译好的自动机（词库版本未变时直接复用）"""
+    global _scanner_cache
+    version = get_words_version()
+    cached_version, scanner = _scanner_cache
+    if cached_version == version:
+        return scanner
+
+    with _scanner_lock:
+        cached_version, scanner = _scanner_cache
+        if cached_version != version:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT word FROM sensitive_words")
+                scanner = AhoCorasick(row[0] for row in cursor.fetchall())
+            _scanner_cache = (version, scanner)
+        return scanner
+
+
+def scan_text(text):
+    """扫描文本中的敏感词，返回 ComplianceMatch 列表"""
+    return get_scanner().scan(text or "")
+
+
+def check_compliance(text):
+    """
+    合规预检
+
+    返回:
+        tuple: (是否通过, 命中列表)
+    """
+    matches = scan_text(text)
+    return not matches, matches
+
+
+def format_matches(matches, limit=10):
+    """把命中结果格式化为简短说明，例如：刷单(第 3 字), 翻墙(第 12 字)"""
+    parts = [f"{m.term}(第 {m.start + 1} 字)" for m in matches[:limit]]
+    if len(matches) > limit:
+        parts.append(f"等共 {len(matches)} 处")
+    return ", ".join(parts)
+
+
+def list_sensitive_words(category=None):
+    """列出词库"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if category:
+            cursor.execute("SELECT id, word, category, created_at FROM sensitive_words WHERE category = ? ORDER BY id", (category,))
+        else:
+            cursor.execute("SELECT id, word, category, created_at FROM sensitive_words ORDER BY id")
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def add_sensitive_words(words, category="通用"):
+    """
+    批量添加敏感词（已存在的忽略，整批一个事务，触发器负责递增词库版本）
+
+    参数:
+        words: 词语可迭代对象
+        category: 分类
+
+    返回:
+        int: 实际新增数量
+    """
+    rows = [(word, category) for word in dict.fromkeys(w.strip() for w in words) if word]
+    if not rows:
+        return 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT OR IGNORE INTO sensitive_words (word, category) VALUES (?, ?)", rows)
+        return max(cursor.rowcount, 0)
+
+
+def parse_sensitive_words(content):
+    """从上传的词表文本中解析词语（每行一个，也支持逗号/顿号分隔；# 开头为注释）"""
+    words = []
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        for sep in ("，", "、", ","):
+            line = line.replace(sep, "\n")
+        words.extend(w.strip() for w in line.split("\n") if w.strip())
+    return words
+
+
+def delete_sensitive_words(word_ids):
+    """
+    删除敏感词
+
+    返回:
+        int: 删除数量
+    """
+    rows = [(int(word_id),) for word_id in word_ids]
+    if not rows:
+        return 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("DELETE FROM sensitive_words WHERE id = ?", rows)
+        return max(cursor.rowcount, 0)
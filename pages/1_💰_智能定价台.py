@@ -5,12 +5,19 @@ Ozon Seller Pro v4.0 - 智能定价台
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
+from functools import partial
 from utils import (
-    load_config, get_logistics_tiers, smart_match_logistics,
+    load_config, get_tier_table, smart_match_logistics,
     get_charge_weight, get_profit_color, get_profit_status, sidebar_footer,
-    save_history_record, get_history_records, reverse_calculate_cost, get_db_connection,
-    export_analysis_image, get_ai_insight
+    save_history_record, get_history_records, reverse_calculate_cost,
+    export_analysis_image, get_ai_insight, reverse_calculate_batch, read_competitor_file,
+    export_dataframe_bytes, margin_sensitivity_grid, render_margin_heatmap,
+    count_sheet_rows, import_pricing_sheet, promo_price_surface, promo_campaign_plan,
+    replace_temp_file, remove_temp_file, read_temp_file,
+    normalize_columns, PRODUCT_COLUMN_ALIASES, get_history_page, get_history_channels,
+    format_history_frame, clear_history, MARGIN_BANDS
 )
 
 st.set_page_config(page_title="智能定价台", page_icon="💰", layout="wide")
@@ -83,7 +90,7 @@ st.markdown("输入商品成本和重量，自动匹配最优物流渠道，计
 st.markdown("---")
 
 # 创建标签页
-tab1, tab2, tab3 = st.tabs(["💰 基础定价", "🎉 活动模拟", "📉 竞品反推"])
+tab1, tab2, tab3, tab4 = st.tabs(["💰 基础定价", "🎉 活动模拟", "📉 竞品反推", "📂 批量定价"])
 
 # ==================== Tab 1: 基础定价 ====================
 with tab1:
@@ -162,7 +169,7 @@ with tab1:
     # 计算按钮
     if st.button("🚀 开始计算", type="primary", use_container_width=True, key="calc_basic"):
         # 获取物流档位
-        tiers = get_logistics_tiers()
+        tiers = get_tier_table()
         
         if not tiers:
             st.error("❌ 未找到物流档位配置，请前往「设置与关于」页面配置")
@@ -407,9 +414,7 @@ with tab1:
                         if result:
                             st.success("✅ 已保存到历史记录！")
                             
-                            # 【关键】清除所有缓存，确保侧边栏仪表盘立即更新
-                            from utils import get_dashboard_stats
-                            get_dashboard_stats.clear()  # 清除仪表盘统计缓存
+                            # 仪表盘统计在写入时已自动失效，这里只清除页面缓存
                             st.cache_data.clear()  # 全局缓存清除
                             
                             # 清除历史记录缓存
@@ -487,6 +492,81 @@ with tab1:
                 except Exception as e:
                     st.warning(f"跳转失败，请手动切换页面。数据已保存到缓存。")
     
+    # ==================== 利润敏感度热力图 ====================
+    st.markdown("---")
+    
+    with st.expander("🔥 成本 × 重量 利润敏感度热力图", expanded=False):
+        st.caption("一次性计算整张网格的匹配渠道与净利润率，白线为物流档位分界，快速找到利润断崖")
+        
+        col1, col2, col3 = st.columns(3)
+        
+        with col1:
+            grid_cost_range = st.slider(
+                "成本范围 (CNY)",
+                min_value=1.0,
+                max_value=2000.0,
+                value=(1.0, 300.0),
+                step=1.0,
+                key="grid_cost_range"
+            )
+        
+        with col2:
+            grid_weight_range = st.slider(
+                "计费重量范围 (克)",
+                min_value=1,
+                max_value=50000,
+                value=(10, 3000),
+                step=10,
+                key="grid_weight_range"
+            )
+        
+        with col3:
+            grid_cost_points = st.number_input("成本取样点数", min_value=10, max_value=500, value=200, step=10, key="grid_cost_points")
+            grid_weight_points = st.number_input("重量取样点数", min_value=10, max_value=500, value=300, step=10, key="grid_weight_points")
+        
+        if st.button("🔥 生成热力图", type="primary", use_container_width=True, key="calc_grid"):
+            tiers = get_tier_table()
+            if not tiers:
+                st.error("❌ 未找到物流档位配置，请前往「设置与关于」页面配置")
+            else:
+                import time
+                start_time = time.perf_counter()
+                grid = margin_sensitivity_grid(
+                    np.linspace(grid_cost_range[0], grid_cost_range[1], int(grid_cost_points)),
+                    np.linspace(grid_weight_range[0], grid_weight_range[1], int(grid_weight_points)),
+                    profit_rate=profit_rate,
+                    commission_rate=commission_rate,
+                    label_fee=label_fee,
+                    tiers=tiers
+                )
+                heatmap = render_margin_heatmap(grid)
+                elapsed_ms = (time.perf_counter() - start_time) * 1000
+                
+                st.image(heatmap, use_container_width=True)
+                
+                margin = grid['margin']
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("网格点数", f"{margin.size:,}", delta=f"{elapsed_ms:.0f} ms", delta_color="off")
+                with col2:
+                    st.metric("利润率 ≥ 20% 占比", f"{(margin >= 20).mean() * 100:.1f}%")
+                with col3:
+                    st.metric("亏损区域占比", f"{(margin < 0).mean() * 100:.1f}%")
+                
+                # 各档位覆盖情况
+                tier_index = grid['tier_index']
+                tier_summary = []
+                for i, name in enumerate(grid['tier_names']):
+                    mask = tier_index == i
+                    if mask.any():
+                        tier_summary.append({
+                            "渠道": name,
+                            "覆盖占比": f"{mask.mean() * 100:.1f}%",
+                            "最低利润率": f"{margin[mask].min():.1f}%",
+                            "最高利润率": f"{margin[mask].max():.1f}%"
+                        })
+                st.dataframe(pd.DataFrame(tier_summary), use_container_width=True, hide_index=True)
+    
     # 显示最近5条历史记录
     st.markdown("---")
     st.markdown("### 📜 最近计算记录")
@@ -496,20 +576,7 @@ with tab1:
     
     history = get_history_records(limit=5)
     if history:
-        history_display = []
-        for record in history:
-            history_display.append({
-                "商品": record['product_name'],
-                "成本": f"¥{record['cost']:.2f}",
-                "计费重": f"{record['charge_weight']:.0f}g",
-                "渠道": record['channel_name'],
-                "售价": f"¥{record['final_price']:.2f}",
-                "利润": f"¥{record['profit']:.2f}",
-                "利润率": f"{record['margin']:.1f}%",
-                "时间": record['created_at']
-            })
-        df_history = pd.DataFrame(history_display)
-        st.dataframe(df_history, use_container_width=True, hide_index=True)
+        st.dataframe(format_history_frame(history), use_container_width=True, hide_index=True)
         
         # 显示记录总数
         st.caption(f"共 {len(history)} 条记录（最近5条）")
@@ -568,7 +635,7 @@ with tab2:
     
     if st.button("🎯 开始模拟", type="primary", use_container_width=True, key="calc_promo"):
         # 获取物流档位
-        tiers = get_logistics_tiers()
+        tiers = get_tier_table()
         if not tiers:
             st.error("❌ 未找到物流档位配置")
             st.stop()
@@ -736,12 +803,204 @@ with tab2:
         
         df_comparison = pd.DataFrame(comparison_data)
         st.dataframe(df_comparison, use_container_width=True, hide_index=True)
+    
+    st.markdown("---")
+    
+    # ==================== 曲线模式：折扣 × 保底利润率 ====================
+    with st.expander("📈 曲线模式：折扣 × 保底利润率 全组合", expanded=False):
+        st.caption("基于上方的商品成本和重量，一次性算出所有折扣与保底利润率组合下的建议原价")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            curve_discount_range = st.slider("折扣范围 (%)", min_value=5, max_value=70, value=(5, 70), step=5, key="curve_discount_range")
+        with col2:
+            curve_margin_range = st.slider("保底利润率范围 (%)", min_value=0, max_value=40, value=(0, 40), step=5, key="curve_margin_range")
+        
+        curve_discounts = list(range(curve_discount_range[0], curve_discount_range[1] + 1, 5))
+        curve_margins = list(range(curve_margin_range[0], curve_margin_range[1] + 1, 5))
+        
+        if st.button("📈 生成定价曲线", type="primary", use_container_width=True, key="calc_promo_curve"):
+            tiers = get_tier_table()
+            if not tiers:
+                st.error("❌ 未找到物流档位配置")
+            else:
+                match_result = smart_match_logistics(
+                    weight_g=promo_weight,
+                    cost_cny=promo_cost,
+                    profit_rate=profit_rate,
+                    commission_rate=commission_rate,
+                    label_fee=label_fee,
+                    tiers=tiers
+                )
+                surface = promo_price_surface(
+                    promo_cost, match_result['shipping_fee'], commission_rate, exchange_rate,
+                    curve_discounts, curve_margins
+                )
+                
+                # 建议原价矩阵：行为折扣，列为保底利润率
+                original_rub = surface['suggested_original_price_rub'][0]
+                df_curve = pd.DataFrame(
+                    original_rub.astype(int),
+                    index=[f"{d}%" for d in curve_discounts],
+                    columns=[f"保底{m}%" for m in curve_margins]
+                )
+                df_curve.index.name = "折扣"
+                
+                st.markdown(f"**建议原价 (RUB)** · 渠道：{match_result['tier']['name']} · 运费 ¥{match_result['shipping_fee']:.2f}")
+                st.dataframe(df_curve, use_container_width=True)
+                
+                st.line_chart(
+                    pd.DataFrame(original_rub, index=curve_discounts, columns=[f"保底{m}%" for m in curve_margins]),
+                    x_label="活动折扣 (%)",
+                    y_label="建议原价 (RUB)"
+                )
+                
+                df_curve_profit = pd.DataFrame(
+                    surface['net_profit'][0].round(2),
+                    index=[f"{d}%" for d in curve_discounts],
+                    columns=[f"保底{m}%" for m in curve_margins]
+                )
+                df_curve_profit.index.name = "折扣"
+                st.markdown("**活动价单件净利润 (CNY)**")
+                st.dataframe(df_curve_profit, use_container_width=True)
+    
+    # ==================== 批量活动计划 ====================
+    with st.expander("📋 批量活动计划（上传 SKU 列表）", expanded=False):
+        st.caption("上传含「商品名称」「成本」「重量」列的 CSV / XLSX，按曲线模式选定的折扣和保底利润率范围生成整张活动计划表")
+        
+        plan_file = st.file_uploader("上传 SKU 列表", type=["csv", "xlsx"], key="promo_plan_file")
+        
+        if plan_file is not None and st.button("📋 生成活动计划", type="primary", use_container_width=True, key="calc_promo_plan"):
+            tiers = get_tier_table()
+            if not tiers:
+                st.error("❌ 未找到物流档位配置")
+            else:
+                try:
+                    if plan_file.name.lower().endswith('.xlsx'):
+                        df_skus = pd.read_excel(plan_file, engine='openpyxl')
+                    else:
+                        df_skus = pd.read_csv(plan_file, encoding='utf-8-sig')
+                    df_skus = normalize_columns(df_skus, PRODUCT_COLUMN_ALIASES)
+                    
+                    st.session_state['promo_plan_result'] = promo_campaign_plan(
+                        df_skus,
+                        profit_rate=profit_rate,
+                        commission_rate=commission_rate,
+                        label_fee=label_fee,
+                        exchange_rate=exchange_rate,
+                        discount_pcts=curve_discounts,
+                        min_margins=curve_margins,
+                        tiers=tiers
+                    )
+                except Exception as e:
+                    st.error(f"❌ 生成活动计划失败: {e}")
+        
+        if 'promo_plan_result' in st.session_state:
+            df_plan = st.session_state['promo_plan_result'].rename(columns={
+                'product_name': '商品',
+                'cost': '成本(CNY)',
+                'weight': '重量(g)',
+                'channel_name': '渠道',
+                'shipping_fee': '运费(CNY)',
+                'discount_pct': '折扣(%)',
+                'min_margin': '保底利润率(%)',
+                'suggested_original_price_cny': '建议原价(CNY)',
+                'suggested_original_price_rub': '建议原价(RUB)',
+                'discounted_price_cny': '活动价(CNY)',
+                'discounted_price_rub': '活动价(RUB)',
+                'net_profit': '净利润(CNY)',
+                'actual_margin': '实际利润率(%)'
+            })
+            
+            st.caption(f"共 {df_plan['商品'].nunique() if len(df_plan) else 0} 个 SKU，{len(df_plan):,} 个定价组合")
+            st.dataframe(df_plan.head(500), use_container_width=True, hide_index=True)
+            
+            # 下载文件在点击时才生成，页面重跑不再每次序列化整张表
+            st.download_button(
+                "📥 下载活动计划 XLSX",
+                data=partial(export_dataframe_bytes, df_plan, 'xlsx'),
+                file_name="活动计划.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                use_container_width=True,
+                key="download_promo_plan"
+            )
 
 # ==================== Tab 3: 竞品反推 ====================
 with tab3:
     st.markdown("### 📉 竞品成本反推")
     st.info("根据竞品售价反推其进货成本上限，帮助你评估市场竞争力")
     
+    # ==================== 批量反推 ====================
+    with st.expander("📂 批量反推（上传竞品价格 CSV / XLSX）", expanded=False):
+        st.caption("文件需包含「售价」(price_rub，卢布) 和「重量」(weight_g，克) 两列，其余列原样保留")
+        
+        competitor_file = st.file_uploader(
+            "上传竞品价格文件",
+            type=["csv", "xlsx"],
+            key="comp_batch_file"
+        )
+        
+        if competitor_file is not None and st.button("🔍 批量反推", type="primary", use_container_width=True, key="calc_reverse_batch"):
+            tiers = get_tier_table()
+            if not tiers:
+                st.error("❌ 未找到物流档位配置")
+            else:
+                try:
+                    df_competitors = read_competitor_file(competitor_file)
+                    st.session_state['reverse_batch_result'] = reverse_calculate_batch(
+                        df_competitors,
+                        exchange_rate=exchange_rate,
+                        profit_rate=profit_rate,
+                        commission_rate=commission_rate,
+                        label_fee=label_fee,
+                        tiers=tiers
+                    )
+                except Exception as e:
+                    st.error(f"❌ 批量反推失败: {e}")
+        
+        if 'reverse_batch_result' in st.session_state:
+            df_result = st.session_state['reverse_batch_result']
+            df_export = df_result.drop(columns=['tier_index', 'is_fallback']).rename(columns={
+                'price_rub': '竞品售价(RUB)',
+                'weight_g': '重量(g)',
+                'price_cny': '竞品售价(CNY)',
+                'channel_name': '物流渠道',
+                'shipping_fee': '运费(CNY)',
+                'max_cost': '成本上限(CNY)'
+            })
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("反推条数", f"{len(df_result):,}")
+            with col2:
+                st.metric("可跟卖（成本上限 > 0）", f"{int((df_result['max_cost'] > 0).sum()):,}")
+            with col3:
+                st.metric("成本上限中位数", f"¥{df_result['max_cost'].median():.2f}" if len(df_result) else "-")
+            
+            st.dataframe(df_export.head(200), use_container_width=True, hide_index=True)
+            if len(df_export) > 200:
+                st.caption(f"仅预览前 200 条，完整结果请下载（共 {len(df_export):,} 条）")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                st.download_button(
+                    "📥 下载 CSV",
+                    data=partial(export_dataframe_bytes, df_export, 'csv'),
+                    file_name="竞品反推结果.csv",
+                    mime="text/csv",
+                    use_container_width=True,
+                    key="download_reverse_csv"
+                )
+            with col2:
+                st.download_button(
+                    "📥 下载 XLSX",
+                    data=partial(export_dataframe_bytes, df_export, 'xlsx'),
+                    file_name="竞品反推结果.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    use_container_width=True,
+                    key="download_reverse_xlsx"
+                )
+    
     col1, col2 = st.columns(2)
     
     with col1:
@@ -866,40 +1125,160 @@ with tab3:
         df_breakdown = pd.DataFrame(breakdown_data)
         st.dataframe(df_breakdown, use_container_width=True, hide_index=True)
 
+# ==================== Tab 4: 批量定价 ====================
+with tab4:
+    st.markdown("### 📂 批量定价导入")
+    st.info("上传商品表（CSV / XLSX），按当前参数逐块计算计费重量、匹配物流并给出建议售价，支持十万行级别的表格")
+    
+    st.caption("必要列：「成本」(cost)、「重量」(weight，克)；可选列：「商品名称」、「长」「宽」「高」(cm)")
+    
+    bulk_file = st.file_uploader(
+        "上传商品表",
+        type=["csv", "xlsx"],
+        key="bulk_pricing_file"
+    )
+    
+    bulk_save_history = st.checkbox("同时写入测款历史记录", value=True, key="bulk_save_history")
+    
+    if bulk_file is not None and st.button("🚀 开始批量定价", type="primary", use_container_width=True, key="calc_bulk"):
+        tiers = get_tier_table()
+        if not tiers:
+            st.error("❌ 未找到物流档位配置，请前往「设置与关于」页面配置")
+        else:
+            import tempfile
+            
+            total_rows = count_sheet_rows(bulk_file)
+            progress_bar = st.progress(0.0, text="正在读取商品表...")
+            
+            def update_progress(done_rows):
+                if total_rows:
+                    progress_bar.progress(min(done_rows / total_rows, 1.0), text=f"已处理 {done_rows:,} / {total_rows:,} 行")
+                else:
+                    # 部分工具导出的 XLSX 不含维度信息，无法预知总行数
+                    progress_bar.progress(0.0, text=f"已处理 {done_rows:,} 行")
+            
+            output_file = tempfile.NamedTemporaryFile(prefix="ozon_bulk_pricing_", suffix=".csv", delete=False)
+            output_file.close()
+            
+            try:
+                summary = import_pricing_sheet(
+                    bulk_file,
+                    output_file.name,
+                    profit_rate=profit_rate,
+                    commission_rate=commission_rate,
+                    label_fee=label_fee,
+                    exchange_rate=exchange_rate,
+                    tiers=tiers,
+                    save_history=bulk_save_history,
+                    progress_callback=update_progress
+                )
+                progress_bar.progress(1.0, text="✅ 批量定价完成")
+                summary['output_path'] = output_file.name
+                # 新结果替换旧结果时删除上一次的临时 CSV
+                replace_temp_file(st.session_state, 'bulk_pricing_output', output_file.name)
+                st.session_state['bulk_pricing_summary'] = summary
+            except Exception as e:
+                remove_temp_file(output_file.name)
+                st.error(f"❌ 批量定价失败: {e}")
+    
+    if 'bulk_pricing_summary' in st.session_state:
+        summary = st.session_state['bulk_pricing_summary']
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("定价成功", f"{summary['rows']:,}")
+        with col2:
+            st.metric("无效行（已跳过）", f"{summary['skipped']:,}")
+        with col3:
+            st.metric("写入历史记录", f"{summary['history_rows']:,}")
+        
+        if summary['preview'] is not None:
+            st.dataframe(summary['preview'], use_container_width=True, hide_index=True)
+            if summary['rows'] > len(summary['preview']):
+                st.caption(f"仅预览前 {len(summary['preview'])} 条，完整结果请下载")
+        
+        import os
+        if os.path.exists(summary['output_path']):
+            # 点击下载时才读取结果文件，页面重跑不再整份读入内存
+            st.download_button(
+                "📥 下载定价结果 CSV",
+                data=partial(read_temp_file, summary['output_path']),
+                file_name=f"批量定价结果_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime="text/csv",
+                use_container_width=True,
+                key="download_bulk_pricing"
+            )
+
 st.markdown("---")
 
 # 历史记录（显示在所有tab外面）
 with st.expander("📜 查看完整历史记录", expanded=False):
-    history = get_history_records(limit=20)
+    hcol1, hcol2, hcol3, hcol4 = st.columns(4)
+    with hcol1:
+        history_dates = st.date_input("日期范围", value=(), key="history_dates")
+    with hcol2:
+        history_channel = st.selectbox(
+            "物流渠道",
+            ["全部"] + get_history_channels(include_archive=st.session_state.get('history_include_archive', False)),
+            key="history_channel"
+        )
+    with hcol3:
+        history_band = st.selectbox("利润率", list(MARGIN_BANDS.keys()), key="history_band")
+    with hcol4:
+        history_page_size = st.selectbox("每页条数", [20, 50, 100, 200], key="history_page_size")
+    
+    # 日期范围未选完整时不过滤
+    start_date = end_date = None
+    if len(history_dates) == 2:
+        start_date, end_date = (d.isoformat() for d in history_dates)
+    elif len(history_dates) == 1:
+        start_date = history_dates[0].isoformat()
+    min_margin, max_margin = MARGIN_BANDS[history_band]
+    
+    include_archive = st.checkbox("包含已归档的历史记录", key="history_include_archive",
+                                  help="归档月份按需解压，翻到较早的记录时会稍慢")
+    
+    history_filters = dict(
+        start_date=start_date, end_date=end_date,
+        channel=None if history_channel == "全部" else history_channel,
+        min_margin=min_margin, max_margin=max_margin
+    )
+    
+    # 游标栈：cursors[i] 是第 i 页的起始游标；过滤条件变化时回到第一页
+    filter_key = (tuple(history_filters.items()), history_page_size, include_archive)
+    if st.session_state.get('history_filter_key') != filter_key:
+        st.session_state.history_filter_key = filter_key
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
+    history, next_cursor = get_history_page(
+        after=cursors[-1], page_size=history_page_size, include_archive=include_archive, **history_filters
+    )
     if history:
-        history_display = []
-        for record in history:
-            history_display.append({
-                "商品": record['product_name'],
-                "成本": f"¥{record['cost']:.2f}",
-                "计费重": f"{record['charge_weight']:.0f}g",
-                "渠道": record['channel_name'],
-                "售价": f"¥{record['final_price']:.2f}",
-                "利润": f"¥{record['profit']:.2f}",
-                "利润率": f"{record['margin']:.1f}%",
-                "时间": record['created_at']
-            })
-        df_history = pd.DataFrame(history_display)
-        st.dataframe(df_history, use_container_width=True, hide_index=True)
+        st.dataframe(format_history_frame(history), use_container_width=True, hide_index=True)
         
-        st.caption(f"共显示最近 {len(history)} 条记录")
+        nav1, nav2, nav3 = st.columns([1, 2, 1])
+        with nav1:
+            if st.button("⬅️ 上一页", key="history_prev", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with nav2:
+            st.caption(f"第 {len(cursors)} 页，本页 {len(history)} 条记录")
+        with nav3:
+            if st.button("下一页 ➡️", key="history_next", disabled=next_cursor is None):
+                cursors.append(next_cursor)
+                st.rerun()
         
         # 添加清空历史记录按钮
         if st.button("🗑️ 清空所有历史记录", key="clear_all_history"):
             try:
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("DELETE FROM history")
-                    conn.commit()
+                clear_history()
+                st.session_state.history_cursors = [None]
                 st.success("✅ 历史记录已清空")
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ 清空失败: {e}")
+    elif len(cursors) > 1 or any(v is not None for v in history_filters.values()):
+        st.info("没有符合条件的历史记录")
     else:
         st.info("暂无历史记录，完成定价计算后点击「保存到历史记录」按钮即可保存")
-
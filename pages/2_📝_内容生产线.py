@@ -6,6 +6,7 @@ AI Prompt工厂 + HTML尺码表 + JSON工具
 import streamlit as st
 import json
 from utils import sidebar_footer, get_current_product, clear_current_product
+from compliance_scanner import scan_text, format_matches
 
 st.set_page_config(page_title="内容生产线", page_icon="📝", layout="wide")
 
@@ -158,8 +159,19 @@ if tool_mode == "AI指令工厂":
         )
     
     if st.button("🚀 生成AI超级Prompt", type="primary", use_container_width=True):
+        # 合规预检：生成前先扫描名称、卖点和品类，命中敏感词时不生成
+        compliance_hits = [
+            (label, matches)
+            for label, text in (("商品名称", product_name), ("商品卖点", selling_points), ("商品品类", category))
+            if (matches := scan_text(text))
+        ]
+        
         if not product_name:
             st.warning("请输入商品名称")
+        elif compliance_hits:
+            for label, matches in compliance_hits:
+                st.error(f"🛡️ {label}包含敏感词：{format_matches(matches)}")
+            st.info("请修改上述内容后再生成（词库可在「设置与关于 → 合规词库」中维护）")
         else:
             prompt = f"""请为以下商品生成完整的Ozon商品页面内容：
 
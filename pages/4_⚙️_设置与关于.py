@@ -7,8 +7,8 @@ import streamlit as st
 import pandas as pd
 import requests
 from utils import (
-    load_config, save_config, get_logistics_tiers, 
-    save_logistics_tiers, sidebar_footer
+    load_config, save_config, get_logistics_tiers, get_tier_table,
+    save_logistics_tiers, reset_logistics_tiers, sidebar_footer
 )
 
 st.set_page_config(page_title="设置与关于", page_icon="⚙️", layout="wide")
@@ -48,7 +48,7 @@ with st.sidebar:
     
     setting_section = st.radio(
         "选择设置项",
-        ["汇率设置", "佣金设置", "物流配置", "数据管理", "关于系统"],
+        ["汇率设置", "佣金设置", "物流配置", "数据管理", "合规词库", "关于系统"],
         key="setting_section"
     )
     
@@ -357,18 +357,7 @@ elif setting_section == "物流配置":
         
         with col2:
             if st.button("🔄 重置为默认", use_container_width=True):
-                default_tiers = [
-                    {"name": "轻小件", "max_weight": 500, "max_price": 135, 
-                     "fixed_fee": 2.6, "per_gram_fee": 0.035, "priority": 1},
-                    {"name": "标准轻小", "max_weight": 2000, "max_price": 635, 
-                     "fixed_fee": 16.0, "per_gram_fee": 0.033, "priority": 2},
-                    {"name": "标准大件", "max_weight": 30000, "max_price": 635, 
-                     "fixed_fee": 36.0, "per_gram_fee": 0.025, "priority": 3},
-                    {"name": "中等件/兜底", "max_weight": 0, "max_price": 0, 
-                     "fixed_fee": 23.0, "per_gram_fee": 0.025, "priority": 4}
-                ]
-                
-                if save_logistics_tiers(default_tiers):
+                if reset_logistics_tiers():
                     st.success("✅ 已重置为默认配置")
                     st.rerun()
         
@@ -387,18 +376,7 @@ elif setting_section == "物流配置":
         st.warning("⚠️ 未找到物流档位配置")
         
         if st.button("初始化默认配置", type="primary"):
-            default_tiers = [
-                {"name": "轻小件", "max_weight": 500, "max_price": 135, 
-                 "fixed_fee": 2.6, "per_gram_fee": 0.035, "priority": 1},
-                {"name": "标准轻小", "max_weight": 2000, "max_price": 635, 
-                 "fixed_fee": 16.0, "per_gram_fee": 0.033, "priority": 2},
-                {"name": "标准大件", "max_weight": 30000, "max_price": 635, 
-                 "fixed_fee": 36.0, "per_gram_fee": 0.025, "priority": 3},
-                {"name": "中等件/兜底", "max_weight": 0, "max_price": 0, 
-                 "fixed_fee": 23.0, "per_gram_fee": 0.025, "priority": 4}
-            ]
-            
-            if save_logistics_tiers(default_tiers):
+            if reset_logistics_tiers():
                 st.success("✅ 默认配置已初始化")
                 st.rerun()
     
@@ -452,34 +430,51 @@ elif setting_section == "数据管理":
         - 备份文件可用于数据恢复或迁移
         """)
         
-        # 读取数据库文件
         import os
-        db_path = os.path.join(os.getcwd(), "ozon_config.db")
+        from functools import partial
+        from utils import DB_PATH, backup_database, replace_temp_file, remove_temp_file, read_temp_file
         
-        if os.path.exists(db_path):
-            try:
-                with open(db_path, 'rb') as f:
-                    db_data = f.read()
+        if os.path.exists(DB_PATH):
+            if st.button("📦 生成数据库备份", key="create_backup", type="primary", use_container_width=True):
+                import tempfile
                 
+                progress_bar = st.progress(0.0, text="正在备份...")
+                
+                def update_backup_progress(done, total):
+                    progress_bar.progress(done / max(total, 1), text=f"正在备份 {done:,} / {total:,} 页...")
+                
+                backup_file = tempfile.NamedTemporaryFile(prefix="ozon_backup_", suffix=".db", delete=False)
+                backup_file.close()
+                try:
+                    # 在线备份 API 分步复制，备份期间不阻塞其它页面写入，也不会拷到写了一半的页
+                    result = backup_database(backup_file.name, progress_callback=update_backup_progress)
+                    progress_bar.progress(1.0, text=f"备份完成，耗时 {result['elapsed_ms']:.0f} ms")
+                    # 新备份替换上一次的临时备份文件
+                    replace_temp_file(st.session_state, 'db_backup_path', backup_file.name)
+                    st.session_state['db_backup'] = result
+                except Exception as e:
+                    remove_temp_file(backup_file.name)
+                    st.error(f"❌ 备份数据库失败: {str(e)}")
+            
+            db_backup = st.session_state.get('db_backup')
+            if db_backup and os.path.exists(db_backup['path']):
                 # 生成备份文件名（带时间戳）
                 from datetime import datetime
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 backup_filename = f"OzonSellerPro_Backup_{timestamp}.db"
                 
+                # 点击下载时才读取备份文件，页面重跑不再把整个数据库读入内存
                 st.download_button(
                     label="📥 下载数据库备份",
-                    data=db_data,
+                    data=partial(read_temp_file, db_backup['path']),
                     file_name=backup_filename,
                     mime="application/octet-stream",
-                    type="primary",
                     use_container_width=True,
+                    key="download_db_backup",
                     help="点击下载完整数据库备份文件"
                 )
                 
-                st.success(f"✅ 数据库文件大小: {len(db_data) / 1024:.2f} KB")
-                
-            except Exception as e:
-                st.error(f"❌ 读取数据库失败: {str(e)}")
+                st.success(f"✅ 备份文件大小: {db_backup['size_bytes'] / 1024:.2f} KB")
         else:
             st.error("❌ 未找到数据库文件")
     
@@ -505,6 +500,186 @@ elif setting_section == "数据管理":
     
     st.markdown("---")
     
+    st.markdown("### 🔁 定时轮转备份")
+    st.caption("后台线程按间隔自动备份到程序目录下的 backups 文件夹，超出保留份数的旧备份自动删除")
+    
+    from utils import run_rotating_backup, list_backups, BACKUP_DIR
+    
+    bcol1, bcol2, bcol3 = st.columns(3)
+    with bcol1:
+        backup_enabled = st.toggle(
+            "启用定时备份", value=load_config('backup_enabled', '0') == '1', key="backup_enabled"
+        )
+    with bcol2:
+        backup_interval = st.number_input(
+            "备份间隔（小时）", min_value=1, max_value=720,
+            value=int(float(load_config('backup_interval_hours', 24))), key="backup_interval_hours"
+        )
+    with bcol3:
+        backup_retention = st.number_input(
+            "保留份数", min_value=1, max_value=100,
+            value=int(float(load_config('backup_retention', 7))), key="backup_retention"
+        )
+    
+    bcol4, bcol5 = st.columns(2)
+    with bcol4:
+        if st.button("💾 保存备份设置", key="save_backup_settings", use_container_width=True):
+            save_config('backup_enabled', '1' if backup_enabled else '0')
+            save_config('backup_interval_hours', backup_interval)
+            save_config('backup_retention', backup_retention)
+            st.success("✅ 备份设置已保存")
+    with bcol5:
+        if st.button("🔁 立即备份一次", key="run_rotating_backup", use_container_width=True):
+            try:
+                result = run_rotating_backup(backup_retention)
+                st.success(f"✅ 已备份到 {result['path']}")
+                if result['removed']:
+                    st.caption(f"已清理旧备份: {', '.join(result['removed'])}")
+            except Exception as e:
+                st.error(f"❌ 备份失败: {e}")
+    
+    rotating_backups = list_backups()
+    if rotating_backups:
+        from datetime import datetime
+        st.dataframe(
+            pd.DataFrame([{
+                "文件名": b['name'],
+                "大小 (KB)": round(b['size_bytes'] / 1024, 1),
+                "备份时间": datetime.fromtimestamp(b['modified_at']).strftime("%Y-%m-%d %H:%M:%S"),
+            } for b in rotating_backups]),
+            use_container_width=True, hide_index=True
+        )
+    else:
+        st.caption(f"备份目录 {BACKUP_DIR} 中暂无轮转备份")
+    
+    st.markdown("---")
+    
+    st.markdown("### 📤 导出历史记录")
+    st.caption("按条件筛选后分块导出测款历史，百万行也不会占满内存")
+    
+    from utils import (
+        get_history_channels, count_history_records, export_history, HISTORY_EXPORT_FORMATS,
+        replace_temp_file, remove_temp_file, read_temp_file
+    )
+    
+    export_include_archive = st.checkbox(
+        "包含已归档的历史记录", value=True, key="export_include_archive",
+        help="归档月份逐月解压后写在在线记录之前"
+    )
+    
+    ecol1, ecol2, ecol3 = st.columns(3)
+    with ecol1:
+        export_dates = st.date_input("日期范围", value=(), key="export_dates")
+    with ecol2:
+        export_channel = st.selectbox(
+            "物流渠道", ["全部"] + get_history_channels(include_archive=export_include_archive), key="export_channel"
+        )
+    with ecol3:
+        export_format = st.selectbox(
+            "导出格式", HISTORY_EXPORT_FORMATS, key="export_format",
+            format_func=lambda f: {"csv": "CSV", "xlsx": "Excel (XLSX)", "parquet": "Parquet"}[f]
+        )
+    
+    export_filters = dict(
+        start_date=export_dates[0].isoformat() if len(export_dates) >= 1 else None,
+        end_date=export_dates[1].isoformat() if len(export_dates) == 2 else None,
+        channel=None if export_channel == "全部" else export_channel
+    )
+    
+    if st.button("📤 生成导出文件", key="export_history", use_container_width=True):
+        import tempfile
+        
+        total_rows = count_history_records(include_archive=export_include_archive, **export_filters)
+        progress_bar = st.progress(0.0, text=f"正在导出 0 / {total_rows:,} 条...")
+        
+        def update_progress(done):
+            progress_bar.progress(min(done / max(total_rows, 1), 1.0), text=f"正在导出 {done:,} / {total_rows:,} 条...")
+        
+        export_file = tempfile.NamedTemporaryFile(prefix="ozon_history_", suffix=f".{export_format}", delete=False)
+        export_file.close()
+        
+        try:
+            exported = export_history(
+                export_file.name, export_format, progress_callback=update_progress,
+                include_archive=export_include_archive, **export_filters
+            )
+            progress_bar.progress(1.0, text=f"导出完成，共 {exported:,} 条")
+            # 新的导出文件替换上一次的临时文件
+            replace_temp_file(st.session_state, 'history_export_path', export_file.name)
+            st.session_state['history_export'] = {
+                'path': export_file.name, 'format': export_format, 'rows': exported
+            }
+        except ImportError as e:
+            remove_temp_file(export_file.name)
+            st.error(f"❌ {e}")
+        except Exception as e:
+            remove_temp_file(export_file.name)
+            st.error(f"❌ 导出失败: {e}")
+    
+    history_export = st.session_state.get('history_export')
+    if history_export and os.path.exists(history_export['path']):
+        from datetime import datetime
+        mimes = {
+            "csv": "text/csv",
+            "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            "parquet": "application/octet-stream",
+        }
+        from functools import partial
+        # 导出文件可能有上百万行，点击下载时才读入内存
+        st.download_button(
+            f"📥 下载导出文件（{history_export['rows']:,} 条）",
+            data=partial(read_temp_file, history_export['path']),
+            file_name=f"测款历史_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{history_export['format']}",
+            mime=mimes[history_export['format']],
+            use_container_width=True,
+            key="download_history_export"
+        )
+    
+    st.markdown("---")
+    
+    st.markdown("### 🗄️ 历史记录归档")
+    st.caption("超过指定天数的历史记录按月压缩移入独立的归档库（ozon_history_archive.db），在线库保持精简；仪表盘累计数据不受影响；数据库备份会一并包含归档月份")
+    
+    from utils import archive_history, list_archived_months, HISTORY_ARCHIVE_DAYS_DEFAULT
+    
+    acol1, acol2 = st.columns([2, 1])
+    with acol1:
+        archive_days = st.number_input(
+            "归档阈值（天）",
+            min_value=30,
+            max_value=3650,
+            value=int(float(load_config('history_archive_days', HISTORY_ARCHIVE_DAYS_DEFAULT))),
+            step=30,
+            key="history_archive_days",
+            help="创建时间早于该天数的记录会被归档"
+        )
+    with acol2:
+        st.markdown("<br>", unsafe_allow_html=True)
+        if st.button("🗄️ 立即归档", key="run_history_archive", use_container_width=True):
+            save_config('history_archive_days', archive_days)
+            try:
+                with st.spinner("正在归档..."):
+                    archive_summary = archive_history(archive_days)
+                if archive_summary['rows']:
+                    st.success(f"✅ 已归档 {archive_summary['rows']:,} 条记录（{', '.join(archive_summary['months'])}）")
+                else:
+                    st.info("没有需要归档的记录")
+            except Exception as e:
+                st.error(f"❌ 归档失败: {e}")
+    
+    archived_months = list_archived_months()
+    if archived_months:
+        st.dataframe(
+            pd.DataFrame(archived_months).rename(columns={
+                'month': '月份', 'row_count': '记录数', 'first_created_at': '最早记录 (UTC)',
+                'last_created_at': '最晚记录 (UTC)', 'size_kb': '压缩后 (KB)', 'archived_at': '归档时间 (UTC)'
+            }),
+            use_container_width=True, hide_index=True
+        )
+        st.caption("在「智能定价台」的完整历史记录中勾选「包含已归档的历史记录」即可查看归档月份")
+    
+    st.markdown("---")
+    
     st.markdown("### 📋 数据库版本信息")
     
     # 显示数据库版本
@@ -521,6 +696,19 @@ elif setting_section == "数据管理":
                 if row:
                     db_version = row[0]
                     st.success(f"✅ 当前数据库版本: v{db_version}")
+                    
+                    from utils import get_db_startup_stats, LATEST_DB_VERSION
+                    startup_stats = get_db_startup_stats()
+                    if startup_stats:
+                        if startup_stats.get('error'):
+                            st.warning(f"⚠️ 启动时数据库初始化出错: {startup_stats['error']}")
+                        elif startup_stats['fast_path']:
+                            st.caption(f"启动检查耗时 {startup_stats['elapsed_ms']:.1f} ms（已是最新版本 v{LATEST_DB_VERSION}，无需迁移）")
+                        elif startup_stats['applied']:
+                            applied = ", ".join(f"v{v}" for v in startup_stats['applied'])
+                            st.caption(f"启动时应用迁移 {applied}，耗时 {startup_stats['elapsed_ms']:.1f} ms")
+                        else:
+                            st.caption(f"启动时迁移已由其它进程完成，耗时 {startup_stats['elapsed_ms']:.1f} ms")
                 else:
                     st.warning("⚠️ 数据库版本信息缺失")
             else:
@@ -530,22 +718,135 @@ elif setting_section == "数据管理":
     
     st.markdown("---")
     
-    with st.expander("💡 数据恢复说明", expanded=False):
-        st.markdown("""
-        ### 如何恢复备份数据
-        
-        1. **关闭程序**：确保 Ozon Seller Pro 已完全关闭
-        2. **找到数据库文件**：在程序根目录找到 `ozon_config.db`
-        3. **替换文件**：用备份文件替换现有的 `ozon_config.db`
-        4. **重启程序**：重新启动 Ozon Seller Pro
-        
-        ### 注意事项
-        
-        - 恢复前请确保程序已关闭
-        - 建议先备份当前数据库再恢复
-        - 不同版本的数据库可能不兼容
-        - 如遇问题请联系技术支持
-        """)
+    st.markdown("### ♻️ 从备份恢复")
+    st.caption("上传的备份先写入临时文件并做完整性与版本校验，校验通过后才会改动当前数据库")
+    
+    from utils import save_uploaded_backup, validate_backup_file, restore_database
+    
+    restore_file = st.file_uploader("选择备份文件 (.db)", type=["db"], key="restore_file")
+    
+    rcol1, rcol2 = st.columns(2)
+    with rcol1:
+        restore_mode = st.radio(
+            "恢复方式",
+            ["merge", "replace"],
+            format_func=lambda m: {"merge": "合并（补入缺少的历史记录和配置）", "replace": "整体替换当前数据库"}[m],
+            key="restore_mode"
+        )
+    with rcol2:
+        config_rule = st.radio(
+            "配置冲突时",
+            ["keep", "overwrite"],
+            format_func=lambda r: {"keep": "保留当前配置", "overwrite": "使用备份中的配置"}[r],
+            key="restore_config_rule",
+            disabled=restore_mode != "merge"
+        )
+    
+    if restore_mode == "replace":
+        st.warning("⚠️ 整体替换会覆盖当前所有数据，替换前会自动在 backups 目录保留一份当前数据库")
+    
+    if restore_file is not None and st.button("♻️ 开始恢复", key="run_restore", type="primary", use_container_width=True):
+        restore_path = None
+        try:
+            with st.spinner("正在保存并校验备份文件..."):
+                restore_path = save_uploaded_backup(restore_file)
+                report = validate_backup_file(restore_path)
+            
+            if not report['ok']:
+                for error in report['errors']:
+                    st.error(f"❌ {error}")
+            else:
+                st.info(
+                    f"校验通过：数据库 v{report['version']}，历史记录 {report['history_rows']:,} 条，"
+                    f"归档记录 {report['archived_rows']:,} 条"
+                )
+                with st.spinner("正在恢复..."):
+                    result = restore_database(restore_path, restore_mode, config_rule)
+                
+                if result['mode'] == 'replace':
+                    st.success(
+                        f"✅ 数据库已替换（恢复归档月份 {result['archive_months']} 个），原数据库已备份到 {result['safety_backup']}"
+                    )
+                else:
+                    st.success(
+                        f"✅ 合并完成：新增历史记录 {result['history_added']:,} 条，"
+                        f"新增/更新配置 {result['config_changed']} 项"
+                    )
+                st.cache_data.clear()
+        except Exception as e:
+            st.error(f"❌ 恢复失败: {e}")
+        finally:
+            if restore_path and os.path.exists(restore_path):
+                os.remove(restore_path)
+
+# ==================== 合规词库 ====================
+elif setting_section == "合规词库":
+    st.markdown("## 🛡️ 合规词库")
+    st.caption("AI 任务处理、任务大厅发布前和内容生产线生成前都会用这份词库做合规扫描；词库改动后扫描器自动重建，无需重启")
+    
+    from compliance_scanner import (
+        list_sensitive_words, add_sensitive_words, delete_sensitive_words,
+        parse_sensitive_words, scan_text, format_matches
+    )
+    
+    wcol1, wcol2 = st.columns([3, 1])
+    with wcol1:
+        new_words = st.text_input("添加敏感词（多个用逗号或顿号分隔）", key="new_sensitive_words")
+    with wcol2:
+        new_category = st.text_input("分类", value="通用", key="new_sensitive_category")
+    
+    if st.button("➕ 添加", key="add_sensitive_words", type="primary"):
+        added = add_sensitive_words(parse_sensitive_words(new_words), new_category.strip() or "通用")
+        if added:
+            st.success(f"✅ 已添加 {added} 个敏感词")
+        else:
+            st.info("没有新增词条（为空或已存在）")
+    
+    with st.expander("📤 批量导入词表", expanded=False):
+        st.caption("上传 .txt / .csv 文本文件，每行一个词（也支持逗号/顿号分隔），# 开头的行视为注释")
+        word_file = st.file_uploader("选择词表文件", type=["txt", "csv"], key="sensitive_words_file")
+        import_category = st.text_input("导入分类", value="通用", key="import_sensitive_category")
+        if word_file is not None and st.button("📥 导入", key="import_sensitive_words", use_container_width=True):
+            try:
+                content = word_file.getvalue().decode("utf-8-sig")
+                words = parse_sensitive_words(content)
+                added = add_sensitive_words(words, import_category.strip() or "通用")
+                st.success(f"✅ 解析 {len(words):,} 个词条，新增 {added:,} 个（其余已存在）")
+            except UnicodeDecodeError:
+                st.error("❌ 文件编码不是 UTF-8，请另存为 UTF-8 后重新上传")
+            except Exception as e:
+                st.error(f"❌ 导入失败: {e}")
+    
+    sensitive_words = list_sensitive_words()
+    st.markdown(f"### 📋 当前词库（{len(sensitive_words):,} 个）")
+    if sensitive_words:
+        words_df = pd.DataFrame(sensitive_words)
+        words_df.insert(0, '删除', False)
+        edited_words = st.data_editor(
+            words_df.rename(columns={'word': '敏感词', 'category': '分类', 'created_at': '添加时间'}),
+            column_config={'id': None},
+            disabled=['敏感词', '分类', '添加时间'],
+            use_container_width=True,
+            hide_index=True,
+            key="sensitive_words_editor"
+        )
+        selected_ids = edited_words.loc[edited_words['删除'], 'id'].tolist()
+        if st.button(f"🗑️ 删除选中（{len(selected_ids)}）", key="delete_sensitive_words", disabled=not selected_ids):
+            removed = delete_sensitive_words(selected_ids)
+            st.success(f"✅ 已删除 {removed} 个敏感词")
+            st.rerun()
+    else:
+        st.info("词库为空，合规扫描不会拦截任何内容")
+    
+    st.markdown("---")
+    st.markdown("### 🔍 扫描测试")
+    sample_text = st.text_area("输入一段文本，查看命中情况", key="compliance_sample_text", height=100)
+    if sample_text:
+        sample_matches = scan_text(sample_text)
+        if sample_matches:
+            st.error(f"⚠️ 命中 {len(sample_matches)} 处：{format_matches(sample_matches)}")
+        else:
+            st.success("✅ 未命中敏感词")
 
 # ==================== 关于系统 ====================
 elif setting_section == "关于系统":
@@ -637,7 +938,7 @@ elif setting_section == "关于系统":
             st.error("❌ 佣金率未配置")
     
     with col3:
-        tiers = get_logistics_tiers()
+        tiers = get_tier_table()
         if tiers:
             st.success(f"✅ {len(tiers)}个物流档位")
         else:
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-import time
 import json
 import os
 import sys
 
 # 动态加载底层依赖
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import get_db_connection, sidebar_footer
-from agent_engine import create_task, process_task, get_user_tasks
+from utils import sidebar_footer, save_config
+from agent_engine import (
+    create_task, create_tasks_bulk, get_user_tasks_page, get_task_result, get_credits,
+    task_dedup_ttl_hours, get_task_dedup_stats
+)
+from task_worker import ensure_worker_pool, get_worker_pool, configured_worker_count
+from compliance_scanner import scan_text, get_scanner, format_matches
 
 st.set_page_config(page_title="AI 任务大厅", page_icon="🌐", layout="wide")
 sidebar_footer()
@@ -16,13 +20,8 @@ sidebar_footer()
 # 当前测试环境默认账号
 USER_ID = "seller_001"
 
-def get_credits(user_id):
-    """安全获取用户积分"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT credits FROM user_credits WHERE user_id=?", (user_id,))
-        row = cursor.fetchone()
-        return row['credits'] if row else 0
+# 确保后台 Worker 池在运行（页面只负责发布任务和查看状态）
+ensure_worker_pool()
 
 # --- 高级黑金/蓝紫视觉 CSS ---
 st.markdown("""
@@ -88,48 +87,197 @@ with tabs[0]:
     st.info(f"💡 本次任务预估将扣除 {cost} 积分，平台将自动为您匹配最优 Agent 执行。")
     
     if st.button("🚀 提交并让 Agent 执行", type="primary", use_container_width=True):
+        compliance_matches = scan_text(task_data)
         if not task_data.strip():
             st.warning("⚠️ 请输入需处理的任务数据！")
+        elif compliance_matches:
+            # 提交前预检：命中敏感词的任务一定会被风控拦截，不扣积分直接提示修改
+            st.error(f"🛡️ 内容包含敏感词：{format_matches(compliance_matches)}，请修改后再提交")
         else:
             task_id, msg = create_task(USER_ID, task_action, {"input": task_data}, cost)
             if not task_id:
                 st.error(msg)  # 积分不足等报错
             else:
                 st.toast("✅ 任务已挂载至底层队列！")
-                # 模拟后端 Worker 进程异步处理
-                with st.spinner("⚡ AI Agent 正在云端接单并处理中..."):
-                    process_task(task_id)
-                st.success("🎉 任务执行完毕！")
-                time.sleep(1.5)
-                st.rerun()
+                st.success(f"{msg}（任务单号: {task_id}），可在「我的任务队列」查看进度")
+    
+    with st.expander("📤 批量提交任务（上传表格）", expanded=False):
+        st.caption("上传 CSV / Excel，每一行生成一个任务；积分一次性校验并扣除，不足时整批不提交")
+        bulk_file = st.file_uploader("选择任务表格", type=["csv", "xlsx", "xls"], key="bulk_task_file")
+        
+        if bulk_file is not None:
+            import pandas as pd
+            try:
+                if bulk_file.name.lower().endswith(".csv"):
+                    bulk_df = pd.read_csv(bulk_file, dtype=str, encoding="utf-8-sig")
+                else:
+                    bulk_df = pd.read_excel(bulk_file, dtype=str)
+            except Exception as e:
+                bulk_df = None
+                st.error(f"❌ 读取表格失败: {e}")
+            
+            if bulk_df is not None and len(bulk_df.columns):
+                text_column = st.selectbox("📄 要处理的文本列", list(bulk_df.columns), key="bulk_task_column")
+                bulk_items = []
+                flagged_rows = []
+                # 词库版本整批只查一次，逐行直接用同一个自动机扫描
+                scanner = get_scanner()
+                for row_no, text in enumerate(bulk_df[text_column].fillna("").astype(str).str.strip(), start=2):
+                    if not text:
+                        continue
+                    row_matches = scanner.scan(text)
+                    if row_matches:
+                        flagged_rows.append({'行号': row_no, '命中敏感词': format_matches(row_matches), '内容': text[:80]})
+                    else:
+                        bulk_items.append({"input": text})
+                
+                if flagged_rows:
+                    st.warning(f"🛡️ {len(flagged_rows):,} 行包含敏感词，已从本次提交中排除（不扣积分）")
+                    st.dataframe(pd.DataFrame(flagged_rows), use_container_width=True, hide_index=True)
+                bulk_cost = cost * len(bulk_items)
+                st.info(f"💡 共 {len(bulk_items):,} 个有效任务，将扣除 {bulk_cost:,} 积分（当前 {current_credits:,}）")
+                
+                if st.button("🚀 批量提交", key="submit_bulk_tasks", type="primary",
+                             use_container_width=True, disabled=not bulk_items):
+                    task_ids, msg = create_tasks_bulk(USER_ID, task_action, bulk_items, cost)
+                    if not task_ids:
+                        st.error(msg)
+                    else:
+                        st.success(msg)
+    
+    with st.expander("⚙️ 后台 Worker 设置", expanded=False):
+        worker_count = st.number_input(
+            "页面进程内并发 Worker 数",
+            min_value=0,
+            max_value=32,
+            value=configured_worker_count(),
+            help="设为 0 表示不在页面进程内处理，改由独立进程运行：python task_worker.py --workers 4"
+        )
+        if st.button("💾 保存并应用", key="save_task_workers"):
+            save_config('task_workers', worker_count)
+            ensure_worker_pool(worker_count)
+            st.success("✅ Worker 设置已生效")
+        
+        pool = get_worker_pool()
+        if pool is not None:
+            pool_stats = pool.stats()
+            st.caption(
+                f"运行中：{pool_stats['workers']} 个 Worker，处理中 {pool_stats['inflight']}，"
+                f"本次启动已完成 {pool_stats['processed']} 个"
+            )
+        else:
+            st.caption("页面进程内未运行 Worker，任务将由独立 Worker 进程处理")
+    
+    with st.expander("♻️ 结果复用（去重）", expanded=False):
+        st.caption("任务类型和内容（忽略多余空白）与有效期内已完成的任务相同时，直接复用其结果，不扣积分也不占用 Worker")
+        dedup_ttl = st.number_input(
+            "结果复用有效期（小时）",
+            min_value=0.0,
+            max_value=720.0,
+            value=task_dedup_ttl_hours(),
+            step=1.0,
+            help="设为 0 表示关闭结果复用"
+        )
+        if st.button("💾 保存", key="save_task_dedup_ttl"):
+            save_config('task_dedup_ttl_hours', dedup_ttl)
+            st.success("✅ 结果复用设置已保存")
+        
+        dedup_stats = get_task_dedup_stats()
+        dcol1, dcol2, dcol3 = st.columns(3)
+        dcol1.metric("复用命中", f"{dedup_stats['hits']:,}")
+        dcol2.metric("命中率", f"{dedup_stats['hit_rate']:.1%}")
+        dcol3.metric("累计节省积分", f"{dedup_stats['credits_saved']:,}")
 
 # Tab 2: 任务队列
 with tabs[1]:
     st.markdown("### 📋 历史发包记录")
-    tasks = get_user_tasks(USER_ID)
+    
+    status_map = {
+        'completed': '✅ 已完成',
+        'pending': '⏳ 等待接单',
+        'processing': '🔄 处理中',
+        'failed_compliance': '🔴 违规拦截',
+        'dead_letter': '☠️ 多次失败（已退款）'
+    }
+    
+    qcol1, qcol2, qcol3 = st.columns([2, 1, 1])
+    with qcol1:
+        status_filter = st.selectbox(
+            "按状态筛选",
+            [None] + list(status_map),
+            format_func=lambda s: "全部状态" if s is None else status_map[s],
+            key="task_status_filter"
+        )
+    with qcol2:
+        task_page_size = st.selectbox("每页条数", [10, 20, 50], index=1, key="task_page_size")
+    with qcol3:
+        st.markdown("<br>", unsafe_allow_html=True)
+        if st.button("🔄 刷新任务状态", key="refresh_tasks", use_container_width=True):
+            st.rerun()
+    
+    # 筛选条件变化时回到第一页；游标栈记录每一页的起点
+    task_filter_key = (status_filter, task_page_size)
+    if st.session_state.get('task_filter_key') != task_filter_key:
+        st.session_state.task_filter_key = task_filter_key
+        st.session_state.task_cursors = [None]
+    task_cursors = st.session_state.task_cursors
+    # 已点开查看结果的任务（结果正文只在这里按需读取和解析）
+    opened_results = st.session_state.setdefault('task_results_opened', set())
+    
+    tasks, next_task_cursor = get_user_tasks_page(
+        USER_ID, after=task_cursors[-1], page_size=task_page_size, status=status_filter
+    )
     
     if not tasks:
-        st.info("暂无任务记录，快去发包中心试试吧！")
+        if len(task_cursors) == 1 and status_filter is None:
+            st.info("暂无任务记录，快去发包中心试试吧！")
+        else:
+            st.info("没有符合条件的任务")
     else:
-        status_map = {
-            'completed': '✅ 已完成',
-            'pending': '⏳ 等待接单',
-            'processing': '🔄 处理中',
-            'failed_compliance': '🔴 违规拦截'
-        }
-        
         for t in tasks:
             status_emoji = status_map.get(t['status'], '❓ 未知状态')
+            if t['status'] == 'pending' and t['attempts']:
+                status_emoji = f"🔁 等待第 {t['attempts'] + 1} 次重试"
+            if t['dedup_of'] and t['status'] == 'completed':
+                status_emoji = '♻️ 已复用结果'
+            elif t['dedup_of'] and t['status'] == 'pending':
+                status_emoji = '⏳ 等待原任务完成'
             with st.expander(f"{status_emoji} | 任务单号: {t['task_id']} | 发布时间: {t['created_at']}"):
-                if t['status'] == 'failed_compliance':
-                    st.error(f"**拦截原因:** {t['result']}")
-                elif t['result']:
-                    try:
-                        # 尝试美化输出 JSON 结果
-                        res_json = json.loads(t['result'])
-                        st.json(res_json)
-                    except Exception:
-                        st.write(t['result'])
-                else:
+                if t['dedup_of']:
+                    st.caption(f"与任务 {t['dedup_of']} 内容相同，沿用其处理结果，未扣积分")
+                if t['status'] == 'dead_letter' and t['dedup_of']:
+                    st.error(f"**原任务多次失败，本任务未扣积分。** {t['last_error']}")
+                elif t['status'] == 'dead_letter':
+                    st.error(f"**已尝试 {t['attempts']} 次仍失败，积分已全额退回。** 最近错误: {t['last_error']}")
+                elif t['status'] == 'pending' and t['attempts']:
+                    st.warning(f"上次失败: {t['last_error']}，将于 {t['next_attempt_at']} 后重试")
+                elif not t['has_result']:
                     st.info("任务正在处理中或暂无返回结果...")
+                elif t['task_id'] not in opened_results:
+                    label = "🔍 查看拦截原因" if t['status'] == 'failed_compliance' else "📄 查看结果"
+                    if st.button(label, key=f"open_result_{t['task_id']}"):
+                        opened_results.add(t['task_id'])
+                        st.rerun()
+                else:
+                    result = get_task_result(t['task_id'], USER_ID)
+                    if t['status'] == 'failed_compliance':
+                        st.error(f"**拦截原因:** {result}")
+                    else:
+                        try:
+                            # 尝试美化输出 JSON 结果
+                            st.json(json.loads(result))
+                        except Exception:
+                            st.write(result)
+        
+        nav1, nav2, nav3 = st.columns([1, 2, 1])
+        with nav1:
+            if st.button("⬅️ 上一页", key="task_prev", disabled=len(task_cursors) == 1):
+                task_cursors.pop()
+                st.rerun()
+        with nav2:
+            st.caption(f"第 {len(task_cursors)} 页，本页 {len(tasks)} 个任务")
+        with nav3:
+            if st.button("下一页 ➡️", key="task_next", disabled=next_task_cursor is None):
+                task_cursors.append(next_task_cursor)
+                st.rerun()
 
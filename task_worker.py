@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Ozon Seller Pro v4.0 - AI 任务后台 Worker
+多个线程（以及多个 Worker 进程）通过租约原子认领 ai_tasks 中的待处理任务并发处理，页面只负责发布任务和查看状态
+
+两种运行方式：
+    1. 随 Streamlit 进程启动的线程池（配置 task_workers，默认 2；设为 0 表示不在页面进程内处理）
+    2. 独立进程：python task_worker.py --workers 4
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+from utils import load_config, close_db_connection
+from agent_engine import claim_task, run_claimed_task, reap_expired_leases, snapshot_credit_balances
+
+TASK_WORKERS_DEFAULT = 2
+POLL_INTERVAL_SECONDS = 1.0
+REAPER_INTERVAL_SECONDS = 15.0
+CREDIT_SNAPSHOT_INTERVAL_SECONDS = 300.0
+
+
+class TaskWorkerPool:
+    """
+    进程内 Worker 池：workers 个线程各自原子认领并处理任务，多个进程可以同时运行互不冲突
+    另有一个回收线程定期把租约过期的任务重新排队（或超过最大尝试次数后进入死信并退款），并定期生成积分余额快照
+    """
+
+    def __init__(self, workers=TASK_WORKERS_DEFAULT, poll_interval=POLL_INTERVAL_SECONDS,
+                 reaper_interval=REAPER_INTERVAL_SECONDS):
+        self.workers = max(int(workers), 1)
+        self.poll_interval = poll_interval
+        self.reaper_interval = reaper_interval
+        self.processed = 0
+        self.failed = 0
+        self.reaped = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        # 租约持有者标识：主机 + 进程 + 池实例，线程编号在 Worker 内追加
+        self.owner_prefix = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+
+    @property
+    def alive(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        """启动 Worker 线程和回收线程"""
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._work_loop, args=(f"{self.owner_prefix}:w{i + 1}",),
+                             name=f"ozon-task-worker-{i + 1}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self._threads.append(threading.Thread(target=self._reaper_loop, name="ozon-task-reaper", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def signal_stop(self):
+        """通知所有线程退出（不等待）"""
+        self._stop.set()
+
+    def join(self, timeout=10):
+        """等待所有线程退出（正在处理的任务会先完成）"""
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def stop(self, timeout=10):
+        """通知所有线程退出并等待正在处理的任务完成"""
+        self.signal_stop()
+        self.join(timeout)
+
+    def stats(self):
+        """当前统计：Worker 数、处理中数、累计完成/失败/回收数"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'inflight': self._busy,
+                'processed': self.processed,
+                'failed': self.failed,
+                'reaped': self.reaped,
+            }
+
+    def _reaper_loop(self):
+        """回收线程：定期处理租约过期的任务，每隔 CREDIT_SNAPSHOT_INTERVAL_SECONDS 生成一次积分快照"""
+        next_snapshot = time.monotonic() + CREDIT_SNAPSHOT_INTERVAL_SECONDS
+        while not self._stop.wait(self.reaper_interval):
+            try:
+                result = reap_expired_leases()
+                reaped = result['requeued'] + result['dead_letter']
+                if reaped:
+                    print(f"♻️ 回收过期任务：重新排队 {result['requeued']} 个，进入死信 {result['dead_letter']} 个")
+                    with self._lock:
+                        self.reaped += reaped
+            except Exception as e:
+                print(f"⚠️ 回收过期任务失败: {e}")
+
+            if time.monotonic() >= next_snapshot:
+                next_snapshot = time.monotonic() + CREDIT_SNAPSHOT_INTERVAL_SECONDS
+                try:
+                    snapshot_credit_balances()
+                except Exception as e:
+                    print(f"⚠️ 生成积分快照失败: {e}")
+        close_db_connection()
+
+    def _work_loop(self, worker_id):
+        """Worker 线程：认领 → 处理；队列为空时按轮询间隔休眠"""
+        while not self._stop.is_set():
+            try:
+                task = claim_task(worker_id)
+            except Exception as e:
+                print(f"⚠️ 认领任务失败: {e}")
+                task = None
+
+            if task is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            with self._lock:
+                self._busy += 1
+            try:
+                run_claimed_task(task, worker_id)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                print(f"❌ 任务 {task['task_id']} 处理失败: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self._busy -= 1
+        close_db_connection()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configured_worker_count():
+    """配置的页面进程内 Worker 数（task_workers，0 表示交给独立 Worker 进程）"""
+    try:
+        return max(int(float(load_config('task_workers', TASK_WORKERS_DEFAULT))), 0)
+    except (TypeError, ValueError):
+        return TASK_WORKERS_DEFAULT
+
+
+def ensure_worker_pool(workers=None):
+    """
+    确保页面进程内的 Worker 池按配置运行（可重复调用；Worker 数变化时重建）
+
+    参数:
+        workers: Worker 数，None 时读取配置 task_workers
+
+    返回:
+        TaskWorkerPool 或 None（配置为 0 时不启动）
+    """
+    global _pool
+    if workers is None:
+        workers = configured_worker_count()
+
+    old_pool = None
+    with _pool_lock:
+        if _pool is not None and _pool.alive and _pool.workers == workers:
+            return _pool
+        # 锁内只发出停止信号；等待旧线程退出放在锁外，不阻塞其它会话的页面请求
+        if _pool is not None:
+            old_pool = _pool
+            old_pool.signal_stop()
+            _pool = None
+        if workers > 0:
+            _pool = TaskWorkerPool(workers).start()
+        pool = _pool
+
+    if old_pool is not None:
+        old_pool.join()
+    return pool
+
+
+def get_worker_pool():
+    """当前进程内的 Worker 池（未启动时为 None）"""
+    return _pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ozon Seller Pro AI 任务后台 Worker")
+    parser.add_argument("--workers", type=int, default=None, help="并发 Worker 数（默认读取配置 task_workers）")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL_SECONDS, help="轮询间隔（秒）")
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers is not None else max(configured_worker_count(), 1)
+    pool = TaskWorkerPool(workers, poll_interval=args.poll_interval).start()
+    print(f"✅ AI 任务 Worker 已启动：{workers} 个并发，按 Ctrl+C 退出")
+
+    try:
+        while pool.alive:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("⏹️ 正在停止 Worker，等待处理中的任务完成...")
+    finally:
+        pool.stop()
+        print(f"✅ Worker 已退出：完成 {pool.processed} 个，失败 {pool.failed} 个")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""测试公共夹具：每个测试使用临时目录中的独立数据库、归档库和备份目录"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compliance_scanner
+import utils
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    utils.close_db_connection()
+    monkeypatch.setattr(utils, "DB_PATH", str(tmp_path / "ozon_config.db"))
+    monkeypatch.setattr(utils, "ARCHIVE_DB_PATH", str(tmp_path / "ozon_history_archive.db"))
+    monkeypatch.setattr(utils, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(compliance_scanner, "_scanner_cache", (None, compliance_scanner.AhoCorasick([])))
+    utils.reset_db_connections()
+    utils._load_archive_month.cache_clear()
+    utils.init_database()
+    yield tmp_path
+    utils.close_db_connection()
+    utils.reset_db_connections()
+    utils._load_archive_month.cache_clear()
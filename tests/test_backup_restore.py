@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""备份恢复：整体替换（先留安全备份）与按自然键合并（配置冲突按规则处理）"""
+import os
+
+import pytest
+
+import utils
+
+
+def _history_names():
+    with utils.get_db_connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT product_name FROM history"))
+
+
+def _save(names):
+    return utils.save_history_records([{'product_name': name, 'cost': 10, 'final_price': 30} for name in names])
+
+
+def test_replace_restores_backup_and_keeps_safety_copy(fresh_db):
+    _save(['a', 'b'])
+    utils.save_config('exchange_rate', '11')
+    backup_path = str(fresh_db / "backup.db")
+    utils.backup_database(backup_path)
+
+    _save(['c'])
+    utils.save_config('exchange_rate', '13')
+    assert utils.load_config('exchange_rate') == '13'
+
+    report = utils.validate_backup_file(backup_path)
+    assert report['ok'] and report['history_rows'] == 2
+
+    result = utils.restore_database(backup_path, mode='replace')
+
+    assert _history_names() == ['a', 'b']
+    assert utils.load_config('exchange_rate') == '11'
+    # 替换前的库保存在轮转备份里
+    assert os.path.exists(result['safety_backup'])
+    assert utils.validate_backup_file(result['safety_backup'])['history_rows'] == 3
+
+
+def test_merge_adds_missing_history_and_applies_config_rule(fresh_db, monkeypatch):
+    _save(['shared'])
+    utils.save_config('exchange_rate', '11')
+    utils.save_config('only_in_backup', 'x')
+    backup_path = str(fresh_db / "backup.db")
+    utils.backup_database(backup_path)
+
+    # 当前库：删掉备份独有的配置，改掉冲突配置，另加一条历史
+    with utils.get_db_connection() as conn:
+        conn.execute("DELETE FROM config WHERE key = 'only_in_backup'")
+    utils.bump_config_generation()
+    utils.save_config('exchange_rate', '13')
+    _save(['local'])
+    with utils.get_db_connection() as conn:
+        conn.execute("""
+            INSERT INTO history (product_name, cost, final_price, created_at)
+            VALUES ('backup_only', 10, 30, '2024-01-01 00:00:00')
+        """)
+    utils.backup_database(str(fresh_db / "backup2.db"))
+    with utils.get_db_connection() as conn:
+        conn.execute("DELETE FROM history WHERE product_name = 'backup_only'")
+
+    result = utils.restore_database(str(fresh_db / "backup2.db"), mode='merge', config_rule='keep')
+    assert result['history_added'] == 1
+    assert _history_names() == ['backup_only', 'local', 'shared']
+
+    result = utils.restore_database(backup_path, mode='merge', config_rule='keep')
+    assert result['history_added'] == 0
+    assert utils.load_config('exchange_rate') == '13'
+    assert utils.load_config('only_in_backup') == 'x'
+
+    result = utils.restore_database(backup_path, mode='merge', config_rule='overwrite')
+    assert result['config_changed'] == 1
+    assert utils.load_config('exchange_rate') == '11'
+
+
+def test_invalid_backup_is_rejected(fresh_db):
+    bogus = fresh_db / "bogus.db"
+    bogus.write_bytes(b"not a database")
+    with pytest.raises(ValueError):
+        utils.restore_database(str(bogus), mode='replace')
+    assert utils.validate_backup_file(str(bogus))['ok'] is False
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Aho-Corasick 合规扫描：重叠命中、大小写折叠、命中位置，以及词库变更后自动重建"""
+import compliance_scanner
+from compliance_scanner import AhoCorasick, ComplianceMatch
+
+
+def test_finds_all_overlapping_matches_with_positions():
+    scanner = AhoCorasick(["he", "she", "his", "hers"])
+    assert scanner.scan("ushers") == [
+        ComplianceMatch("she", 1, 4),
+        ComplianceMatch("he", 2, 4),
+        ComplianceMatch("hers", 2, 6),
+    ]
+
+
+def test_case_folding_and_mixed_scripts():
+    scanner = AhoCorasick(["刷单", "Подделка", " vpn ", "", "刷单"])
+    assert len(scanner) == 3
+    text = "支持刷单，VPN 和 ПОДДЕЛКА"
+    matches = scanner.scan(text)
+    assert [m.term for m in matches] == ["刷单", "vpn", "Подделка"]
+    # 命中位置直接对应原文
+    assert [text[m.start:m.end] for m in matches] == ["刷单", "VPN", "ПОДДЕЛКА"]
+
+
+def test_no_words_or_no_text():
+    assert AhoCorasick([]).scan("任何内容") == []
+    assert AhoCorasick(["刷单"]).scan("") == []
+
+
+def test_scanner_rebuilds_when_word_list_changes(fresh_db):
+    assert compliance_scanner.scan_text("这是一段测试新词") == []
+    assert compliance_scanner.add_sensitive_words(["测试新词", "测试新词"]) == 1
+
+    passed, matches = compliance_scanner.check_compliance("这是一段测试新词")
+    assert not passed
+    assert matches == [ComplianceMatch("测试新词", 4, 8)]
+    assert compliance_scanner.format_matches(matches) == "测试新词(第 5 字)"
+
+    word_id = next(w['id'] for w in compliance_scanner.list_sensitive_words() if w['word'] == "测试新词")
+    assert compliance_scanner.delete_sensitive_words([word_id]) == 1
+    assert compliance_scanner.scan_text("这是一段测试新词") == []
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""积分流水账：余额 = 快照 + 之后的流水，生成快照前后余额一致，余额不足时整批拒绝"""
+import agent_engine
+import utils
+
+
+def _ledger_sum(user_id):
+    with utils.get_db_connection() as conn:
+        return conn.execute("SELECT COALESCE(SUM(delta), 0) FROM credit_ledger WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+def _snapshot(user_id):
+    with utils.get_db_connection() as conn:
+        row = conn.execute("SELECT balance, ledger_id FROM credit_snapshots WHERE user_id = ?", (user_id,)).fetchone()
+        return tuple(row) if row else None
+
+
+def test_balance_matches_ledger_across_snapshots(fresh_db):
+    initial, _ = _snapshot('seller_001')
+    for _ in range(5):
+        assert agent_engine.create_tasks_bulk('seller_001', 'seo', [{'n': i} for i in range(3)], 7)[0]
+    expected = initial + _ledger_sum('seller_001')
+    assert expected == initial - 5 * 3 * 7
+    assert agent_engine.get_credits('seller_001') == expected
+
+    # 快照之后的流水不足阈值：不生成快照
+    assert agent_engine.snapshot_credit_balances(min_entries=100) == 0
+    assert agent_engine.snapshot_credit_balances(min_entries=3) == 1
+    balance, ledger_id = _snapshot('seller_001')
+    assert balance == expected
+    with utils.get_db_connection() as conn:
+        assert ledger_id == conn.execute("SELECT MAX(id) FROM credit_ledger WHERE user_id = 'seller_001'").fetchone()[0]
+
+    # 快照之后继续记账，余额仍等于 初始快照 + 全部流水
+    assert agent_engine.create_tasks_bulk('seller_001', 'seo', [{'n': 'new'}], 7)[0]
+    assert agent_engine.get_credits('seller_001') == initial + _ledger_sum('seller_001') == expected - 7
+
+
+def test_insufficient_credits_rejects_whole_batch(fresh_db):
+    balance = agent_engine.get_credits('seller_001')
+    items = [{'n': i} for i in range(3)]
+    task_ids, msg = agent_engine.create_tasks_bulk('seller_001', 'seo', items, balance // 2)
+    assert task_ids is None
+    assert '积分不足' in msg
+    assert agent_engine.get_credits('seller_001') == balance
+    with utils.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM ai_tasks").fetchone()[0] == 0
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""历史归档：按月归档、包含归档的键集分页/计数/导出/渠道列表，以及从不带归档的旧备份恢复后 id 不重号"""
+import csv
+
+import utils
+
+
+def _save_aged(count, days_ago, channel='轻小件', prefix='p'):
+    ids = utils.save_history_records([
+        {'product_name': f'{prefix}{i}', 'cost': 10, 'final_price': 30, 'channel_name': channel, 'margin': 10 + i}
+        for i in range(count)
+    ])
+    with utils.get_db_connection() as conn:
+        conn.executemany(
+            "UPDATE history SET created_at = datetime('now', ?, ?) WHERE id = ?",
+            [(f'-{days_ago} days', f'+{i} seconds', row_id) for i, row_id in enumerate(ids)]
+        )
+    return ids
+
+
+def _page_through(page_size, **filters):
+    rows, cursor = [], None
+    while True:
+        page, cursor = utils.get_history_page(after=cursor, page_size=page_size, include_archive=True, **filters)
+        rows.extend(page)
+        if cursor is None:
+            return rows
+
+
+def test_archive_and_page_through_live_and_archived(fresh_db):
+    old_ids = _save_aged(7, 400, channel='旧渠道')
+    new_ids = _save_aged(5, 1)
+
+    summary = utils.archive_history(older_than_days=180)
+    assert summary['rows'] == 7
+    with utils.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 5
+
+    rows = _page_through(page_size=3)
+    assert [row['id'] for row in rows] == sorted(old_ids + new_ids, reverse=True)
+    assert [row['id'] for row in _page_through(page_size=4, channel='旧渠道')] == sorted(old_ids, reverse=True)
+
+    assert utils.get_history_channels() == ['轻小件']
+    assert utils.get_history_channels(include_archive=True) == ['旧渠道', '轻小件']
+    assert utils.count_history_records(include_archive=True) == 12
+    assert utils.count_history_records(include_archive=True, min_margin=14) == 3 + 1
+
+    export_path = fresh_db / "export.csv"
+    assert utils.export_history(str(export_path), include_archive=True) == 12
+    with open(export_path, encoding='utf-8-sig', newline='') as f:
+        exported_ids = [int(row[0]) for row in list(csv.reader(f))[1:]]
+    assert exported_ids == sorted(old_ids + new_ids)
+
+
+def test_rows_left_behind_by_interrupted_archive_are_counted_once(fresh_db):
+    old_ids = _save_aged(4, 400)
+    utils.archive_history(older_than_days=180)
+    archived = utils.query_history()
+    assert sorted(archived['id']) == old_ids
+
+    # 模拟归档写入后、删除在线记录前中断：在线库里仍有同一批记录
+    with utils.get_db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO history (id, product_name, cost, final_price, channel_name, margin, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(int(r.id), r.product_name, r.cost, r.final_price, r.channel_name, r.margin, r.created_at_utc) for r in archived.itertuples()]
+        )
+
+    assert utils.count_history_records(include_archive=True) == 4
+    assert len(_page_through(page_size=3)) == 4
+    assert len(utils.query_history()) == 4
+    # 重跑归档只是把这批记录再并入同一个月份
+    assert utils.archive_history(older_than_days=180)['rows'] == 4
+    assert sum(m['row_count'] for m in utils.list_archived_months()) == 4
+
+
+def test_replace_restore_without_archive_keeps_ids_unique(fresh_db):
+    _save_aged(3, 400)
+    backup_path = str(fresh_db / "before_archive.db")
+    utils.backup_database(backup_path)
+
+    later_ids = _save_aged(2, 300)
+    utils.archive_history(older_than_days=180)
+    utils.restore_database(backup_path, mode='replace')
+
+    (new_id,) = utils.save_history_records([{'product_name': 'new'}])
+    assert new_id > max(later_ids)
+    # 备份里的 3 条与归档中的同一批记录只出现一次
+    assert utils.count_history_records(include_archive=True) == 6
+    assert len(utils.query_history()) == 6
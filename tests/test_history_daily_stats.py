@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""history_daily_stats 触发器：利润率为空的记录也能正常写入并计入日统计"""
+import utils
+
+
+def test_null_margin_is_counted_as_not_high_margin(fresh_db):
+    ids = utils.save_history_records([
+        {'product_name': 'x', 'margin': None},
+        {'product_name': 'y', 'margin': float('nan')},
+        {'product_name': 'z', 'margin': 25.0, 'profit': 10.0},
+    ])
+    assert len(ids) == 3
+
+    with utils.get_db_connection() as conn:
+        record_count, high_margin_count = conn.execute(
+            "SELECT SUM(record_count), SUM(high_margin_count) FROM history_daily_stats"
+        ).fetchone()
+    assert record_count == 3
+    assert high_margin_count == 1
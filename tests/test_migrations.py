@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""版本化迁移：旧版 v1 数据库升级到最新版本，已有数据和积分余额保持不变"""
+import sqlite3
+
+import agent_engine
+import utils
+
+
+def _make_v1_database(path):
+    """按 v1 结构建库（含早期版本的 user_credits 余额表），并写入一些旧数据"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    utils._migration_001_base_schema(cursor)
+    utils._migration_002_ai_task_tables(cursor)
+    cursor.execute("CREATE TABLE db_meta (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL DEFAULT 1, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    cursor.execute("INSERT INTO db_meta (id, version) VALUES (1, 1)")
+    cursor.execute("UPDATE user_credits SET credits = 4321 WHERE user_id = 'seller_001'")
+    cursor.execute("UPDATE user_credits SET credits = 77 WHERE user_id = 'platform'")
+    cursor.execute("INSERT INTO history (product_name, cost, final_price, channel_name, margin) VALUES ('旧记录', 10, 30, '轻小件', 25)")
+    conn.commit()
+    conn.close()
+
+
+def test_v1_database_upgrades_and_keeps_balances(fresh_db, monkeypatch):
+    path = str(fresh_db / "legacy.db")
+    _make_v1_database(path)
+    utils.close_db_connection()
+    monkeypatch.setattr(utils, "DB_PATH", path)
+    utils.reset_db_connections()
+
+    utils.init_database()
+
+    stats = utils.get_db_startup_stats()
+    assert stats['error'] is None
+    assert stats['version'] == utils.LATEST_DB_VERSION
+    assert stats['applied'] == list(range(2, utils.LATEST_DB_VERSION + 1))
+    assert stats['fast_path'] is False
+
+    assert agent_engine.get_credits('seller_001') == 4321
+    assert agent_engine.get_credits(agent_engine.PLATFORM_USER_ID) == 77
+    with utils.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 1
+        # v4 回填了旧记录的日统计
+        assert tuple(conn.execute("SELECT SUM(record_count), SUM(high_margin_count) FROM history_daily_stats").fetchone()) == (1, 1)
+
+    # 再次启动走快速路径
+    utils.init_database()
+    stats = utils.get_db_startup_stats()
+    assert stats['applied'] == []
+    assert stats['fast_path'] is True
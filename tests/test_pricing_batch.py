@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""向量化批量定价/反推与逐个计算的结果一致"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+
+PARAMS = dict(profit_rate=1.5, commission_rate=15, label_fee=2.0)
+EXCHANGE_RATE = 12.5
+
+
+@pytest.fixture
+def tiers():
+    return utils.compile_logistics_tiers(utils.DEFAULT_LOGISTICS_TIERS)
+
+
+def test_price_batch_matches_smart_match_logistics(tiers):
+    rng = np.random.default_rng(7)
+    # 覆盖各档位重量边界、价格上限附近和超出所有档位（兜底）的情况
+    weights = np.concatenate([[0, 1, 500, 501, 2000, 2001, 30000, 30001], rng.uniform(1, 40000, 300)])
+    costs = np.concatenate([[0.5, 50, 40, 200, 300, 350, 10, 5], rng.uniform(0.5, 400, 300)])
+    df = pd.DataFrame({'cost': costs, 'charge_weight': weights})
+
+    result = utils.price_batch(df, exchange_rate=EXCHANGE_RATE, tiers=tiers, **PARAMS)
+
+    for row in result.itertuples():
+        expected = utils.smart_match_logistics(row.charge_weight, row.cost, tiers=tiers, **PARAMS)
+        assert row.channel_name == expected['tier']['name']
+        assert row.shipping_fee == pytest.approx(expected['shipping_fee'])
+        assert row.final_price == pytest.approx(expected['final_price'])
+        assert row.final_price_rub == pytest.approx(expected['final_price'] * EXCHANGE_RATE)
+
+
+def test_reverse_calculate_batch_matches_reverse_calculate_cost(tiers):
+    rng = np.random.default_rng(11)
+    prices = np.concatenate([[1, 100, 1687.5, 1688, 7937.5, 7938, 50000], rng.uniform(1, 20000, 300)])
+    weights = np.concatenate([[100, 400, 500, 501, 2000, 30000, 45000], rng.uniform(1, 40000, 300)])
+    df = pd.DataFrame({'price_rub': prices, 'weight_g': weights})
+
+    result = utils.reverse_calculate_batch(df, exchange_rate=EXCHANGE_RATE, tiers=tiers, **PARAMS)
+
+    for row in result.itertuples():
+        expected = utils.reverse_calculate_cost(row.price_rub, row.weight_g, EXCHANGE_RATE, tiers=tiers, **PARAMS)
+        assert row.channel_name == expected['tier']['name']
+        assert row.shipping_fee == pytest.approx(expected['shipping_fee'])
+        assert row.max_cost == pytest.approx(expected['max_cost'])
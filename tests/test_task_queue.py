@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""AI 任务队列：原子认领、租约过期回收、死信退款，以及同批复用任务跟随原任务结束"""
+import agent_engine
+import utils
+
+COST = 100
+
+
+def _submit(items, user_id='seller_001'):
+    task_ids, msg = agent_engine.create_tasks_bulk(user_id, 'seo', items, COST)
+    assert task_ids, msg
+    return task_ids
+
+
+def _task(task_id):
+    with utils.get_db_connection() as conn:
+        return dict(conn.execute("SELECT * FROM ai_tasks WHERE task_id = ?", (task_id,)).fetchone())
+
+
+def _expire_lease(task_id):
+    with utils.get_db_connection() as conn:
+        conn.execute("UPDATE ai_tasks SET lease_expires_at = datetime('now', '-1 seconds') WHERE task_id = ?", (task_id,))
+
+
+def _make_due(task_id):
+    with utils.get_db_connection() as conn:
+        conn.execute("UPDATE ai_tasks SET next_attempt_at = NULL WHERE task_id = ?", (task_id,))
+
+
+def test_claim_is_exclusive_and_in_creation_order(fresh_db):
+    first, second = _submit([{'n': 1}, {'n': 2}])
+
+    claimed = agent_engine.claim_task('w1')
+    assert claimed['task_id'] == first
+    assert claimed['attempts'] == 1
+    assert agent_engine.claim_task('w2')['task_id'] == second
+    assert agent_engine.claim_task('w3') is None
+
+    task = _task(first)
+    assert task['status'] == 'processing'
+    assert task['lease_owner'] == 'w1'
+
+
+def test_expired_lease_is_requeued_and_fenced(fresh_db):
+    (task_id,) = _submit([{'n': 1}])
+    claimed = agent_engine.claim_task('w1')
+    _expire_lease(task_id)
+
+    assert agent_engine.reap_expired_leases() == {'requeued': 1, 'dead_letter': 0}
+    task = _task(task_id)
+    assert task['status'] == 'pending'
+    assert task['next_attempt_at'] is not None
+    # 退避期间不可认领
+    assert agent_engine.claim_task('w2') is None
+
+    # 原 Worker 的租约已失效，迟到的失败回写不生效
+    assert agent_engine.fail_task(claimed, 'w1', 'late') is None
+
+    _make_due(task_id)
+    assert agent_engine.claim_task('w2')['attempts'] == 2
+
+
+def test_dead_letter_refunds_credits(fresh_db):
+    before = agent_engine.get_credits('seller_001')
+    (task_id,) = _submit([{'n': 1}])
+    assert agent_engine.get_credits('seller_001') == before - COST
+
+    for attempt in range(1, 4):
+        _make_due(task_id)
+        claimed = agent_engine.claim_task('w1')
+        assert claimed['attempts'] == attempt
+        if attempt < 3:
+            assert agent_engine.fail_task(claimed, 'w1', 'boom') == 'pending'
+        else:
+            # 最后一次由回收器发现租约过期
+            _expire_lease(task_id)
+            assert agent_engine.reap_expired_leases() == {'requeued': 0, 'dead_letter': 1}
+
+    assert _task(task_id)['status'] == 'dead_letter'
+    assert agent_engine.get_credits('seller_001') == before
+
+
+def test_in_batch_repeat_follows_source_outcome(fresh_db, monkeypatch):
+    monkeypatch.setattr(agent_engine.time, "sleep", lambda seconds: None)
+    before = agent_engine.get_credits('seller_001')
+    blocked, blocked_repeat, ok, ok_repeat = _submit([{'t': '刷单'}, {'t': '刷单'}, {'t': '耳机'}, {'t': '耳机'}])
+    assert agent_engine.get_credits('seller_001') == before - 2 * COST
+
+    # 同批复用任务不会被 Worker 认领，等待原任务结束
+    assert _task(blocked_repeat)['status'] == 'pending'
+    claimed = [agent_engine.claim_task('w1'), agent_engine.claim_task('w1')]
+    assert [task['task_id'] for task in claimed] == [blocked, ok]
+    assert agent_engine.claim_task('w1') is None
+
+    for task in claimed:
+        assert agent_engine.run_claimed_task(task, 'w1')
+
+    assert _task(blocked_repeat)['status'] == 'failed_compliance'
+    assert '未扣积分' in agent_engine.get_task_result(blocked_repeat, 'seller_001')
+    assert _task(ok_repeat)['status'] == 'completed'
+    assert agent_engine.get_task_result(ok_repeat, 'seller_001') == agent_engine.get_task_result(ok, 'seller_001')
+    # 只退回被拦截的原任务那一份
+    assert agent_engine.get_credits('seller_001') == before - COST
+
+
+def test_results_are_not_reused_across_users(fresh_db):
+    with utils.get_db_connection() as conn:
+        conn.execute("INSERT INTO credit_ledger (user_id, delta, reason) VALUES ('seller_002', 1000, 'grant')")
+    (task_id,) = _submit([{'n': 1}])
+    with utils.get_db_connection() as conn:
+        conn.execute("UPDATE ai_tasks SET status = 'completed', result = 'R' WHERE task_id = ?", (task_id,))
+
+    (other,) = _submit([{'n': 1}], user_id='seller_002')
+    assert _task(other)['dedup_of'] is None
+    assert agent_engine.get_credits('seller_002') == 1000 - COST
@@ -9,6 +9,17 @@ from contextlib import contextmanager
 import os
 import requests
 import json
+import io
+import csv
+import zlib
+import time
+import threading
+from types import MappingProxyType
+from bisect import bisect_left
+from itertools import islice
+from functools import lru_cache
+import numpy as np
+import pandas as pd
 
 # 数据库文件路径（基于当前运行目录，兼容打包后的环境）
 current_dir = os.getcwd()
@@ -18,172 +29,587 @@ DB_PATH = os.path.join(current_dir, "ozon_config.db")
 REMOTE_CONFIG_URL = "https://raw.githubusercontent.com/你的用户名/OzonPro/main/config.json"
 
 
+# 连接调优参数
+DB_BUSY_TIMEOUT_MS = 5000        # 写锁被占用时最多等待 5 秒，而不是立即报 database is locked
+DB_STATEMENT_CACHE_SIZE = 256    # 每个连接缓存的预编译语句数
+DB_CACHE_SIZE_MIN_KB = 2048      # 页缓存下限 2MB
+DB_CACHE_SIZE_MAX_KB = 65536     # 页缓存上限 64MB
+
+# 线程级连接池：每个线程复用一条已调优的连接；代号变化（如恢复备份后）时重新打开
+_db_local = threading.local()
+_db_pool_generation = 0
+
+
+def _tuned_cache_size_kb():
+    """按数据库文件大小设置页缓存（整库可放入缓存，但不超过上限）"""
+    try:
+        db_size_kb = os.path.getsize(DB_PATH) // 1024
+    except OSError:
+        db_size_kb = 0
+    return min(max(db_size_kb, DB_CACHE_SIZE_MIN_KB), DB_CACHE_SIZE_MAX_KB)
+
+
+def _open_db_connection():
+    """打开一条调优后的连接：WAL + synchronous=NORMAL + busy_timeout + 页缓存 + 语句缓存"""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{_tuned_cache_size_kb()}")
+    return conn
+
+
+def reset_db_connections():
+    """使所有线程的池化连接失效（各线程下次取连接时重新打开）"""
+    global _db_pool_generation
+    _db_pool_generation += 1
+
+
+def close_db_connection():
+    """关闭当前线程的池化连接（线程退出前或测试时使用）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and getattr(_db_local, 'depth', 0) == 0:
+        conn.close()
+        _db_local.conn = None
+
+
+def checkpoint_database():
+    """把 WAL 日志合并回主库文件（直接读取 .db 文件前调用）"""
+    with get_db_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
 @contextmanager
 def get_db_connection():
-    """数据库连接上下文管理器"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    数据库连接上下文管理器（线程级连接池）
+    最外层正常退出时提交；任何异常（包括 st.rerun()/st.stop() 抛出的 BaseException）都会回滚，
+    连接不会带着未结束的事务和写锁留在池中
+    嵌套使用时内层以 SAVEPOINT 包裹：内层失败只回滚内层的写入，调用方捕获异常后外层仍可正常提交
+    """
+    state = _db_local
+    depth = getattr(state, 'depth', 0)
+    conn = getattr(state, 'conn', None)
+    
+    # 仅在不处于外层事务中时才允许重新打开连接
+    if depth == 0 and conn is not None and (state.generation != _db_pool_generation or state.path != DB_PATH):
+        conn.close()
+        conn = None
+    
+    if conn is None:
+        conn = _open_db_connection()
+        state.conn = conn
+        state.generation = _db_pool_generation
+        state.path = DB_PATH
+    
+    # 内层进入时外层已开启事务：用保存点隔离内层写入；外层尚未开启事务时，之后的事务完全属于内层
+    savepoint = None
+    if depth > 0 and conn.in_transaction:
+        savepoint = f"nested_{depth}"
+        conn.execute(f"SAVEPOINT {savepoint}")
+    
+    state.depth = depth + 1
     try:
         yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
+        if depth == 0:
+            conn.commit()
+        elif savepoint and conn.in_transaction:
+            conn.execute(f"RELEASE {savepoint}")
+    except BaseException:
+        if depth == 0 or (savepoint is None and conn.in_transaction):
+            conn.rollback()
+        elif conn.in_transaction:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+        raise
     finally:
-        conn.close()
+        state.depth = depth
+
+
+def _migration_001_base_schema(cursor):
+    """v1：基础表结构（配置、物流档位、测款历史）与默认数据"""
+    # 创建 config 表
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    
+    # 创建 logistics_tiers 表
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS logistics_tiers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            max_weight REAL DEFAULT 0,
+            max_price REAL DEFAULT 0,
+            fixed_fee REAL DEFAULT 0,
+            per_gram_fee REAL DEFAULT 0,
+            priority INTEGER DEFAULT 0
+        )
+    """)
+    
+    # 创建 history 表（测款历史记录）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT,
+            cost REAL,
+            weight REAL,
+            charge_weight REAL,
+            channel_name TEXT,
+            shipping_fee REAL,
+            final_price REAL,
+            profit REAL,
+            margin REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # 【关键】初始化默认配置（使用 INSERT OR IGNORE 防止重复插入）
+    default_configs = [
+        ('commission_rate', '15.0'),
+        ('exchange_rate', '13.5'),
+        ('label_fee', '1.5'),
+        ('profit_rate', '1.35')
+    ]
+    cursor.executemany("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", default_configs)
+    
+    # 【关键】初始化默认物流档位（仅在表为空时插入）
+    cursor.execute("SELECT COUNT(*) FROM logistics_tiers")
+    if cursor.fetchone()[0] == 0:
+        cursor.executemany("""
+            INSERT INTO logistics_tiers (name, max_weight, max_price, fixed_fee, per_gram_fee, priority)
+            VALUES (:name, :max_weight, :max_price, :fixed_fee, :per_gram_fee, :priority)
+        """, DEFAULT_LOGISTICS_TIERS)
+
+
+def _migration_002_ai_task_tables(cursor):
+    """v2：AI 任务社区表（早期 v1 数据库可能缺少，全部使用 IF NOT EXISTS 保证幂等）"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT DEFAULT 'pending',
+            user_id TEXT,
+            payload TEXT,
+            cost INTEGER,
+            result TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_credits (
+            user_id TEXT PRIMARY KEY,
+            credits INTEGER DEFAULT 10000
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS compliance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            action TEXT,
+            detail TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # 初始化测试用户和平台积分账号
+    cursor.execute("INSERT OR IGNORE INTO user_credits (user_id, credits) VALUES ('seller_001', 10000)")
+    cursor.execute("INSERT OR IGNORE INTO user_credits (user_id, credits) VALUES ('platform', 0)")
+
+
+def _migration_003_history_indexes(cursor):
+    """v3：history 表索引（按时间倒序分页、按利润率/渠道过滤）"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_created_at ON history (created_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_margin ON history (margin)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_channel ON history (channel_name, created_at, id)")
+
+
+def _migration_004_history_daily_stats(cursor):
+    """
+    v4：按（本地日期, 渠道）汇总的 history 日统计表
+    只由 INSERT 触发器累加：归档/删除明细不影响累计数据，清空历史时由 clear_history 一并清空
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS history_daily_stats (
+            day TEXT NOT NULL,
+            channel_name TEXT NOT NULL DEFAULT '',
+            record_count INTEGER NOT NULL DEFAULT 0,
+            high_margin_count INTEGER NOT NULL DEFAULT 0,
+            profit_sum REAL NOT NULL DEFAULT 0,
+            margin_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, channel_name)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_history_daily_stats_insert
+        AFTER INSERT ON history
+        BEGIN
+            INSERT INTO history_daily_stats (
+                day, channel_name, record_count, high_margin_count, profit_sum, margin_sum
+            ) VALUES (
+                date(NEW.created_at, 'localtime'), COALESCE(NEW.channel_name, ''), 1,
+                NEW.margin >= 20.0, COALESCE(NEW.profit, 0), COALESCE(NEW.margin, 0)
+            )
+            ON CONFLICT(day, channel_name) DO UPDATE SET
+                record_count = record_count + 1,
+                high_margin_count = high_margin_count + excluded.high_margin_count,
+                profit_sum = profit_sum + excluded.profit_sum,
+                margin_sum = margin_sum + excluded.margin_sum;
+        END
+    """)
+    
+    # 回填已有明细
+    cursor.execute("DELETE FROM history_daily_stats")
+    cursor.execute("""
+        INSERT INTO history_daily_stats (
+            day, channel_name, record_count, high_margin_count, profit_sum, margin_sum
+        )
+        SELECT
+            date(created_at, 'localtime'), COALESCE(channel_name, ''), COUNT(*),
+            COALESCE(SUM(margin >= 20.0), 0), COALESCE(SUM(profit), 0), COALESCE(SUM(margin), 0)
+        FROM history
+        GROUP BY 1, 2
+    """)
+
+
+def _migration_005_ai_task_queue_index(cursor):
+    """v5：ai_tasks 队列索引（后台 Worker 按状态 + 创建时间轮询待处理任务）"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_status ON ai_tasks (status, created_at)")
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """为已有表补充列（ALTER TABLE ADD COLUMN 不支持 IF NOT EXISTS）"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _migration_006_ai_task_leases(cursor):
+    """v6：ai_tasks 租约字段（Worker 原子认领任务，写回结果时以 lease_owner 为栅栏）"""
+    _add_column_if_missing(cursor, "ai_tasks", "lease_owner", "TEXT")
+    _add_column_if_missing(cursor, "ai_tasks", "lease_expires_at", "TIMESTAMP")
+
+
+def _migration_007_ai_task_retries(cursor):
+    """v7：ai_tasks 重试字段（尝试次数、最大尝试次数、下次重试时间、最近错误）与租约回收索引"""
+    _add_column_if_missing(cursor, "ai_tasks", "attempts", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "ai_tasks", "max_attempts", "INTEGER NOT NULL DEFAULT 3")
+    _add_column_if_missing(cursor, "ai_tasks", "next_attempt_at", "TIMESTAMP")
+    _add_column_if_missing(cursor, "ai_tasks", "last_error", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_lease ON ai_tasks (status, lease_expires_at)")
+
+
+# 合规词库初始词条（原先硬编码在 agent_engine 中）
+SENSITIVE_WORDS_SEED = ["违禁词", "政治敏感", "刷单", "翻墙"]
+
+
+def _migration_008_sensitive_words(cursor):
+    """
+    v8：合规敏感词库与词库版本号
+    版本号由触发器在增删改时递增，合规扫描器据此判断是否需要重建自动机
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sensitive_words (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            word TEXT NOT NULL UNIQUE,
+            category TEXT NOT NULL DEFAULT '通用',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sensitive_words_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO sensitive_words_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sensitive_words_{event.lower()}
+            AFTER {event} ON sensitive_words
+            BEGIN
+                UPDATE sensitive_words_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO sensitive_words (word, category) VALUES (?, '通用')",
+        [(word,) for word in SENSITIVE_WORDS_SEED]
+    )
+
+
+def _migration_009_credit_ledger(cursor):
+    """
+    v9：积分流水账（只追加）与余额快照
+    余额 = 快照余额 + 快照之后的流水合计；user_credits 中的现有余额作为初始快照迁入，此后不再更新
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS credit_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            task_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_ledger_user ON credit_ledger (user_id, id, delta)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS credit_snapshots (
+            user_id TEXT PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO credit_snapshots (user_id, balance, ledger_id)
+        SELECT user_id, credits, 0 FROM user_credits
+    """)
+
+
+def _migration_010_ai_task_user_index(cursor):
+    """v10：ai_tasks 按用户的索引（任务队列按创建时间倒序键集分页，可按状态过滤）"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_user ON ai_tasks (user_id, created_at, task_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_user_status ON ai_tasks (user_id, status, created_at, task_id)")
+
+
+def _migration_011_ai_task_dedup(cursor):
+    """
+    v11：AI 任务结果去重
+    payload_hash 为规范化后的 任务类型 + 数据 的 sha256；命中有效期内已完成的相同任务时新任务只记录 dedup_of 链接，不再处理
+    task_dedup_stats 按本地日期记录命中/未命中次数和节省的积分
+    """
+    _add_column_if_missing(cursor, "ai_tasks", "payload_hash", "TEXT")
+    _add_column_if_missing(cursor, "ai_tasks", "dedup_of", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_payload_hash ON ai_tasks (payload_hash, status, updated_at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_dedup_stats (
+            day TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0,
+            credits_saved INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_012_history_daily_stats_null_margin(cursor):
+    """
+    v12：重建 history 日统计触发器，利润率为空（NULL/NaN）的记录按非高利润计数
+    v4 的触发器直接写入 NEW.margin >= 20.0，利润率为空时结果为 NULL，违反 high_margin_count 的 NOT NULL 约束导致整条插入失败
+    """
+    cursor.execute("DROP TRIGGER IF EXISTS trg_history_daily_stats_insert")
+    cursor.execute("""
+        CREATE TRIGGER trg_history_daily_stats_insert
+        AFTER INSERT ON history
+        BEGIN
+            INSERT INTO history_daily_stats (
+                day, channel_name, record_count, high_margin_count, profit_sum, margin_sum
+            ) VALUES (
+                date(NEW.created_at, 'localtime'), COALESCE(NEW.channel_name, ''), 1,
+                COALESCE(NEW.margin >= 20.0, 0), COALESCE(NEW.profit, 0), COALESCE(NEW.margin, 0)
+            )
+            ON CONFLICT(day, channel_name) DO UPDATE SET
+                record_count = record_count + 1,
+                high_margin_count = high_margin_count + excluded.high_margin_count,
+                profit_sum = profit_sum + excluded.profit_sum,
+                margin_sum = margin_sum + excluded.margin_sum;
+        END
+    """)
+
+
+
+def _migration_013_ai_task_dedup_links(cursor):
+    """
+    v13：同批复用任务的链接索引，并修正链接到未完成任务却已标记为 completed 的复用任务
+    同批复用任务以 pending 状态等待原任务结束，原任务结束时按 dedup_of 查找并同步状态
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_tasks_dedup_of ON ai_tasks (dedup_of) WHERE dedup_of IS NOT NULL")
+    cursor.execute("""
+        UPDATE ai_tasks AS t
+        SET status = CASE WHEN src.status = 'processing' THEN 'pending' ELSE src.status END,
+            result = CASE WHEN src.status = 'failed_compliance' THEN '触发风控，与原任务 ' || src.task_id || ' 一并拦截，未扣积分' END,
+            last_error = CASE WHEN src.status = 'dead_letter' THEN '原任务 ' || src.task_id || ' 多次失败: ' || COALESCE(src.last_error, '') END,
+            updated_at = CURRENT_TIMESTAMP
+        FROM ai_tasks AS src
+        WHERE src.task_id = t.dedup_of AND t.status = 'completed' AND src.status != 'completed'
+    """)
+
+
+# 数据库迁移列表：(版本号, 说明, 迁移函数)，版本号必须连续递增，已发布的迁移不可修改
+MIGRATIONS = [
+    (1, "基础表结构与默认数据", _migration_001_base_schema),
+    (2, "AI 任务社区表", _migration_002_ai_task_tables),
+    (3, "history 索引", _migration_003_history_indexes),
+    (4, "history 日统计表", _migration_004_history_daily_stats),
+    (5, "ai_tasks 队列索引", _migration_005_ai_task_queue_index),
+    (6, "ai_tasks 租约字段", _migration_006_ai_task_leases),
+    (7, "ai_tasks 重试与死信", _migration_007_ai_task_retries),
+    (8, "合规敏感词库", _migration_008_sensitive_words),
+    (9, "积分流水账与余额快照", _migration_009_credit_ledger),
+    (10, "ai_tasks 用户索引", _migration_010_ai_task_user_index),
+    (11, "AI 任务结果去重", _migration_011_ai_task_dedup),
+    (12, "history 日统计触发器兼容空利润率", _migration_012_history_daily_stats_null_margin),
+    (13, "ai_tasks 同批复用任务链接", _migration_013_ai_task_dedup_links),
+]
+LATEST_DB_VERSION = MIGRATIONS[-1][0]
+
+# 最近一次 init_database 的耗时统计
+_db_startup_stats = {}
+
+
+def _read_db_version(cursor):
+    """读取 db_meta 中的数据库版本（库为空时返回 0）"""
+    try:
+        cursor.execute("SELECT version FROM db_meta WHERE id = 1")
+    except sqlite3.OperationalError:
+        # db_meta 表不存在：全新数据库
+        return 0
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _apply_migration(version, description, migrate):
+    """在独立的写事务中应用一个迁移（事务内复查版本，避免多进程重复执行）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS db_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 1,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        if _read_db_version(cursor) >= version:
+            return False
+        
+        migrate(cursor)
+        cursor.execute("""
+            INSERT INTO db_meta (id, version) VALUES (1, ?)
+            ON CONFLICT(id) DO UPDATE SET version=excluded.version, updated_at=CURRENT_TIMESTAMP
+        """, (version,))
+        return True
+
+
+def get_db_startup_stats():
+    """
+    获取最近一次数据库初始化的耗时统计
+    
+    返回:
+        dict: {
+            'version': 当前数据库版本,
+            'applied': 本次应用的迁移版本列表,
+            'fast_path': 是否走快速路径（版本读取成功且已是最新，未执行任何迁移）,
+            'error': 初始化出错时的错误信息，否则为 None,
+            'elapsed_ms': 耗时（毫秒）
+        }
+    """
+    return dict(_db_startup_stats)
 
 
 def init_database():
     """
-    初始化数据库表结构（防崩兜底版）
-    首次运行时自动创建数据库和默认配置，绝不抛出异常
+    初始化数据库（版本化迁移，防崩兜底版）
+    快速路径只读取一次 db_meta.version；版本落后时按序应用编号迁移，绝不抛出异常
     """
+    start_time = time.perf_counter()
+    current_version = 0
+    applied = []
+    fast_path = False
+    error = None
+    
     try:
         with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # 创建 db_meta 表（数据库版本管理）
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS db_meta (
-                    id INTEGER PRIMARY KEY CHECK (id = 1),
-                    version INTEGER NOT NULL DEFAULT 1,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # 检查并初始化数据库版本
-            cursor.execute("SELECT version FROM db_meta WHERE id = 1")
-            row = cursor.fetchone()
-            
-            if row is None:
-                # 首次创建，插入版本 1
-                cursor.execute("INSERT INTO db_meta (id, version) VALUES (1, 1)")
-                current_version = 1
-            else:
-                current_version = row[0]
-            
-            # 创建 config 表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS config (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
-            """)
-            
-            # 创建 logistics_tiers 表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS logistics_tiers (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    max_weight REAL DEFAULT 0,
-                    max_price REAL DEFAULT 0,
-                    fixed_fee REAL DEFAULT 0,
-                    per_gram_fee REAL DEFAULT 0,
-                    priority INTEGER DEFAULT 0
-                )
-            """)
-            
-            # 创建 history 表（测款历史记录）
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    product_name TEXT,
-                    cost REAL,
-                    weight REAL,
-                    charge_weight REAL,
-                    channel_name TEXT,
-                    shipping_fee REAL,
-                    final_price REAL,
-                    profit REAL,
-                    margin REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # 【关键】初始化默认配置（使用 INSERT OR IGNORE 防止重复插入）
-            default_configs = [
-                ('commission_rate', '15.0'),
-                ('exchange_rate', '13.5'),
-                ('label_fee', '1.5'),
-                ('profit_rate', '1.35')
-            ]
-            
-            for key, value in default_configs:
-                cursor.execute("""
-                    INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)
-                """, (key, value))
-            
-            # 【关键】初始化默认物流档位（仅在表为空时插入）
-            cursor.execute("SELECT COUNT(*) FROM logistics_tiers")
-            count = cursor.fetchone()[0]
-            
-            if count == 0:
-                default_tiers = [
-                    ("轻小件", 500, 135, 2.6, 0.035, 1),
-                    ("标准轻小", 2000, 635, 16.0, 0.033, 2),
-                    ("标准大件", 30000, 635, 36.0, 0.025, 3),
-                    ("中等件/兜底", 0, 0, 23.0, 0.025, 4)
-                ]
-                cursor.executemany("""
-                    INSERT INTO logistics_tiers (name, max_weight, max_price, fixed_fee, per_gram_fee, priority)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, default_tiers)
-            
-            # --- AI 任务社区新增表 ---
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS ai_tasks (
-                    task_id TEXT PRIMARY KEY,
-                    status TEXT DEFAULT 'pending',
-                    user_id TEXT,
-                    payload TEXT,
-                    cost INTEGER,
-                    result TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_credits (
-                    user_id TEXT PRIMARY KEY,
-                    credits INTEGER DEFAULT 10000
-                )
-            """)
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS compliance_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    task_id TEXT,
-                    action TEXT,
-                    detail TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # 初始化测试用户和平台积分账号
-            cursor.execute("INSERT OR IGNORE INTO user_credits (user_id, credits) VALUES ('seller_001', 10000)")
-            cursor.execute("INSERT OR IGNORE INTO user_credits (user_id, credits) VALUES ('platform', 0)")
-            
-            conn.commit()
+            current_version = _read_db_version(conn.cursor())
+        fast_path = current_version >= LATEST_DB_VERSION
+        
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            if _apply_migration(version, description, migrate):
+                applied.append(version)
+                print(f"✅ 数据库迁移 v{version}: {description}")
+            current_version = version
+        
+        if applied:
             print("✅ 数据库初始化成功")
-            
+            # 默认配置、档位和统计表可能刚写入，使对应的进程内缓存失效
+            bump_config_generation()
+            invalidate_logistics_tiers()
+            invalidate_dashboard_stats()
+        
     except Exception as e:
         # 【防崩兜底】即使出错也不影响程序启动，只打印错误日志
         print(f"⚠️ 数据库初始化警告: {e}")
+        fast_path = False
+        error = str(e)
         import traceback
         traceback.print_exc()
+    
+    _db_startup_stats.update({
+        'version': current_version,
+        'applied': applied,
+        'fast_path': fast_path,
+        'error': error,
+        'elapsed_ms': (time.perf_counter() - start_time) * 1000
+    })
+
+
+# 进程级配置快照：一次查询读出整张 config 表，按单调递增的代号失效（写入即失效，不依赖 TTL）
+_config_lock = threading.Lock()
+_config_generation = 0
+_config_snapshot = (-1, MappingProxyType({}))
+
+
+def get_config_generation():
+    """当前配置代号"""
+    return _config_generation
+
+
+def bump_config_generation():
+    """配置已变更：代号 +1，下一次读取时重新加载快照"""
+    global _config_generation
+    with _config_lock:
+        _config_generation += 1
+        return _config_generation
+
+
+def get_config_snapshot():
+    """
+    获取配置快照（只读映射，同一进程内所有会话共享）
+    仅在代号变化后才重新查询数据库
+    """
+    global _config_snapshot
+    generation, snapshot = _config_snapshot
+    if generation == _config_generation:
+        return snapshot
+    
+    # 先记下代号再查询：加载期间若有写入，代号已变，下次读取会再次刷新
+    loading_generation = _config_generation
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT key, value FROM config")
+        snapshot = MappingProxyType({row['key']: row['value'] for row in cursor.fetchall()})
+    
+    with _config_lock:
+        _config_snapshot = (loading_generation, snapshot)
+    return snapshot
 
 
 def load_config(key, default_value=None):
-    """从数据库加载配置"""
+    """从配置快照加载配置"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM config WHERE key=?", (key,))
-            row = cursor.fetchone()
-            if row:
-                return row['value']
-            return default_value
+        return get_config_snapshot().get(key, default_value)
     except Exception as e:
         st.error(f"加载配置失败: {e}")
         return default_value
@@ -198,30 +624,82 @@ def save_config(key, value):
                 INSERT INTO config (key, value) VALUES (?, ?)
                 ON CONFLICT(key) DO UPDATE SET value=excluded.value
             """, (key, str(value)))
-            conn.commit()
-            return True
+        bump_config_generation()
+        return True
     except Exception as e:
         st.error(f"保存配置失败: {e}")
         return False
 
 
+# 默认物流档位（初始化 / 重置为默认 共用）
+DEFAULT_LOGISTICS_TIERS = [
+    {"name": "轻小件", "max_weight": 500, "max_price": 135,
+     "fixed_fee": 2.6, "per_gram_fee": 0.035, "priority": 1},
+    {"name": "标准轻小", "max_weight": 2000, "max_price": 635,
+     "fixed_fee": 16.0, "per_gram_fee": 0.033, "priority": 2},
+    {"name": "标准大件", "max_weight": 30000, "max_price": 635,
+     "fixed_fee": 36.0, "per_gram_fee": 0.025, "priority": 3},
+    {"name": "中等件/兜底", "max_weight": 0, "max_price": 0,
+     "fixed_fee": 23.0, "per_gram_fee": 0.025, "priority": 4}
+]
+
+# 进程级物流档位缓存：(代号, 档位行, 编译后的 TierTable)，所有会话共享，写入时显式失效
+_tiers_lock = threading.Lock()
+_tiers_generation = 0
+_tiers_cache = (-1, (), None)
+
+
+def invalidate_logistics_tiers():
+    """物流档位已变更：使进程内的档位缓存失效"""
+    global _tiers_generation
+    with _tiers_lock:
+        _tiers_generation += 1
+
+
+def _load_logistics_tiers():
+    """读取（必要时重新加载）档位缓存，返回 (档位行, TierTable)"""
+    global _tiers_cache
+    generation, rows, table = _tiers_cache
+    if generation == _tiers_generation:
+        return rows, table
+    
+    # 先记下代号再查询：加载期间若有写入，代号已变，下次读取会再次刷新
+    loading_generation = _tiers_generation
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, name, max_weight, max_price, fixed_fee, per_gram_fee, priority
+            FROM logistics_tiers
+            ORDER BY priority ASC
+        """)
+        rows = tuple(dict(row) for row in cursor.fetchall())
+    table = TierTable(rows)
+    
+    with _tiers_lock:
+        _tiers_cache = (loading_generation, rows, table)
+    return rows, table
+
+
 def get_logistics_tiers():
-    """获取所有物流档位"""
+    """获取所有物流档位（返回副本，调用方可自由修改）"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, name, max_weight, max_price, fixed_fee, per_gram_fee, priority
-                FROM logistics_tiers
-                ORDER BY priority ASC
-            """)
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+        rows, _ = _load_logistics_tiers()
+        return [dict(row) for row in rows]
     except Exception as e:
         st.error(f"加载物流档位失败: {e}")
         return []
 
 
+def get_tier_table():
+    """获取编译后的物流档位表（进程内共享，只读）"""
+    try:
+        _, table = _load_logistics_tiers()
+        return table
+    except Exception as e:
+        st.error(f"加载物流档位失败: {e}")
+        return TierTable([])
+
+
 def save_logistics_tiers(tiers_data):
     """保存物流档位数据"""
     try:
@@ -242,13 +720,145 @@ def save_logistics_tiers(tiers_data):
                     tier.get('per_gram_fee', 0),
                     tier.get('priority', 0)
                 ))
-            conn.commit()
-            return True
+        invalidate_logistics_tiers()
+        return True
     except Exception as e:
         st.error(f"保存物流档位失败: {e}")
         return False
 
 
+def reset_logistics_tiers():
+    """重置为默认物流档位"""
+    return save_logistics_tiers(DEFAULT_LOGISTICS_TIERS)
+
+
+class LogisticsTier:
+    """编译后的单个物流档位（__slots__ 记录，避免重复的字典查找）"""
+    __slots__ = ('index', 'name', 'max_weight', 'max_price', 'fixed_fee', 'per_gram_fee', 'priority', 'row')
+    
+    def __init__(self, index, row):
+        self.index = index
+        self.name = row['name']
+        self.max_weight = row['max_weight']
+        self.max_price = row['max_price']
+        self.fixed_fee = row['fixed_fee']
+        self.per_gram_fee = row['per_gram_fee']
+        self.priority = row.get('priority', 0)
+        # 保留原始字典（缓存共享，只读）；匹配结果通过 as_dict() 返回副本以兼容页面和 session_state
+        self.row = row
+    
+    def as_dict(self):
+        """档位字典副本（调用方修改不会影响共享的档位缓存）"""
+        return dict(self.row)
+
+
+class TierTable:
+    """
+    编译后的物流档位表（由 logistics_tiers 行一次性构建）
+    
+    max_weight / max_price 的非零取值排序后形成断点数组，断点把 (重量, 价格) 平面
+    切成若干格子，同一格子内各档位的重量/价格条件结果完全相同。构建时为每个格子
+    预先算好按优先级排列的候选档位，查询时只需两次 bisect 即可定位。
+    """
+    __slots__ = (
+        'rows', 'tiers', 'names', 'fixed_fees', 'per_gram_fees', 'max_weights', 'max_prices',
+        'weight_breakpoints', 'price_breakpoints', '_weight_ok', '_weight_candidates', '_cell_candidates'
+    )
+    
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.tiers = tuple(LogisticsTier(i, row) for i, row in enumerate(self.rows))
+        
+        # 预计算的费用系数（按优先级顺序）
+        self.names = tuple(tier.name for tier in self.tiers)
+        self.fixed_fees = tuple(tier.fixed_fee for tier in self.tiers)
+        self.per_gram_fees = tuple(tier.per_gram_fee for tier in self.tiers)
+        self.max_weights = tuple(tier.max_weight for tier in self.tiers)
+        self.max_prices = tuple(tier.max_price for tier in self.tiers)
+        
+        # 断点数组：格子 j 覆盖 (breakpoints[j-1], breakpoints[j]]，最后一个格子为超出所有断点
+        self.weight_breakpoints = sorted({w for w in self.max_weights if w != 0})
+        self.price_breakpoints = sorted({p for p in self.max_prices if p != 0})
+        
+        weight_ok = [self._cell_mask(self.max_weights, self.weight_breakpoints, j)
+                     for j in range(len(self.weight_breakpoints) + 1)]
+        self._weight_ok = weight_ok
+        price_ok = [self._cell_mask(self.max_prices, self.price_breakpoints, j)
+                    for j in range(len(self.price_breakpoints) + 1)]
+        
+        # 仅按重量过滤的候选档位；遇到不限价档位即截断（它一定满足价格条件）
+        self._weight_candidates = []
+        for mask in weight_ok:
+            candidates = []
+            for tier in self.tiers:
+                if mask[tier.index]:
+                    candidates.append(tier)
+                    if tier.max_price == 0:
+                        break
+            self._weight_candidates.append(tuple(candidates))
+        
+        # 按 (重量格子, 价格格子) 过滤的候选档位
+        self._cell_candidates = [
+            [tuple(tier for tier in self.tiers if w_mask[tier.index] and p_mask[tier.index])
+             for p_mask in price_ok]
+            for w_mask in weight_ok
+        ]
+    
+    @staticmethod
+    def _cell_mask(limits, breakpoints, cell):
+        """某个格子内各档位是否满足 (limit == 0 或 value <= limit)"""
+        if cell == len(breakpoints):
+            return tuple(limit == 0 for limit in limits)
+        upper = breakpoints[cell]
+        return tuple(limit == 0 or upper <= limit for limit in limits)
+    
+    def __len__(self):
+        return len(self.tiers)
+    
+    def __bool__(self):
+        return bool(self.tiers)
+    
+    @property
+    def last(self):
+        """兜底档位（优先级最低的最后一个档位）"""
+        return self.tiers[-1]
+    
+    def weight_candidates(self, weight_g):
+        """满足重量条件的候选档位（按优先级）"""
+        return self._weight_candidates[bisect_left(self.weight_breakpoints, weight_g)]
+    
+    def cell_candidates(self, weight_g, price_cny):
+        """同时满足重量和价格条件的候选档位（按优先级）"""
+        w_cell = bisect_left(self.weight_breakpoints, weight_g)
+        p_cell = bisect_left(self.price_breakpoints, price_cny)
+        return self._cell_candidates[w_cell][p_cell]
+    
+    def weight_cells(self, weights):
+        """向量化的重量格子定位（np.searchsorted 等价于逐个 bisect_left）"""
+        return np.searchsorted(np.asarray(self.weight_breakpoints, dtype=float), weights, side='left')
+    
+    def weight_ok_matrix(self):
+        """形状 (重量格子数, 档位数) 的重量条件布尔矩阵"""
+        return np.array(self._weight_ok, dtype=bool).reshape(len(self._weight_ok), len(self.tiers))
+
+
+def compile_logistics_tiers(tiers=None):
+    """
+    获取编译后的物流档位表
+    
+    参数:
+        tiers: None（从数据库读取）、物流档位字典列表或已编译的 TierTable
+    
+    返回:
+        TierTable: 编译后的档位表
+    """
+    if isinstance(tiers, TierTable):
+        return tiers
+    if tiers is None:
+        return get_tier_table()
+    return TierTable(tiers)
+
+
 def smart_match_logistics(weight_g, cost_cny, profit_rate, commission_rate, label_fee, tiers=None):
     """
     智能物流匹配算法 - 解决抛货漏算和死循环问题
@@ -259,7 +869,7 @@ def smart_match_logistics(weight_g, cost_cny, profit_rate, commission_rate, labe
         profit_rate: 利润率系数
         commission_rate: 平台佣金率（百分比）
         label_fee: 贴单费
-        tiers: 物流档位列表
+        tiers: 物流档位列表或编译后的 TierTable
     
     返回:
         dict: {
@@ -269,10 +879,9 @@ def smart_match_logistics(weight_g, cost_cny, profit_rate, commission_rate, labe
             'matched': 是否成功匹配
         }
     """
-    if tiers is None:
-        tiers = get_logistics_tiers()
+    table = compile_logistics_tiers(tiers)
     
-    if not tiers:
+    if not table:
         return {
             'tier': None,
             'shipping_fee': 0,
@@ -280,86 +889,416 @@ def smart_match_logistics(weight_g, cost_cny, profit_rate, commission_rate, labe
             'matched': False
         }
     
-    # 按优先级遍历档位
-    for tier in tiers:
-        # 计算该档位下的试算运费
-        trial_shipping = tier['fixed_fee'] + label_fee + (weight_g * tier['per_gram_fee'])
-        
-        # 计算该档位下的试算售价
-        commission_factor = 1 - (commission_rate / 100)
-        product_base = cost_cny * profit_rate
+    commission_factor = 1 - (commission_rate / 100)
+    product_base = cost_cny * profit_rate
+    
+    # 按优先级遍历满足重量条件的候选档位（已通过 bisect 定位）
+    for tier in table.weight_candidates(weight_g):
+        # 计算该档位下的试算运费与售价
+        trial_shipping = tier.fixed_fee + label_fee + (weight_g * tier.per_gram_fee)
         trial_price = (product_base + trial_shipping) / commission_factor
         
-        # 判断是否满足该档位条件
-        weight_ok = (tier['max_weight'] == 0) or (weight_g <= tier['max_weight'])
-        price_ok = (tier['max_price'] == 0) or (trial_price <= tier['max_price'])
-        
-        if weight_ok and price_ok:
+        # 试算售价依赖档位自身费用，价格条件需逐个候选判断
+        if (tier.max_price == 0) or (trial_price <= tier.max_price):
             return {
-                'tier': tier,
+                'tier': tier.as_dict(),
                 'shipping_fee': trial_shipping,
                 'final_price': trial_price,
                 'matched': True
             }
     
     # 兜底：使用最后一个档位
-    last_tier = tiers[-1]
-    fallback_shipping = last_tier['fixed_fee'] + label_fee + (weight_g * last_tier['per_gram_fee'])
-    commission_factor = 1 - (commission_rate / 100)
-    product_base = cost_cny * profit_rate
+    last_tier = table.last
+    fallback_shipping = last_tier.fixed_fee + label_fee + (weight_g * last_tier.per_gram_fee)
     fallback_price = (product_base + fallback_shipping) / commission_factor
     
     return {
-        'tier': last_tier,
+        'tier': last_tier.as_dict(),
         'shipping_fee': fallback_shipping,
         'final_price': fallback_price,
         'matched': True
     }
 
 
-def match_logistics_channel(weight_g, price_cny, tiers=None):
+def smart_match_logistics_arrays(weights, costs, profit_rate, commission_rate, label_fee, tiers=None):
     """
-    匹配物流渠道（保留旧接口兼容性）
-    按 priority 遍历，找到第一个满足条件的档位
-    条件：(weight <= max_weight OR max_weight=0) AND (price <= max_price OR max_price=0)
+    smart_match_logistics 的数组版本（批量定价、敏感度网格共用的向量化内核）
+    
+    参数:
+        weights: 计费重量数组（克）
+        costs: 商品成本数组（人民币），与 weights 等长
+        profit_rate / commission_rate / label_fee: 同 smart_match_logistics
+        tiers: 物流档位列表或编译后的 TierTable
+    
+    返回:
+        dict: 各项均为与输入等长的 ndarray:
+            tier_index, is_fallback, shipping_fee, final_price, commission_fee, profit, margin
     """
-    if tiers is None:
-        tiers = get_logistics_tiers()
+    table = compile_logistics_tiers(tiers)
     
-    if not tiers:
-        return None
+    if not table:
+        raise ValueError("未找到物流档位配置")
     
-    for tier in tiers:
-        weight_ok = (tier['max_weight'] == 0) or (weight_g <= tier['max_weight'])
-        price_ok = (tier['max_price'] == 0) or (price_cny <= tier['max_price'])
-        
-        if weight_ok and price_ok:
-            return tier
+    costs = np.asarray(costs, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    row_index = np.arange(len(costs))
     
-    # 兜底：返回最后一个档位
-    return tiers[-1]
-
-
-def calculate_shipping_fee(weight_g, tier, label_fee=0):
-    """计算运费"""
-    if tier is None:
-        return 0
-    return tier['fixed_fee'] + label_fee + (weight_g * tier['per_gram_fee'])
-
-
-def calculate_final_price(cost_cny, shipping_cny, profit_rate, commission_rate):
-    """
-    计算最终售价
-    commission_rate: 平台佣金率（百分比，如15表示15%）
-    """
+    # 档位参数展开为数组，形状 (k,)
+    fixed_fee = np.array(table.fixed_fees, dtype=float)
+    per_gram_fee = np.array(table.per_gram_fees, dtype=float)
+    max_price = np.array(table.max_prices, dtype=float)
+    
+    # 试算运费与售价，形状 (n, k)，运算顺序与标量版本保持一致以保证结果逐位相同
     commission_factor = 1 - (commission_rate / 100)
-    product_base = cost_cny * profit_rate
-    return (product_base + shipping_cny) / commission_factor
+    product_base = costs * profit_rate
+    trial_shipping = fixed_fee + label_fee + (weights[:, None] * per_gram_fee)
+    trial_price = (product_base[:, None] + trial_shipping) / commission_factor
+    
+    # 重量条件按断点格子查表，等价于逐行 bisect
+    weight_ok = table.weight_ok_matrix()[table.weight_cells(weights)]
+    price_ok = (max_price == 0) | (trial_price <= max_price)
+    fits = weight_ok & price_ok
+    
+    # 每行第一个满足条件的档位；全部不满足时兜底使用最后一个档位
+    has_fit = fits.any(axis=1)
+    tier_index = np.where(has_fit, fits.argmax(axis=1), len(table) - 1)
+    
+    shipping_fee = trial_shipping[row_index, tier_index]
+    final_price = trial_price[row_index, tier_index]
+    commission_fee = final_price * (commission_rate / 100)
+    profit = final_price - costs - shipping_fee - commission_fee
+    margin = np.divide(profit, final_price, out=np.zeros_like(profit), where=final_price > 0) * 100
+    
+    return {
+        'tier_index': tier_index,
+        'is_fallback': ~has_fit,
+        'shipping_fee': shipping_fee,
+        'final_price': final_price,
+        'commission_fee': commission_fee,
+        'profit': profit,
+        'margin': margin
+    }
 
 
-def calculate_volume_weight(length_cm, width_cm, height_cm):
+def price_batch(df, profit_rate, commission_rate, label_fee, exchange_rate, tiers=None,
+                cost_col='cost', weight_col='charge_weight'):
     """
-    计算体积重
+    批量定价 - smart_match_logistics 的向量化版本
+    一次性对 (SKU × 档位) 矩阵求值，结果与逐个调用 smart_match_logistics 完全一致
+    （按优先级首个满足条件的档位，全部不满足时兜底使用最后一个档位）
+    
+    参数:
+        df: 商品数据 DataFrame，至少包含成本列和计费重量列
+        profit_rate: 利润率系数
+        commission_rate: 平台佣金率（百分比）
+        label_fee: 贴单费
+        exchange_rate: 汇率（CNY→RUB）
+        tiers: 物流档位列表或编译后的 TierTable
+        cost_col: 成本列名（人民币）
+        weight_col: 计费重量列名（克）
+    
+    返回:
+        DataFrame: 原数据副本，追加以下列:
+            tier_index, channel_name, is_fallback, shipping_fee, final_price,
+            final_price_rub, commission_fee, profit, margin
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    result = df.copy()
+    
+    arrays = smart_match_logistics_arrays(
+        result[weight_col].to_numpy(dtype=float),
+        result[cost_col].to_numpy(dtype=float),
+        profit_rate, commission_rate, label_fee, table
+    )
+    
+    result['tier_index'] = arrays['tier_index']
+    result['channel_name'] = np.array(table.names, dtype=object)[arrays['tier_index']]
+    result['is_fallback'] = arrays['is_fallback']
+    result['shipping_fee'] = arrays['shipping_fee']
+    result['final_price'] = arrays['final_price']
+    result['final_price_rub'] = arrays['final_price'] * exchange_rate
+    result['commission_fee'] = arrays['commission_fee']
+    result['profit'] = arrays['profit']
+    result['margin'] = arrays['margin']
+    
+    return result
+
+
+def margin_sensitivity_grid(cost_values, weight_values, profit_rate, commission_rate, label_fee, tiers=None):
+    """
+    成本 × 重量 利润敏感度网格
+    把整个网格展平后一次性交给向量化内核计算，200 × 300 的网格也只需数十毫秒
+    
+    参数:
+        cost_values: 成本取值（一维，人民币）
+        weight_values: 计费重量取值（一维，克）
+        profit_rate / commission_rate / label_fee: 同 smart_match_logistics
+        tiers: 物流档位列表或编译后的 TierTable
+    
+    返回:
+        dict: {
+            'costs': 成本轴,
+            'weights': 重量轴,
+            'tier_names': 档位名称,
+            'tier_index' / 'final_price' / 'profit' / 'margin': 形状 (成本点数, 重量点数) 的矩阵
+        }
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    costs = np.asarray(cost_values, dtype=float)
+    weights = np.asarray(weight_values, dtype=float)
+    cost_grid, weight_grid = np.meshgrid(costs, weights, indexing='ij')
+    
+    arrays = smart_match_logistics_arrays(
+        weight_grid.ravel(), cost_grid.ravel(), profit_rate, commission_rate, label_fee, table
+    )
+    shape = cost_grid.shape
+    
+    return {
+        'costs': costs,
+        'weights': weights,
+        'tier_names': table.names,
+        'tier_index': arrays['tier_index'].reshape(shape),
+        'final_price': arrays['final_price'].reshape(shape),
+        'profit': arrays['profit'].reshape(shape),
+        'margin': arrays['margin'].reshape(shape)
+    }
+
+
+def render_margin_heatmap(grid, width=900, height=540):
+    """
+    将利润敏感度网格渲染为热力图 PNG（叠加物流档位分界线）
+    
+    参数:
+        grid: margin_sensitivity_grid 的返回值
+        width / height: 热力图绘图区尺寸（像素）
+    
+    返回:
+        io.BytesIO: PNG 图像的字节流对象
+    """
+    from PIL import Image, ImageDraw, ImageFont
+    
+    try:
+        font = ImageFont.truetype("msyh.ttc", 16)
+    except IOError:
+        try:
+            font = ImageFont.truetype("simhei.ttf", 16)
+        except IOError:
+            font = ImageFont.load_default()
+    
+    costs, weights = grid['costs'], grid['weights']
+    margin, tier_index = grid['margin'], grid['tier_index']
+    n_cost, n_weight = margin.shape
+    
+    # 像素 → 网格下标（最近邻放大）；成本轴自下而上递增
+    row_idx = ((np.arange(height) * n_cost) // height)[::-1]
+    col_idx = (np.arange(width) * n_weight) // width
+    margin_px = margin[row_idx][:, col_idx]
+    tier_px = tier_index[row_idx][:, col_idx]
+    
+    # 与利润红绿灯一致的配色：红(亏损) → 橙(10%) → 绿(≥20%)
+    anchors = [-20, 0, 10, 20, 40]
+    palette = np.array([
+        [0x7F, 0x00, 0x00],
+        [0xC6, 0x28, 0x28],
+        [0xFF, 0x98, 0x00],
+        [0x2E, 0x7D, 0x32],
+        [0x1B, 0x5E, 0x20]
+    ], dtype=float)
+    rgb = np.stack([np.interp(margin_px, anchors, palette[:, c]) for c in range(3)], axis=-1)
+    
+    # 档位分界线：相邻像素档位不同即为边界
+    boundary = np.zeros(tier_px.shape, dtype=bool)
+    boundary[:, 1:] |= tier_px[:, 1:] != tier_px[:, :-1]
+    boundary[1:, :] |= tier_px[1:, :] != tier_px[:-1, :]
+    rgb[boundary] = [255, 255, 255]
+    
+    heatmap = Image.fromarray(rgb.astype(np.uint8), 'RGB')
+    
+    # 画布：左侧成本轴、底部重量轴、右侧图例
+    left, top, bottom, right = 90, 20, 60, 120
+    img = Image.new('RGB', (left + width + right, top + height + bottom), color='#FFFFFF')
+    img.paste(heatmap, (left, top))
+    draw = ImageDraw.Draw(img)
+    
+    for i in range(5):
+        frac = i / 4
+        cost_label = costs[0] + (costs[-1] - costs[0]) * frac
+        y = top + height - int(frac * (height - 1))
+        draw.line([(left - 5, y), (left, y)], fill='#333333')
+        draw.text((5, y - 8), f"¥{cost_label:.0f}", fill='#333333', font=font)
+        
+        weight_label = weights[0] + (weights[-1] - weights[0]) * frac
+        x = left + int(frac * (width - 1))
+        draw.line([(x, top + height), (x, top + height + 5)], fill='#333333')
+        draw.text((x - 20, top + height + 10), f"{weight_label:.0f}g", fill='#333333', font=font)
+    
+    draw.text((left + width // 2 - 40, top + height + 35), "计费重量 (g)", fill='#333333', font=font)
+    
+    # 图例
+    legend_x = left + width + 30
+    for i, value in enumerate(range(40, -21, -10)):
+        color = tuple(int(np.interp(value, anchors, palette[:, c])) for c in range(3))
+        y = top + i * 30
+        draw.rectangle([legend_x, y, legend_x + 20, y + 20], fill=color)
+        draw.text((legend_x + 28, y + 2), f"{value}%", fill='#333333', font=font)
+    draw.rectangle([legend_x, top + 230, legend_x + 20, top + 250], fill='#FFFFFF', outline='#999999')
+    draw.text((legend_x + 28, top + 232), "档位分界", fill='#333333', font=font)
+    
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    output.seek(0)
+    
+    return output
+
+
+def promo_price_surface(cost_cny, shipping_fee, commission_rate, exchange_rate, discount_pcts, min_margins):
+    """
+    活动定价曲面：一次性计算 (折扣 × 保底利润率) 全部组合下的建议原价与活动利润
+    公式与「活动模拟」单点计算完全一致；cost_cny / shipping_fee 可为标量或一维数组（多 SKU）
+    
+    参数:
+        cost_cny: 商品成本（人民币），标量或形状 (n,) 的数组
+        shipping_fee: 运费（人民币），与 cost_cny 形状一致
+        commission_rate: 佣金率（百分比）
+        exchange_rate: 汇率
+        discount_pcts: 活动折扣取值（百分比，一维）
+        min_margins: 保底利润率取值（百分比，一维）
+    
+    返回:
+        dict: 各项为形状 (n, 折扣数, 利润率数) 的矩阵（标量输入时 n=1）:
+            target_price_cny, suggested_original_price_cny, suggested_original_price_rub,
+            discounted_price_cny, discounted_price_rub, commission_fee, net_profit, actual_margin
+    """
+    cost = np.atleast_1d(np.asarray(cost_cny, dtype=float))[:, None, None]
+    shipping = np.atleast_1d(np.asarray(shipping_fee, dtype=float))[:, None, None]
+    discount_factor = 1 - (np.asarray(discount_pcts, dtype=float) / 100)[None, :, None]
+    margin_factor = (np.asarray(min_margins, dtype=float) / 100)[None, None, :]
+    
+    commission_factor = 1 - (commission_rate / 100)
+    
+    # 保底目标售价（打折后的价格）与建议原价
+    target_price_cny = (cost + shipping) / (commission_factor * (1 - margin_factor))
+    suggested_original_price_cny = target_price_cny / discount_factor
+    
+    # 打折后的实际数据
+    discounted_price_cny = suggested_original_price_cny * discount_factor
+    commission_fee = discounted_price_cny * (commission_rate / 100)
+    net_profit = discounted_price_cny - cost - shipping - commission_fee
+    actual_margin = np.divide(
+        net_profit, discounted_price_cny,
+        out=np.zeros_like(net_profit), where=discounted_price_cny > 0
+    ) * 100
+    
+    return {
+        'target_price_cny': target_price_cny,
+        'suggested_original_price_cny': suggested_original_price_cny,
+        'suggested_original_price_rub': suggested_original_price_cny * exchange_rate,
+        'discounted_price_cny': discounted_price_cny,
+        'discounted_price_rub': discounted_price_cny * exchange_rate,
+        'commission_fee': commission_fee,
+        'net_profit': net_profit,
+        'actual_margin': actual_margin
+    }
+
+
+def promo_campaign_plan(df, profit_rate, commission_rate, label_fee, exchange_rate,
+                        discount_pcts, min_margins, tiers=None):
+    """
+    批量活动计划：多个 SKU × 折扣 × 保底利润率 一次性计算，输出一张长表
+    
+    参数:
+        df: 商品数据，至少包含 cost、weight 列；product_name 可选
+        profit_rate / commission_rate / label_fee / exchange_rate: 定价参数
+        discount_pcts: 活动折扣取值（百分比）
+        min_margins: 保底利润率取值（百分比）
+        tiers: 物流档位列表或编译后的 TierTable
+    
+    返回:
+        DataFrame: 每行一个 (SKU, 折扣, 保底利润率) 组合
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    missing = [c for c in ('cost', 'weight') if c not in df.columns]
+    if missing:
+        raise ValueError(f"缺少必要列: {', '.join(missing)}")
+    
+    products = pd.DataFrame({
+        'product_name': df['product_name'].fillna('未命名商品').astype(str) if 'product_name' in df.columns else '未命名商品',
+        'cost': pd.to_numeric(df['cost'], errors='coerce').astype(float),
+        'weight': pd.to_numeric(df['weight'], errors='coerce').astype(float),
+    }).dropna(subset=['cost', 'weight']).reset_index(drop=True)
+    
+    # 运费沿用「活动模拟」的口径：按重量走智能匹配
+    matched = smart_match_logistics_arrays(
+        products['weight'].to_numpy(), products['cost'].to_numpy(),
+        profit_rate, commission_rate, label_fee, table
+    )
+    products['channel_name'] = np.array(table.names, dtype=object)[matched['tier_index']]
+    products['shipping_fee'] = matched['shipping_fee']
+    
+    discounts = np.asarray(discount_pcts, dtype=float)
+    margins = np.asarray(min_margins, dtype=float)
+    surface = promo_price_surface(
+        products['cost'].to_numpy(), products['shipping_fee'].to_numpy(),
+        commission_rate, exchange_rate, discounts, margins
+    )
+    
+    # (n, d, m) 展平为长表：SKU 为最外层
+    n, n_discount, n_margin = len(products), len(discounts), len(margins)
+    sku_index = np.repeat(np.arange(n), n_discount * n_margin)
+    
+    plan = products.iloc[sku_index].reset_index(drop=True)
+    plan['discount_pct'] = np.tile(np.repeat(discounts, n_margin), n)
+    plan['min_margin'] = np.tile(margins, n * n_discount)
+    for key in ('suggested_original_price_cny', 'suggested_original_price_rub',
+                'discounted_price_cny', 'discounted_price_rub', 'net_profit', 'actual_margin'):
+        plan[key] = surface[key].ravel()
+    
+    return plan
+
+
+def match_logistics_channel(weight_g, price_cny, tiers=None):
+    """
+    匹配物流渠道（保留旧接口兼容性）
+    按 priority 遍历，找到第一个满足条件的档位
+    条件：(weight <= max_weight OR max_weight=0) AND (price <= max_price OR max_price=0)
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    if not table:
+        return None
+    
+    # 两次 bisect 定位格子，格子内第一个候选即为匹配结果
+    candidates = table.cell_candidates(weight_g, price_cny)
+    if candidates:
+        return candidates[0].as_dict()
+    
+    # 兜底：返回最后一个档位
+    return table.last.as_dict()
+
+
+def calculate_shipping_fee(weight_g, tier, label_fee=0):
+    """计算运费"""
+    if tier is None:
+        return 0
+    return tier['fixed_fee'] + label_fee + (weight_g * tier['per_gram_fee'])
+
+
+def calculate_final_price(cost_cny, shipping_cny, profit_rate, commission_rate):
+    """
+    计算最终售价
+    commission_rate: 平台佣金率（百分比，如15表示15%）
+    """
+    commission_factor = 1 - (commission_rate / 100)
+    product_base = cost_cny * profit_rate
+    return (product_base + shipping_cny) / commission_factor
+
+
+def calculate_volume_weight(length_cm, width_cm, height_cm):
+    """
+    计算体积重
     公式: (长 × 宽 × 高) / 6000
     """
     if length_cm <= 0 or width_cm <= 0 or height_cm <= 0:
@@ -379,35 +1318,72 @@ def get_charge_weight(actual_weight_g, length_cm, width_cm, height_cm):
     return charge_weight, volume_weight, is_bulky
 
 
-@st.cache_data(ttl=30)
+def get_charge_weight_batch(actual_weight_g, length_cm, width_cm, height_cm):
+    """
+    批量获取计费重量（get_charge_weight 的向量化版本）
+    任一边长 <= 0 时体积重为 0，与 calculate_volume_weight 一致
+    
+    返回: (计费重数组, 体积重数组, 是否抛货数组)
+    """
+    actual = np.asarray(actual_weight_g, dtype=float)
+    length = np.asarray(length_cm, dtype=float)
+    width = np.asarray(width_cm, dtype=float)
+    height = np.asarray(height_cm, dtype=float)
+    
+    has_size = (length > 0) & (width > 0) & (height > 0)
+    volume_weight = np.where(has_size, (length * width * height) / 6000, 0.0)
+    charge_weight = np.maximum(actual, volume_weight)
+    is_bulky = volume_weight > actual
+    
+    return charge_weight, volume_weight, is_bulky
+
+
+# 仪表盘统计缓存：写入 history 时代号 +1；跨天时“今日”键变化也会重新读取
+_dashboard_lock = threading.Lock()
+_dashboard_generation = 0
+_dashboard_cache = (None, (0, 0, 0))
+
+
+def invalidate_dashboard_stats():
+    """history 已变更：使仪表盘统计缓存失效"""
+    global _dashboard_generation
+    with _dashboard_lock:
+        _dashboard_generation += 1
+
+
 def get_dashboard_stats():
     """
-    获取仪表盘统计数据（带缓存，30秒刷新）
+    获取仪表盘统计数据（读取 history_daily_stats 汇总表，写入即失效）
     
     返回:
         tuple: (今日测算数, 高利润产品数, 累计潜在利润)
     """
+    global _dashboard_cache
+    cache_key = (_dashboard_generation, time.strftime("%Y-%m-%d"))
+    if _dashboard_cache[0] == cache_key:
+        return _dashboard_cache[1]
+    
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # 今日测算数 (按当地时间计算)
-            cursor.execute("SELECT COUNT(*) FROM history WHERE date(created_at, 'localtime') = date('now', 'localtime')")
-            today_count = cursor.fetchone()[0] or 0
-            
-            # 发现的高利润产品数 (margin >= 20.0)
-            cursor.execute("SELECT COUNT(*) FROM history WHERE margin >= 20.0")
-            high_profit_count = cursor.fetchone()[0] or 0
-            
-            # 累计潜在利润（使用 COALESCE 处理 NULL）
-            cursor.execute("SELECT COALESCE(SUM(profit), 0) FROM history")
-            total_profit = cursor.fetchone()[0] or 0
-            
-            return today_count, high_profit_count, total_profit
+            # 汇总表按（本地日期, 渠道）一行，扫描量与天数成正比
+            cursor.execute("""
+                SELECT
+                    COALESCE(SUM(CASE WHEN day = date('now', 'localtime') THEN record_count END), 0),
+                    COALESCE(SUM(high_margin_count), 0),
+                    COALESCE(SUM(profit_sum), 0)
+                FROM history_daily_stats
+            """)
+            stats = tuple(cursor.fetchone())
     except Exception as e:
         # 出错时返回默认值，避免侧边栏崩溃
         print(f"⚠️ 获取仪表盘统计失败: {e}")
         return 0, 0, 0
+    
+    with _dashboard_lock:
+        if cache_key[0] == _dashboard_generation:
+            _dashboard_cache = (cache_key, stats)
+    return stats
 
 
 def sidebar_footer():
@@ -504,27 +1480,9 @@ def save_history_record(data_dict):
         }
     """
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO history (
-                    product_name, cost, weight, charge_weight, channel_name,
-                    shipping_fee, final_price, profit, margin
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                data_dict.get('product_name', '未命名商品'),
-                data_dict.get('cost', 0),
-                data_dict.get('weight', 0),
-                data_dict.get('charge_weight', 0),
-                data_dict.get('channel_name', ''),
-                data_dict.get('shipping_fee', 0),
-                data_dict.get('final_price', 0),
-                data_dict.get('profit', 0),
-                data_dict.get('margin', 0)
-            ))
-            conn.commit()
-            print(f"✅ 历史记录保存成功: {data_dict.get('product_name', '未命名商品')}")
-            return True
+        save_history_records([data_dict])
+        print(f"✅ 历史记录保存成功: {data_dict.get('product_name', '未命名商品')}")
+        return True
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
@@ -534,6 +1492,85 @@ def save_history_record(data_dict):
         return False
 
 
+# history 明细列（按插入顺序）及字典记录缺省值
+HISTORY_COLUMNS = (
+    'product_name', 'cost', 'weight', 'charge_weight', 'channel_name',
+    'shipping_fee', 'final_price', 'profit', 'margin'
+)
+HISTORY_DEFAULTS = {
+    'product_name': '未命名商品', 'cost': 0, 'weight': 0, 'charge_weight': 0, 'channel_name': '',
+    'shipping_fee': 0, 'final_price': 0, 'profit': 0, 'margin': 0
+}
+
+
+def _history_row(record):
+    """把字典记录转换成按 HISTORY_COLUMNS 排列的元组；元组/列表原样使用"""
+    if isinstance(record, dict):
+        return tuple(record.get(col, HISTORY_DEFAULTS[col]) for col in HISTORY_COLUMNS)
+    return tuple(record)
+
+
+def save_history_records(records, chunk_size=5000):
+    """
+    批量保存测款历史记录（不依赖 Streamlit，出错直接抛出异常）
+    每 chunk_size 条在一个写事务中 executemany 并提交；中途出错时已提交的分块保留
+    在外层事务中调用时不单独提交，由外层统一提交/回滚
+    
+    参数:
+        records: 可迭代的记录，字典（键同 save_history_record）或按 HISTORY_COLUMNS 排列的元组
+        chunk_size: 每个事务写入的条数
+    
+    返回:
+        list: 按输入顺序排列的新记录 id
+    """
+    ids = []
+    rows = map(_history_row, records)
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 已处于外层事务中：不能再 BEGIN，也不能提前提交
+        own_transaction = not conn.in_transaction
+        
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            
+            if own_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany("""
+                INSERT INTO history (
+                    product_name, cost, weight, charge_weight, channel_name,
+                    shipping_fee, final_price, profit, margin
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, chunk)
+            # 写锁内 AUTOINCREMENT 分配的 id 连续，由最后一条 id 倒推整块 id
+            last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+            ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+            if own_transaction:
+                conn.commit()
+    
+    if ids:
+        invalidate_dashboard_stats()
+    return ids
+
+
+def clear_history():
+    """
+    清空所有测款历史记录（同时清空日统计汇总表）
+    
+    返回:
+        int: 删除的记录数
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM history")
+        deleted = cursor.rowcount
+        cursor.execute("DELETE FROM history_daily_stats")
+    invalidate_dashboard_stats()
+    return deleted
+
+
 def get_history_records(limit=50):
     """
     获取历史记录
@@ -553,7 +1590,7 @@ def get_history_records(limit=50):
                     shipping_fee, final_price, profit, margin,
                     datetime(created_at, 'localtime') as created_at
                 FROM history
-                ORDER BY created_at DESC
+                ORDER BY history.created_at DESC, history.id DESC
                 LIMIT ?
             """, (limit,))
             rows = cursor.fetchall()
@@ -563,66 +1600,1598 @@ def get_history_records(limit=50):
         return []
 
 
-def reverse_calculate_cost(final_price_rub, weight_g, exchange_rate, profit_rate, commission_rate, label_fee, tiers=None):
+# 利润率区间（用于历史记录过滤）：名称 → (下限, 上限)，None 表示不限
+MARGIN_BANDS = {
+    "全部": (None, None),
+    "✅ 优秀 (≥20%)": (20.0, None),
+    "⚠️ 一般 (10%~20%)": (10.0, 20.0),
+    "❌ 偏低 (<10%)": (None, 10.0),
+}
+
+
+def _history_filter_sql(start_date=None, end_date=None, channel=None, min_margin=None, max_margin=None):
     """
-    竞品反推：根据售价反推成本上限
+    构建历史记录过滤条件
+    日期按本地日期传入，转换成 UTC 边界后直接与 created_at 比较，保证可以走索引
+    """
+    clauses = []
+    params = []
+    if start_date:
+        clauses.append("history.created_at >= datetime(?, 'utc')")
+        params.append(f"{start_date} 00:00:00")
+    if end_date:
+        clauses.append("history.created_at < datetime(?, '+1 day', 'utc')")
+        params.append(f"{end_date} 00:00:00")
+    if channel:
+        clauses.append("channel_name = ?")
+        params.append(channel)
+    if min_margin is not None:
+        clauses.append("margin >= ?")
+        params.append(min_margin)
+    if max_margin is not None:
+        clauses.append("margin < ?")
+        params.append(max_margin)
+    return clauses, params
+
+
+def get_history_page(after=None, page_size=50, start_date=None, end_date=None,
+                     channel=None, min_margin=None, max_margin=None, include_archive=False):
+    """
+    键集分页获取历史记录（按 created_at、id 倒序，不使用 OFFSET）
     
     参数:
-        final_price_rub: 竞品售价（卢布）
-        weight_g: 预估重量（克）
-        exchange_rate: 汇率
-        profit_rate: 利润率系数
-        commission_rate: 佣金率
-        label_fee: 贴单费
-        tiers: 物流档位
+        after: 上一页最后一条记录的游标 (created_at, id)，None 表示第一页
+        page_size: 每页条数
+        start_date / end_date: 本地日期范围（'YYYY-MM-DD'，含首尾）
+        channel: 物流渠道名称
+        min_margin / max_margin: 利润率区间 [min, max)
+        include_archive: 是否同时翻阅已归档的月份（与在线记录按同一游标顺序合并）
     
     返回:
-        dict: {
-            'max_cost': 最大成本,
-            'shipping_fee': 运费,
-            'tier': 使用的档位
-        }
+        tuple: (记录列表, 下一页游标)；没有下一页时游标为 None
     """
-    if tiers is None:
-        tiers = get_logistics_tiers()
+    clauses, params = _history_filter_sql(start_date, end_date, channel, min_margin, max_margin)
+    if after is not None:
+        clauses.append("(history.created_at, history.id) < (?, ?)")
+        params.extend(after)
     
-    if not tiers:
-        return {'max_cost': 0, 'shipping_fee': 0, 'tier': None}
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
     
-    # 转换为人民币
-    final_price_cny = final_price_rub / exchange_rate
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT 
+                id, product_name, cost, weight, charge_weight, channel_name,
+                shipping_fee, final_price, profit, margin,
+                created_at AS created_at_utc,
+                datetime(created_at, 'localtime') AS created_at
+            FROM history
+            {where_sql}
+            ORDER BY history.created_at DESC, history.id DESC
+            LIMIT ?
+        """, params + [page_size + 1])
+        rows = [dict(row) for row in cursor.fetchall()]
     
-    # 尝试每个档位，找到最合适的
-    for tier in tiers:
-        # 计算运费
-        shipping_fee = tier['fixed_fee'] + label_fee + (weight_g * tier['per_gram_fee'])
-        
-        # 反推成本：(售价 * (1 - 佣金率) - 运费) / 利润率系数
-        commission_factor = 1 - (commission_rate / 100)
-        max_cost = (final_price_cny * commission_factor - shipping_fee) / profit_rate
-        
-        # 检查是否符合该档位限制
-        weight_ok = (tier['max_weight'] == 0) or (weight_g <= tier['max_weight'])
-        price_ok = (tier['max_price'] == 0) or (final_price_cny <= tier['max_price'])
-        
-        if weight_ok and price_ok and max_cost > 0:
-            return {
-                'max_cost': max_cost,
-                'shipping_fee': shipping_fee,
-                'tier': tier
-            }
+    if include_archive:
+        # 在线记录已取满一页时，只有比这一页最后一条更新的归档记录才可能进入本页
+        floor = (rows[-1]['created_at_utc'], rows[-1]['id']) if len(rows) > page_size else None
+        archived = _archived_history_rows(
+            after, floor, page_size + 1, start_date, end_date, channel, min_margin, max_margin
+        )
+        if archived:
+            # 归档后尚未删除的在线记录（中断的归档）按 (created_at, id) 去重
+            merged = {(row['created_at_utc'], row['id']): row for row in archived}
+            merged.update(((row['created_at_utc'], row['id']), row) for row in rows)
+            rows = sorted(merged.values(), key=lambda r: (r['created_at_utc'], r['id']), reverse=True)
+            rows = rows[:page_size + 1]
     
-    # 兜底：使用最后一个档位
-    last_tier = tiers[-1]
-    shipping_fee = last_tier['fixed_fee'] + label_fee + (weight_g * last_tier['per_gram_fee'])
-    commission_factor = 1 - (commission_rate / 100)
-    max_cost = (final_price_cny * commission_factor - shipping_fee) / profit_rate
+    # 多取一条用于判断是否还有下一页
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1]['created_at_utc'], int(rows[-1]['id']))
     
-    return {
-        'max_cost': max(max_cost, 0),
-        'shipping_fee': shipping_fee,
-        'tier': last_tier
-    }
+    return rows, next_cursor
+
+
+def get_history_channels(include_archive=False):
+    """
+    获取历史记录中出现过的物流渠道
+    使用递归 CTE 在渠道索引上逐个跳跃，耗时与渠道数成正比而不是与记录数成正比
+    include_archive 时合并归档月份摘要中记录的渠道（不解压明细）
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH RECURSIVE channels(name) AS (
+                SELECT MIN(channel_name) FROM history
+                UNION ALL
+                SELECT (SELECT MIN(channel_name) FROM history WHERE channel_name > channels.name)
+                FROM channels
+                WHERE channels.name IS NOT NULL
+            )
+            SELECT name FROM channels WHERE name IS NOT NULL
+        """)
+        channels = [row[0] for row in cursor.fetchall()]
+    
+    if include_archive:
+        archived = set()
+        for info in _archive_month_index():
+            archived.update(info['channels'])
+        channels = sorted(set(channels) | archived)
+    return channels
+
+
+def format_history_frame(records):
+    """
+    把历史记录列表转换成展示用的 DataFrame（整列格式化，不逐行拼字典）
+
+    参数:
+        records: get_history_records / get_history_page 返回的记录列表
+
+    返回:
+        DataFrame: 商品/成本/计费重/渠道/售价/利润/利润率/时间
+    """
+    df = pd.DataFrame.from_records(records)
+    if df.empty:
+        return pd.DataFrame(columns=["商品", "成本", "计费重", "渠道", "售价", "利润", "利润率", "时间"])
+
+    return pd.DataFrame({
+        "商品": df['product_name'],
+        "成本": "¥" + df['cost'].map("{:.2f}".format),
+        "计费重": df['charge_weight'].map("{:.0f}".format) + "g",
+        "渠道": df['channel_name'],
+        "售价": "¥" + df['final_price'].map("{:.2f}".format),
+        "利润": "¥" + df['profit'].map("{:.2f}".format),
+        "利润率": df['margin'].map("{:.1f}".format) + "%",
+        "时间": df['created_at'],
+    })
+
+
+# 导出列：(查询表达式, 表头)；Parquet 使用字段名，CSV/XLSX 使用中文表头
+HISTORY_EXPORT_COLUMNS = (
+    ('id', '记录ID'),
+    ('product_name', '商品名称'),
+    ('cost', '成本(¥)'),
+    ('weight', '实重(g)'),
+    ('charge_weight', '计费重(g)'),
+    ('channel_name', '物流渠道'),
+    ('shipping_fee', '运费(¥)'),
+    ('final_price', '售价(¥)'),
+    ('profit', '利润(¥)'),
+    ('margin', '利润率(%)'),
+    ("datetime(created_at, 'localtime') AS created_at", '时间'),
+)
+HISTORY_EXPORT_FORMATS = ('csv', 'xlsx', 'parquet')
+
+# 单个工作表最多 1048576 行（含表头），超出后自动续写到新工作表
+XLSX_MAX_SHEET_ROWS = 1048575
+
+
+def count_history_records(start_date=None, end_date=None, channel=None, min_margin=None, max_margin=None,
+                          include_archive=False):
+    """
+    统计符合过滤条件的历史记录数（用于导出进度；include_archive 时加上归档月份中符合条件的记录）
+    整月落在日期范围内且没有利润率条件的归档月份直接使用摘要中的记录数，只有部分命中的月份才解压
+    """
+    clauses, params = _history_filter_sql(start_date, end_date, channel, min_margin, max_margin)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM history {where_sql}", params)
+        total = cursor.fetchone()[0]
+    if not include_archive:
+        return total
+    
+    months = _archive_month_index()
+    if not months:
+        return total
+    start_utc, end_utc = _history_utc_bounds(start_date, end_date)
+    filter_args = (start_date, end_date, channel, min_margin, max_margin)
+    for info in months:
+        if (start_utc and info['last_created_at'] < start_utc) or (end_utc and info['first_created_at'] >= end_utc):
+            continue
+        if channel and channel not in info['channels']:
+            continue
+        whole_month = (
+            (not start_utc or info['first_created_at'] >= start_utc)
+            and (not end_utc or info['last_created_at'] < end_utc)
+            and (not channel or info['channels'] == {channel})
+            and min_margin is None and max_margin is None
+        )
+        if whole_month:
+            total += info['row_count']
+        else:
+            df = _load_archive_month(info['month'], info['archived_at'])
+            total += int(_archive_filter_mask(df, start_utc, end_utc, channel, min_margin, max_margin).sum())
+    # 中断的归档 / 从旧备份恢复后，两边都有的记录只计一次
+    return total - len(_archived_live_ids(months, *filter_args))
+
+
+def _write_history_csv(cursor, output_path, chunk_size, on_chunk):
+    """逐块写出 CSV"""
+    with open(output_path, 'w', encoding='utf-8-sig', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow([header for _, header in HISTORY_EXPORT_COLUMNS])
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            on_chunk(len(rows))
+
+
+def _write_history_xlsx(cursor, output_path, chunk_size, on_chunk):
+    """逐块写出 XLSX（openpyxl 只写模式，行写入后即落盘）"""
+    from openpyxl import Workbook
+    
+    headers = [header for _, header in HISTORY_EXPORT_COLUMNS]
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_SHEET_ROWS
+    
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            if sheet_rows >= XLSX_MAX_SHEET_ROWS:
+                sheet = workbook.create_sheet(f"历史记录{len(workbook.worksheets) + 1}")
+                sheet.append(headers)
+                sheet_rows = 0
+            sheet.append(tuple(row))
+            sheet_rows += 1
+        on_chunk(len(rows))
+    
+    if sheet is None:
+        workbook.create_sheet("历史记录1").append(headers)
+    workbook.save(output_path)
+
+
+def _write_history_parquet(cursor, output_path, chunk_size, on_chunk):
+    """逐块写出 Parquet（每块一个 row group）"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("缺少依赖库：导出 Parquet 需要先安装 pyarrow 库（pip install pyarrow）")
+    
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('product_name', pa.string()),
+        ('cost', pa.float64()),
+        ('weight', pa.float64()),
+        ('charge_weight', pa.float64()),
+        ('channel_name', pa.string()),
+        ('shipping_fee', pa.float64()),
+        ('final_price', pa.float64()),
+        ('profit', pa.float64()),
+        ('margin', pa.float64()),
+        ('created_at', pa.string()),
+    ])
+    
+    with pq.ParquetWriter(output_path, schema) as writer:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                schema=schema
+            ))
+            on_chunk(len(rows))
+
+
+class _HistoryRowStream:
+    """把行迭代器包装成游标的 fetchmany 接口，供导出写入器按块读取"""
+    
+    def __init__(self, rows):
+        self._rows = iter(rows)
+    
+    def fetchmany(self, size):
+        return list(islice(self._rows, size))
+
+
+def _archived_live_ids(months, start_date=None, end_date=None, channel=None, min_margin=None, max_margin=None):
+    """
+    同时存在于在线库和归档库的记录（中断的归档、从不带归档的旧备份恢复后），返回这些在线记录的 id
+    只检查时间落在某个归档月份 [first_created_at, last_created_at] 之内的在线记录，通常为空，不必解压任何月份
+    """
+    clauses, params = _history_filter_sql(start_date, end_date, channel, min_margin, max_margin)
+    overlap = set()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for info in months:
+            cursor.execute(f"""
+                SELECT created_at, id FROM history
+                WHERE {' AND '.join(clauses + ['history.created_at BETWEEN ? AND ?'])}
+            """, params + [info['first_created_at'], info['last_created_at']])
+            candidates = [tuple(row) for row in cursor.fetchall()]
+            if not candidates:
+                continue
+            df = _load_archive_month(info['month'], info['archived_at'])
+            archived = set(zip(df['created_at_utc'], df['id']))
+            overlap.update(row_id for created_at, row_id in candidates if (created_at, row_id) in archived)
+    return overlap
+
+
+def _export_history_rows(cursor, chunk_size, archive_frames, skip_ids):
+    """导出行：先逐月输出归档明细，再输出在线记录（skip_ids 为两边都有的在线记录，只输出归档中的一份）"""
+    fields = [expr.split(' AS ')[-1] for expr, _ in HISTORY_EXPORT_COLUMNS]
+    for frame in archive_frames:
+        frame = frame[fields].astype(object)
+        frame = frame.where(frame.notna(), None)
+        yield from frame.itertuples(index=False, name=None)
+    
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            if row[0] not in skip_ids:
+                yield tuple(row)
+
+
+def export_history(output_path, file_format='csv', start_date=None, end_date=None, channel=None,
+                   min_margin=None, max_margin=None, chunk_size=5000, progress_callback=None,
+                   include_archive=False):
+    """
+    流式导出历史记录到文件（按时间正序，游标分块读取，内存占用与总行数无关）
+    
+    参数:
+        output_path: 输出文件路径
+        file_format: 'csv'、'xlsx' 或 'parquet'（需要 pyarrow）
+        start_date / end_date: 本地日期范围（'YYYY-MM-DD'，含首尾）
+        channel: 物流渠道名称
+        min_margin / max_margin: 利润率区间 [min, max)
+        chunk_size: 每次从游标读取的行数
+        progress_callback: 每写完一块调用一次，参数为已导出行数
+        include_archive: 是否包含已归档的月份（归档月份逐月解压，排在在线记录之前）
+    
+    返回:
+        int: 导出的行数
+    """
+    writers = {
+        'csv': _write_history_csv,
+        'xlsx': _write_history_xlsx,
+        'parquet': _write_history_parquet,
+    }
+    if file_format not in writers:
+        raise ValueError(f"不支持的导出格式: {file_format}")
+    
+    clauses, params = _history_filter_sql(start_date, end_date, channel, min_margin, max_margin)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    select_sql = ", ".join(expr for expr, _ in HISTORY_EXPORT_COLUMNS)
+    
+    exported = 0
+    
+    def on_chunk(n):
+        nonlocal exported
+        exported += n
+        if progress_callback:
+            progress_callback(exported)
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {select_sql}
+            FROM history
+            {where_sql}
+            ORDER BY history.created_at, history.id
+        """, params)
+        if include_archive:
+            filter_args = (start_date, end_date, channel, min_margin, max_margin)
+            skip_ids = _archived_live_ids(_archive_month_index(), *filter_args)
+            archive_frames = _iter_archive_frames(*filter_args, ascending=True)
+            cursor = _HistoryRowStream(_export_history_rows(cursor, chunk_size, archive_frames, skip_ids))
+        writers[file_format](cursor, output_path, chunk_size, on_chunk)
+    
+    return exported
+
+
+# ==================== 历史归档 ====================
+# 冷数据按本地月份分区存入独立的归档库：每个月一行，明细为 zlib 压缩的 JSON
+ARCHIVE_DB_PATH = os.path.join(current_dir, "ozon_history_archive.db")
+HISTORY_ARCHIVE_DAYS_DEFAULT = 180
+HISTORY_ARCHIVE_FIELDS = (
+    'id', 'product_name', 'cost', 'weight', 'charge_weight', 'channel_name',
+    'shipping_fee', 'final_price', 'profit', 'margin', 'created_at_utc', 'created_at'
+)
+
+
+# 归档表结构：归档库和备份文件（备份时一并带上归档月份）共用
+# channels（该月出现过的渠道，JSON 列表）和 max_id 是月份摘要，渠道列表、计数和 id 序列不必解压明细
+_ARCHIVE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {schema}.history_archive (
+        month TEXT PRIMARY KEY,
+        row_count INTEGER NOT NULL,
+        first_created_at TEXT NOT NULL,
+        last_created_at TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        channels TEXT,
+        max_id INTEGER
+    )
+"""
+_ARCHIVE_COLUMNS = (
+    'month', 'row_count', 'first_created_at', 'last_created_at', 'payload', 'archived_at', 'channels', 'max_id'
+)
+
+
+def _archive_month_summary(rows):
+    """归档明细的月份摘要：(渠道 JSON 列表, 最大 id)"""
+    channels = sorted({row[5] for row in rows if row[5] is not None})
+    return json.dumps(channels, ensure_ascii=False), max((row[0] for row in rows), default=0)
+
+
+def _upgrade_archive_schema(conn):
+    """旧版归档库补齐月份摘要列，并为缺少摘要的月份解压一次回填"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history_archive)")}
+    for column, column_type in (('channels', 'TEXT'), ('max_id', 'INTEGER')):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE history_archive ADD COLUMN {column} {column_type}")
+    
+    missing = conn.execute("SELECT month, payload FROM history_archive WHERE channels IS NULL OR max_id IS NULL").fetchall()
+    for row in missing:
+        conn.execute(
+            "UPDATE history_archive SET channels = ?, max_id = ? WHERE month = ?",
+            _archive_month_summary(_unpack_archive_rows(row['payload'])) + (row['month'],)
+        )
+    if missing:
+        conn.commit()
+
+
+@contextmanager
+def get_archive_connection():
+    """归档库连接上下文管理器（低频访问，不进连接池）"""
+    conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_ARCHIVE_TABLE_SQL.format(schema="main"))
+        _upgrade_archive_schema(conn)
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _pack_archive_rows(rows):
+    """把归档明细（按 HISTORY_ARCHIVE_FIELDS 排列的列表）压缩成 blob"""
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def _unpack_archive_rows(payload):
+    """解压归档 blob"""
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def _merge_archive_month(archive_conn, month, rows):
+    """
+    把一个月的明细并入归档分区（按 (created_at, id) 去重，可重复执行）
+    """
+    cursor = archive_conn.cursor()
+    cursor.execute("SELECT payload FROM history_archive WHERE month = ?", (month,))
+    existing = cursor.fetchone()
+    
+    merged = {}
+    if existing:
+        merged = {(row[10], row[0]): row for row in _unpack_archive_rows(existing['payload'])}
+    merged.update(((row[10], row[0]), row) for row in rows)
+    ordered = sorted(merged.values(), key=lambda r: (r[10], r[0]))
+    channels, max_id = _archive_month_summary(ordered)
+    
+    cursor.execute("""
+        INSERT INTO history_archive (month, row_count, first_created_at, last_created_at, payload, channels, max_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(month) DO UPDATE SET
+            row_count=excluded.row_count,
+            first_created_at=excluded.first_created_at,
+            last_created_at=excluded.last_created_at,
+            payload=excluded.payload,
+            channels=excluded.channels,
+            max_id=excluded.max_id,
+            archived_at=CURRENT_TIMESTAMP
+    """, (month, len(ordered), ordered[0][10], ordered[-1][10], _pack_archive_rows(ordered), channels, max_id))
+
+
+def archive_history(older_than_days=None):
+    """
+    把超过指定天数的历史记录移入归档库（按月分区压缩）
+    每个月先写入并提交归档库，再从在线库删除；中途中断后重跑会按 (created_at, id) 去重，不丢不重
+    日统计汇总表不受影响，仪表盘累计数据保持不变
+    
+    参数:
+        older_than_days: 归档阈值（天），None 时读取配置 history_archive_days（默认 180）
+    
+    返回:
+        dict: {'rows': 归档行数, 'months': 涉及的月份列表}
+    """
+    if older_than_days is None:
+        older_than_days = int(float(load_config('history_archive_days', HISTORY_ARCHIVE_DAYS_DEFAULT)))
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT datetime('now', ?)", (f"-{int(older_than_days)} days",))
+        cutoff = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT strftime('%Y-%m', created_at, 'localtime') AS month
+            FROM history
+            WHERE history.created_at < ?
+            GROUP BY month
+            ORDER BY month
+        """, (cutoff,))
+        months = [row[0] for row in cursor.fetchall()]
+    
+    summary = {'rows': 0, 'months': months}
+    for month in months:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    id, product_name, cost, weight, charge_weight, channel_name,
+                    shipping_fee, final_price, profit, margin,
+                    created_at AS created_at_utc,
+                    datetime(created_at, 'localtime') AS created_at
+                FROM history
+                WHERE history.created_at >= datetime(?, 'utc')
+                  AND history.created_at < datetime(?, '+1 month', 'utc')
+                  AND history.created_at < ?
+            """, (f"{month}-01 00:00:00", f"{month}-01 00:00:00", cutoff))
+            rows = [list(row) for row in cursor.fetchall()]
+        if not rows:
+            continue
+        
+        # 先落归档库，再删在线库
+        with get_archive_connection() as archive_conn:
+            archive_conn.execute("BEGIN IMMEDIATE")
+            _merge_archive_month(archive_conn, month, rows)
+        
+        with get_db_connection() as conn:
+            conn.executemany("DELETE FROM history WHERE id = ?", [(row[0],) for row in rows])
+        summary['rows'] += len(rows)
+    
+    if summary['rows']:
+        _load_archive_month.cache_clear()
+    return summary
+
+
+def list_archived_months():
+    """
+    列出已归档的月份
+    
+    返回:
+        list: [{'month', 'row_count', 'first_created_at', 'last_created_at', 'size_kb', 'archived_at'}]，按月份倒序
+    """
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return []
+    with get_archive_connection() as archive_conn:
+        cursor = archive_conn.cursor()
+        cursor.execute("""
+            SELECT month, row_count, first_created_at, last_created_at,
+                   length(payload) / 1024.0 AS size_kb, archived_at
+            FROM history_archive
+            ORDER BY month DESC
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def _archive_month_index():
+    """归档月份摘要（不含明细）：list_archived_months 的字段另加 channels（集合）、max_id，按月份倒序"""
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return []
+    with get_archive_connection() as archive_conn:
+        cursor = archive_conn.cursor()
+        cursor.execute("""
+            SELECT month, row_count, first_created_at, last_created_at, archived_at, channels, max_id
+            FROM history_archive
+            ORDER BY month DESC
+        """)
+        months = [dict(row) for row in cursor.fetchall()]
+    for info in months:
+        info['channels'] = set(json.loads(info['channels'] or '[]'))
+    return months
+
+
+@lru_cache(maxsize=12)
+def _load_archive_month(month, archived_at):
+    """解压一个归档月份为 DataFrame（以 archived_at 作为版本号缓存最近访问的月份）"""
+    with get_archive_connection() as archive_conn:
+        cursor = archive_conn.cursor()
+        cursor.execute("SELECT payload FROM history_archive WHERE month = ?", (month,))
+        row = cursor.fetchone()
+    rows = _unpack_archive_rows(row['payload']) if row else []
+    return pd.DataFrame.from_records(rows, columns=list(HISTORY_ARCHIVE_FIELDS))
+
+
+def _archive_filter_mask(df, start_utc, end_utc, channel, min_margin, max_margin):
+    """按与在线查询相同的条件过滤归档明细"""
+    mask = np.ones(len(df), dtype=bool)
+    if start_utc:
+        mask &= (df['created_at_utc'] >= start_utc).to_numpy()
+    if end_utc:
+        mask &= (df['created_at_utc'] < end_utc).to_numpy()
+    if channel:
+        mask &= (df['channel_name'] == channel).to_numpy()
+    if min_margin is not None:
+        mask &= (df['margin'] >= min_margin).to_numpy()
+    if max_margin is not None:
+        mask &= (df['margin'] < max_margin).to_numpy()
+    return mask
+
+
+def _history_utc_bounds(start_date, end_date):
+    """本地日期范围 → UTC 时间边界（与 _history_filter_sql 的换算一致）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT datetime(?, 'utc'), datetime(?, '+1 day', 'utc')",
+            (f"{start_date} 00:00:00" if start_date else None, f"{end_date} 00:00:00" if end_date else None)
+        )
+        return tuple(cursor.fetchone())
+
+
+def _iter_archive_frames(start_date=None, end_date=None, channel=None, min_margin=None, max_margin=None,
+                         before=None, floor=None, ascending=False):
+    """
+    按月份倒序逐月产出过滤后的归档明细（DataFrame，组内按时间倒序）
+    before / floor: 只保留 (created_at, id) 在 (floor, before) 之间的记录，并据此跳过整月
+    ascending: 改为按月份正序产出（组内按时间正序），用于导出
+    """
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return
+    start_utc, end_utc = _history_utc_bounds(start_date, end_date)
+    
+    months = _archive_month_index()
+    for info in reversed(months) if ascending else months:
+        if before is not None and info['first_created_at'] > before[0]:
+            continue
+        if floor is not None and info['last_created_at'] < floor[0]:
+            if ascending:
+                continue
+            break
+        if start_utc and info['last_created_at'] < start_utc:
+            if ascending:
+                continue
+            break
+        if end_utc and info['first_created_at'] >= end_utc:
+            continue
+        if channel and channel not in info['channels']:
+            continue
+        
+        df = _load_archive_month(info['month'], info['archived_at'])
+        mask = _archive_filter_mask(df, start_utc, end_utc, channel, min_margin, max_margin)
+        created, ids = df['created_at_utc'], df['id']
+        if before is not None:
+            mask &= ((created < before[0]) | ((created == before[0]) & (ids < before[1]))).to_numpy()
+        if floor is not None:
+            mask &= ((created > floor[0]) | ((created == floor[0]) & (ids >= floor[1]))).to_numpy()
+        if mask.any():
+            yield df[mask] if ascending else df[mask].iloc[::-1]
+
+
+def _archived_history_rows(before, floor, limit, start_date=None, end_date=None,
+                           channel=None, min_margin=None, max_margin=None):
+    """归档部分的键集分页：取游标之前最多 limit 条（按时间倒序）"""
+    rows = []
+    for frame in _iter_archive_frames(start_date, end_date, channel, min_margin, max_margin, before, floor):
+        rows.extend(frame.head(limit - len(rows)).to_dict('records'))
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def query_history(start_date=None, end_date=None, channel=None, min_margin=None, max_margin=None,
+                  include_archive=True):
+    """
+    统一的历史查询层：在线记录 + 按需解压的归档月份（只加载与日期范围相交的月份）
+    
+    参数:
+        start_date / end_date: 本地日期范围（'YYYY-MM-DD'，含首尾）
+        channel: 物流渠道名称
+        min_margin / max_margin: 利润率区间 [min, max)
+        include_archive: 是否包含归档记录
+    
+    返回:
+        DataFrame: 列同 HISTORY_ARCHIVE_FIELDS，按时间倒序
+    """
+    clauses, params = _history_filter_sql(start_date, end_date, channel, min_margin, max_margin)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT
+                id, product_name, cost, weight, charge_weight, channel_name,
+                shipping_fee, final_price, profit, margin,
+                created_at AS created_at_utc,
+                datetime(created_at, 'localtime') AS created_at
+            FROM history
+            {where_sql}
+            ORDER BY history.created_at DESC, history.id DESC
+        """, params)
+        live = pd.DataFrame.from_records(
+            [tuple(row) for row in cursor.fetchall()], columns=list(HISTORY_ARCHIVE_FIELDS)
+        )
+    
+    if not include_archive:
+        return live
+    
+    frames = [live] + list(_iter_archive_frames(start_date, end_date, channel, min_margin, max_margin))
+    frames = [frame for frame in frames if len(frame)]
+    if len(frames) <= 1:
+        return frames[0].reset_index(drop=True) if frames else live
+    
+    return (
+        pd.concat(frames, ignore_index=True)
+        .drop_duplicates(['created_at_utc', 'id'])
+        .sort_values(['created_at_utc', 'id'], ascending=False)
+        .reset_index(drop=True)
+    )
+
+
+# 数据库备份：基于 sqlite3 在线备份 API 分步复制页面，备份期间不阻塞写入
+BACKUP_DIR = os.path.join(current_dir, "backups")
+BACKUP_FILE_PREFIX = "OzonSellerPro_Backup_"
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_SCHEDULER_POLL_SECONDS = 60
+
+_backup_scheduler_lock = threading.Lock()
+_backup_scheduler_thread = None
+_backup_scheduler_stop = threading.Event()
+
+
+def backup_database(dest_path, pages=BACKUP_PAGES_PER_STEP, progress_callback=None):
+    """
+    在线备份数据库到指定文件（每步复制 pages 页；整个备份持有同一个读事务，WAL 模式下不阻塞写入，得到的是备份开始时的一致快照）
+    归档库中的月份一并写入备份文件的 history_archive 表，备份结果切换为 DELETE 日志模式，得到可直接拷贝/下载的单个文件
+    
+    参数:
+        dest_path: 备份文件路径（已存在会被覆盖）
+        pages: 每步复制的页数
+        progress_callback: 每步调用一次，参数为 (已复制页数, 总页数)
+    
+    返回:
+        dict: {'path', 'size_bytes', 'pages', 'archive_months', 'elapsed_ms'}
+    """
+    start_time = time.perf_counter()
+    copied = {'pages': 0, 'archive_months': 0}
+    
+    def on_progress(status, remaining, total):
+        copied['pages'] = total
+        if progress_callback:
+            progress_callback(total - remaining, total)
+    
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    
+    source = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    dest = sqlite3.connect(dest_path)
+    try:
+        # 整个备份期间持有一个读事务：WAL 模式下快照固定，其它连接照常写入，
+        # 备份也不会因为源库被修改而从头重来
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(dest, pages=pages, progress=on_progress)
+        source.execute("COMMIT")
+        dest.execute("PRAGMA journal_mode=DELETE")
+        copied['archive_months'] = _copy_archive_into(dest)
+    finally:
+        dest.close()
+        source.close()
+    
+    return {
+        'path': dest_path,
+        'size_bytes': os.path.getsize(dest_path),
+        'pages': copied['pages'],
+        'archive_months': copied['archive_months'],
+        'elapsed_ms': (time.perf_counter() - start_time) * 1000
+    }
+
+
+def _copy_archive_into(dest):
+    """把归档库的全部月份复制到备份连接的 history_archive 表（归档库不存在时跳过），返回月份数"""
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return 0
+    dest.execute("ATTACH DATABASE ? AS archive_src", (ARCHIVE_DB_PATH,))
+    try:
+        tables = dest.execute("SELECT name FROM archive_src.sqlite_master WHERE type = 'table' AND name = 'history_archive'").fetchall()
+        if not tables:
+            return 0
+        dest.execute(_ARCHIVE_TABLE_SQL.format(schema="main"))
+        dest.execute("DELETE FROM main.history_archive")
+        source_columns = {row[1] for row in dest.execute("PRAGMA archive_src.table_info(history_archive)")}
+        columns = ", ".join(column for column in _ARCHIVE_COLUMNS if column in source_columns)
+        cursor = dest.execute(f"INSERT INTO main.history_archive ({columns}) SELECT {columns} FROM archive_src.history_archive")
+        months = cursor.rowcount
+        dest.commit()
+        return months
+    finally:
+        dest.execute("DETACH DATABASE archive_src")
+
+
+def list_backups():
+    """
+    列出备份目录中的轮转备份（按时间倒序）
+    
+    返回:
+        list: [{'name', 'path', 'size_bytes', 'modified_at'}]
+    """
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    backups = []
+    for entry in os.scandir(BACKUP_DIR):
+        if entry.is_file() and entry.name.startswith(BACKUP_FILE_PREFIX) and entry.name.endswith(".db"):
+            stat = entry.stat()
+            backups.append({
+                'name': entry.name,
+                'path': entry.path,
+                'size_bytes': stat.st_size,
+                'modified_at': stat.st_mtime
+            })
+    backups.sort(key=lambda b: (b['modified_at'], b['name']), reverse=True)
+    return backups
+
+
+def prune_backups(retention):
+    """只保留最新的 retention 份轮转备份，返回删除的文件名列表"""
+    removed = []
+    for backup in list_backups()[max(int(retention), 1):]:
+        try:
+            os.remove(backup['path'])
+            removed.append(backup['name'])
+        except OSError as e:
+            print(f"⚠️ 删除旧备份失败: {backup['name']}: {e}")
+    return removed
+
+
+def run_rotating_backup(retention=None):
+    """
+    生成一份轮转备份到备份目录并清理超出保留份数的旧备份
+    
+    参数:
+        retention: 保留份数，None 时读取配置 backup_retention（默认 7）
+    
+    返回:
+        dict: backup_database 的结果，另含 'removed'（被清理的旧备份）
+    """
+    if retention is None:
+        retention = int(float(load_config('backup_retention', 7)))
+    
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    final_path = os.path.join(BACKUP_DIR, f"{BACKUP_FILE_PREFIX}{timestamp}.db")
+    suffix = 1
+    while os.path.exists(final_path):
+        # 同一秒内多次备份（如连续恢复前的自动备份）不能互相覆盖
+        final_path = os.path.join(BACKUP_DIR, f"{BACKUP_FILE_PREFIX}{timestamp}_{suffix}.db")
+        suffix += 1
+    
+    # 先写临时文件再改名，保证备份目录里只出现完整的备份
+    result = backup_database(final_path + ".partial")
+    os.replace(final_path + ".partial", final_path)
+    result['path'] = final_path
+    result['removed'] = prune_backups(retention)
+    return result
+
+
+def _backup_due():
+    """按配置判断是否需要执行定时备份（以最新备份文件的修改时间为准，重启后依然有效）"""
+    if load_config('backup_enabled', '0') != '1':
+        return False
+    interval_hours = float(load_config('backup_interval_hours', 24))
+    backups = list_backups()
+    return not backups or time.time() - backups[0]['modified_at'] >= interval_hours * 3600
+
+
+def _backup_scheduler_loop():
+    """定时备份线程主循环"""
+    while not _backup_scheduler_stop.is_set():
+        try:
+            if _backup_due():
+                result = run_rotating_backup()
+                print(f"✅ 定时备份完成: {os.path.basename(result['path'])}")
+        except Exception as e:
+            print(f"⚠️ 定时备份失败: {e}")
+        finally:
+            close_db_connection()
+        _backup_scheduler_stop.wait(BACKUP_SCHEDULER_POLL_SECONDS)
+
+
+def start_backup_scheduler():
+    """启动定时轮转备份的后台线程（每个进程只启动一次，重复调用无副作用）"""
+    global _backup_scheduler_thread
+    with _backup_scheduler_lock:
+        if _backup_scheduler_thread is not None and _backup_scheduler_thread.is_alive():
+            return _backup_scheduler_thread
+        _backup_scheduler_stop.clear()
+        _backup_scheduler_thread = threading.Thread(
+            target=_backup_scheduler_loop, name="ozon-backup-scheduler", daemon=True
+        )
+        _backup_scheduler_thread.start()
+        return _backup_scheduler_thread
+
+
+def stop_backup_scheduler(timeout=5):
+    """停止定时备份线程"""
+    _backup_scheduler_stop.set()
+    thread = _backup_scheduler_thread
+    if thread is not None:
+        thread.join(timeout)
+
+
+# 备份恢复：上传文件先流式落盘并校验，再整体替换（在线备份 API 写入活动库）或合并
+RESTORE_REQUIRED_TABLES = ('config', 'logistics_tiers', 'history')
+RESTORE_CONFIG_RULES = ('keep', 'overwrite')
+UPLOAD_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def save_uploaded_backup(uploaded_file):
+    """
+    把上传的备份文件分块写入临时文件（上传期间不接触活动库）
+    
+    返回:
+        str: 临时文件路径（由调用方负责删除）
+    """
+    import shutil
+    import tempfile
+    
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="ozon_restore_", suffix=".db", delete=False) as target:
+        shutil.copyfileobj(uploaded_file, target, UPLOAD_COPY_CHUNK_BYTES)
+        return target.name
+
+
+def validate_backup_file(path):
+    """
+    校验备份文件：SQLite 完整性（quick_check）、必需表、db_meta 版本不高于当前程序
+    
+    返回:
+        dict: {'ok': 是否可恢复, 'version': 备份的数据库版本, 'history_rows': 历史记录数,
+               'archived_rows': 备份中的归档记录数, 'errors': 错误列表}
+    """
+    report = {'ok': False, 'version': None, 'history_rows': 0, 'archived_rows': 0, 'errors': []}
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        report['errors'].append(f"无法打开备份文件: {e}")
+        return report
+    
+    try:
+        cursor = conn.cursor()
+        problems = [row[0] for row in cursor.execute("PRAGMA quick_check").fetchall()]
+        if problems != ['ok']:
+            report['errors'].append(f"完整性检查未通过: {'; '.join(problems[:5])}")
+            return report
+        
+        tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = [table for table in RESTORE_REQUIRED_TABLES if table not in tables]
+        if missing:
+            report['errors'].append(f"缺少数据表: {', '.join(missing)}（不是本程序的备份文件）")
+            return report
+        
+        # 没有 db_meta 的旧版备份按 v1 处理，恢复后由迁移补齐
+        report['version'] = _read_db_version(cursor) or 1
+        if report['version'] > LATEST_DB_VERSION:
+            report['errors'].append(
+                f"备份来自更新的程序版本（数据库 v{report['version']}，当前程序最高支持 v{LATEST_DB_VERSION}）"
+            )
+            return report
+        
+        report['history_rows'] = cursor.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        if 'history_archive' in tables:
+            report['archived_rows'] = cursor.execute("SELECT COALESCE(SUM(row_count), 0) FROM history_archive").fetchone()[0]
+        report['ok'] = True
+    except sqlite3.DatabaseError as e:
+        report['errors'].append(f"不是有效的 SQLite 数据库: {e}")
+    finally:
+        conn.close()
+    return report
+
+
+def _invalidate_database_caches():
+    """活动库内容被整体替换/合并后，使连接池和所有进程内缓存失效"""
+    reset_db_connections()
+    bump_config_generation()
+    invalidate_logistics_tiers()
+    invalidate_dashboard_stats()
+
+
+def restore_database(path, mode='replace', config_rule='keep'):
+    """
+    从已校验的备份文件恢复数据
+    
+    参数:
+        path: 备份文件路径（save_uploaded_backup 的结果）
+        mode: 'replace' 整体替换（先自动备份当前库）；'merge' 合并历史记录和配置
+        config_rule: 合并时配置冲突的处理：'keep' 保留当前值，'overwrite' 使用备份中的值
+    
+    返回:
+        dict: replace 模式 {'mode', 'safety_backup'}；merge 模式 {'mode', 'history_added', 'config_changed'}
+    """
+    report = validate_backup_file(path)
+    if not report['ok']:
+        raise ValueError("；".join(report['errors']))
+    
+    if mode == 'replace':
+        return _restore_replace(path)
+    if mode == 'merge':
+        if config_rule not in RESTORE_CONFIG_RULES:
+            raise ValueError(f"不支持的配置冲突规则: {config_rule}")
+        return _restore_merge(path, config_rule)
+    raise ValueError(f"不支持的恢复方式: {mode}")
+
+
+def _restore_replace(path):
+    """整体替换：在线备份 API 一步写入活动库（单个写事务，其它连接看到的要么是旧库要么是新库）"""
+    # 替换前先留一份当前库的轮转备份，误操作可以找回
+    safety_backup = run_rotating_backup()
+    
+    source = sqlite3.connect(path)
+    try:
+        # WAL 模式的目标库要求页大小一致，不一致时先在临时副本上重建
+        with get_db_connection() as conn:
+            live_page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        if source.execute("PRAGMA page_size").fetchone()[0] != live_page_size:
+            source.execute("PRAGMA journal_mode=DELETE")
+            source.execute(f"PRAGMA page_size={live_page_size}")
+            source.execute("VACUUM")
+        
+        target = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            source.backup(target, pages=-1)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    
+    # 旧版备份在这里补齐迁移；随后所有线程重新打开连接、重新加载缓存
+    _invalidate_database_caches()
+    init_database()
+    archive_months = _restore_archive_replace()
+    _invalidate_database_caches()
+    return {'mode': 'replace', 'safety_backup': safety_backup['path'], 'archive_months': archive_months}
+
+
+def _restore_archive_replace():
+    """
+    整体替换后：备份中带有归档月份时，用它替换归档库内容并从活动库删除该表
+    没有归档表的旧备份不改动归档库（替换前的安全备份已包含当前归档），但在线库的 id 序列随备份回退，
+    需要推进到归档中的最大 id 之后，新记录才不会与归档记录重号
+
+    返回:
+        int: 恢复的归档月份数
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'history_archive'")
+        if not cursor.fetchone():
+            _advance_history_sequence(cursor, _archive_max_id())
+            return 0
+        # 较早的备份没有月份摘要列，缺少的摘要在下次打开归档库时回填
+        backup_columns = {row[1] for row in cursor.execute("PRAGMA table_info(history_archive)")}
+        columns = [column for column in _ARCHIVE_COLUMNS if column in backup_columns]
+        cursor.execute(f"SELECT {', '.join(columns)} FROM history_archive")
+        months = [tuple(row) for row in cursor.fetchall()]
+    
+    with get_archive_connection() as archive_conn:
+        archive_conn.execute("BEGIN IMMEDIATE")
+        archive_conn.execute("DELETE FROM history_archive")
+        archive_conn.executemany(f"""
+            INSERT INTO history_archive ({', '.join(columns)})
+            VALUES ({', '.join('?' * len(columns))})
+        """, months)
+        _upgrade_archive_schema(archive_conn)
+    
+    with get_db_connection() as conn:
+        conn.execute("DROP TABLE history_archive")
+    _load_archive_month.cache_clear()
+    return len(months)
+
+
+def _archive_max_id():
+    """归档库中的最大记录 id（归档库不存在时为 0）"""
+    return max((info['max_id'] or 0 for info in _archive_month_index()), default=0)
+
+
+def _advance_history_sequence(cursor, min_id):
+    """把 history 的 AUTOINCREMENT 序列推进到不小于 min_id（只前进不后退）"""
+    if not min_id:
+        return
+    cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'history'", (min_id,))
+    if cursor.rowcount == 0:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history', ?)", (min_id,))
+
+
+def _restore_merge(path, config_rule):
+    """合并：ATTACH 备份文件，在一个写事务内按自然键补入历史记录、按规则合并配置"""
+    with get_db_connection() as conn:
+        conn.execute("ATTACH DATABASE ? AS restore_src", (path,))
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            
+            # 自然键：(created_at, 商品, 渠道, 成本, 售价)；id 在两个库之间没有意义
+            cursor.execute("""
+                INSERT INTO main.history (
+                    product_name, cost, weight, charge_weight, channel_name,
+                    shipping_fee, final_price, profit, margin, created_at
+                )
+                SELECT
+                    s.product_name, s.cost, s.weight, s.charge_weight, s.channel_name,
+                    s.shipping_fee, s.final_price, s.profit, s.margin, s.created_at
+                FROM restore_src.history AS s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM main.history AS h
+                    WHERE h.created_at = s.created_at
+                      AND h.product_name IS s.product_name
+                      AND h.channel_name IS s.channel_name
+                      AND h.cost IS s.cost
+                      AND h.final_price IS s.final_price
+                )
+                ORDER BY s.created_at, s.id
+            """)
+            history_added = cursor.rowcount
+            history_added += _merge_restore_archived(cursor)
+            
+            if config_rule == 'overwrite':
+                cursor.execute("""
+                    INSERT INTO main.config (key, value)
+                    SELECT key, value FROM restore_src.config WHERE true
+                    ON CONFLICT(key) DO UPDATE SET value=excluded.value
+                    WHERE main.config.value IS NOT excluded.value
+                """)
+            else:
+                cursor.execute("""
+                    INSERT OR IGNORE INTO main.config (key, value)
+                    SELECT key, value FROM restore_src.config
+                """)
+            config_changed = cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute("DETACH DATABASE restore_src")
+    
+    _invalidate_database_caches()
+    return {'mode': 'merge', 'history_added': history_added, 'config_changed': config_changed}
+
+
+def _merge_restore_archived(cursor):
+    """
+    合并备份中的归档月份：归档明细按与在线记录相同的自然键补入 history（之后随下一次归档移回归档库）
+    已存在于在线库或本地归档库中的记录跳过；备份中的 id 与本地 id 无关，不能直接并入本地归档分区
+
+    返回:
+        int: 补入的记录数
+    """
+    cursor.execute("SELECT name FROM restore_src.sqlite_master WHERE type = 'table' AND name = 'history_archive'")
+    if not cursor.fetchone():
+        return 0
+    
+    columns = "product_name, cost, weight, charge_weight, channel_name, shipping_fee, final_price, profit, margin, created_at"
+    cursor.execute(f"CREATE TEMP TABLE restore_archived ({columns})")
+    cursor.execute(f"CREATE TEMP TABLE local_archived ({columns})")
+    try:
+        cursor.execute("SELECT month, payload FROM restore_src.history_archive")
+        backup_months = cursor.fetchall()
+        for row in backup_months:
+            # 归档明细按 HISTORY_ARCHIVE_FIELDS 排列：去掉 id 和本地时间，created_at 取 UTC 原值
+            cursor.executemany(
+                "INSERT INTO temp.restore_archived VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [record[1:11] for record in _unpack_archive_rows(row['payload'])]
+            )
+        
+        if os.path.exists(ARCHIVE_DB_PATH):
+            months = [row['month'] for row in backup_months]
+            with get_archive_connection() as archive_conn:
+                local_months = archive_conn.execute(
+                    f"SELECT payload FROM history_archive WHERE month IN ({','.join('?' * len(months))})", months
+                ).fetchall()
+            for row in local_months:
+                cursor.executemany(
+                    "INSERT INTO temp.local_archived VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [record[1:11] for record in _unpack_archive_rows(row['payload'])]
+                )
+        
+        cursor.execute(f"""
+            INSERT INTO main.history ({columns})
+            SELECT {columns} FROM temp.restore_archived AS s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM main.history AS h
+                WHERE h.created_at = s.created_at
+                  AND h.product_name IS s.product_name
+                  AND h.channel_name IS s.channel_name
+                  AND h.cost IS s.cost
+                  AND h.final_price IS s.final_price
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM temp.local_archived AS a
+                WHERE a.created_at = s.created_at
+                  AND a.product_name IS s.product_name
+                  AND a.channel_name IS s.channel_name
+                  AND a.cost IS s.cost
+                  AND a.final_price IS s.final_price
+            )
+            ORDER BY s.created_at
+        """)
+        return cursor.rowcount
+    finally:
+        cursor.execute("DROP TABLE temp.restore_archived")
+        cursor.execute("DROP TABLE temp.local_archived")
+
+
+def reverse_calculate_cost(final_price_rub, weight_g, exchange_rate, profit_rate, commission_rate, label_fee, tiers=None):
+    """
+    竞品反推：根据售价反推成本上限
+    
+    参数:
+        final_price_rub: 竞品售价（卢布）
+        weight_g: 预估重量（克）
+        exchange_rate: 汇率
+        profit_rate: 利润率系数
+        commission_rate: 佣金率
+        label_fee: 贴单费
+        tiers: 物流档位列表或编译后的 TierTable
+    
+    返回:
+        dict: {
+            'max_cost': 最大成本,
+            'shipping_fee': 运费,
+            'tier': 使用的档位
+        }
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    if not table:
+        return {'max_cost': 0, 'shipping_fee': 0, 'tier': None}
+    
+    # 转换为人民币
+    final_price_cny = final_price_rub / exchange_rate
+    commission_factor = 1 - (commission_rate / 100)
+    net_income = final_price_cny * commission_factor
+    
+    # 售价已知，重量/价格条件通过 bisect 一次定位，只需在候选档位中检查成本是否为正
+    for tier in table.cell_candidates(weight_g, final_price_cny):
+        # 计算运费
+        shipping_fee = tier.fixed_fee + label_fee + (weight_g * tier.per_gram_fee)
+        
+        # 反推成本：(售价 * (1 - 佣金率) - 运费) / 利润率系数
+        max_cost = (net_income - shipping_fee) / profit_rate
+        
+        if max_cost > 0:
+            return {
+                'max_cost': max_cost,
+                'shipping_fee': shipping_fee,
+                'tier': tier.as_dict()
+            }
+    
+    # 兜底：使用最后一个档位
+    last_tier = table.last
+    shipping_fee = last_tier.fixed_fee + label_fee + (weight_g * last_tier.per_gram_fee)
+    max_cost = (net_income - shipping_fee) / profit_rate
+    
+    return {
+        'max_cost': max(max_cost, 0),
+        'shipping_fee': shipping_fee,
+        'tier': last_tier.as_dict()
+    }
+
+
+def reverse_calculate_batch(df, exchange_rate, profit_rate, commission_rate, label_fee, tiers=None,
+                            price_col='price_rub', weight_col='weight_g'):
+    """
+    批量竞品反推 - reverse_calculate_cost 的向量化版本
+    一次性对 (竞品 × 档位) 矩阵求值，结果与逐个调用 reverse_calculate_cost 一致
+    
+    参数:
+        df: 竞品数据 DataFrame，至少包含售价列（卢布）和重量列（克）
+        exchange_rate: 汇率
+        profit_rate: 利润率系数
+        commission_rate: 佣金率
+        label_fee: 贴单费
+        tiers: 物流档位列表或编译后的 TierTable
+        price_col: 售价列名（卢布）
+        weight_col: 重量列名（克）
+    
+    返回:
+        DataFrame: 原数据副本，追加以下列:
+            price_cny, tier_index, channel_name, is_fallback, shipping_fee, max_cost
+    """
+    table = compile_logistics_tiers(tiers)
+    
+    result = df.copy()
+    
+    if not table:
+        raise ValueError("未找到物流档位配置")
+    
+    prices_cny = result[price_col].to_numpy(dtype=float) / exchange_rate
+    weights = result[weight_col].to_numpy(dtype=float)
+    row_index = np.arange(len(result))
+    
+    fixed_fee = np.array(table.fixed_fees, dtype=float)
+    per_gram_fee = np.array(table.per_gram_fees, dtype=float)
+    max_price = np.array(table.max_prices, dtype=float)
+    
+    # 试算运费与成本上限，形状 (n, k)
+    commission_factor = 1 - (commission_rate / 100)
+    net_income = prices_cny * commission_factor
+    trial_shipping = fixed_fee + label_fee + (weights[:, None] * per_gram_fee)
+    trial_cost = (net_income[:, None] - trial_shipping) / profit_rate
+    
+    weight_ok = table.weight_ok_matrix()[table.weight_cells(weights)]
+    price_ok = (max_price == 0) | (prices_cny[:, None] <= max_price)
+    fits = weight_ok & price_ok & (trial_cost > 0)
+    
+    # 每行第一个满足条件的档位；全部不满足时兜底使用最后一个档位（成本上限不低于 0）
+    has_fit = fits.any(axis=1)
+    tier_index = np.where(has_fit, fits.argmax(axis=1), len(table) - 1)
+    max_cost = trial_cost[row_index, tier_index]
+    
+    result['price_cny'] = prices_cny
+    result['tier_index'] = tier_index
+    result['channel_name'] = np.array(table.names, dtype=object)[tier_index]
+    result['is_fallback'] = ~has_fit
+    result['shipping_fee'] = trial_shipping[row_index, tier_index]
+    result['max_cost'] = np.maximum(max_cost, 0)
+    
+    return result
+
+
+def normalize_columns(df, aliases):
+    """
+    按别名表统一上传文件的列名（兼容中英文表头）
+    
+    参数:
+        df: 原始 DataFrame
+        aliases: {标准列名: [别名1, 别名2, ...]}
+    
+    返回:
+        DataFrame: 列名已统一的 DataFrame
+    """
+    lookup = {}
+    for column, names in aliases.items():
+        for name in [column] + list(names):
+            lookup[str(name).strip().lower()] = column
+    
+    return df.rename(columns=lambda c: lookup.get(str(c).strip().lower(), c))
+
+
+COMPETITOR_COLUMN_ALIASES = {
+    'price_rub': ['售价', '竞品售价', '价格', 'price', '售价(rub)', '售价 (rub)'],
+    'weight_g': ['重量', '预估重量', 'weight', '重量(g)', '重量 (克)', '重量(克)'],
+}
+
+
+def read_competitor_file(uploaded_file):
+    """
+    读取竞品价格文件（CSV / XLSX）
+    
+    返回:
+        DataFrame: 至少包含 price_rub、weight_g 两列
+    """
+    file_name = getattr(uploaded_file, 'name', '') or ''
+    if file_name.lower().endswith(('.xlsx', '.xlsm')):
+        df = pd.read_excel(uploaded_file, engine='openpyxl')
+    else:
+        df = pd.read_csv(uploaded_file, encoding='utf-8-sig')
+    
+    df = normalize_columns(df, COMPETITOR_COLUMN_ALIASES)
+    missing = [c for c in ('price_rub', 'weight_g') if c not in df.columns]
+    if missing:
+        raise ValueError(f"缺少必要列: {', '.join(missing)}")
+    
+    df['price_rub'] = pd.to_numeric(df['price_rub'], errors='coerce')
+    df['weight_g'] = pd.to_numeric(df['weight_g'], errors='coerce')
+    return df.dropna(subset=['price_rub', 'weight_g']).reset_index(drop=True)
+
+
+def export_dataframe_bytes(df, file_format='csv'):
+    """
+    将 DataFrame 导出为可下载的字节流（页面中用 partial 包装后传给 st.download_button，点击时才生成）
+    
+    参数:
+        df: 要导出的数据
+        file_format: 'csv' 或 'xlsx'
+    
+    返回:
+        bytes: 文件内容
+    """
+    output = io.BytesIO()
+    if file_format == 'xlsx':
+        df.to_excel(output, index=False, engine='openpyxl')
+    else:
+        df.to_csv(output, index=False, encoding='utf-8-sig')
+    return output.getvalue()
+
+
+PRODUCT_COLUMN_ALIASES = {
+    'product_name': ['商品名称', '商品', '名称', 'name', 'product'],
+    'cost': ['成本', '商品成本', '采购成本', '成本(cny)', '成本 (cny)'],
+    'weight': ['重量', '实重', '实际重量', '重量(g)', '重量(克)', 'weight_g'],
+    'length': ['长', '长度', '长度(cm)', 'length_cm'],
+    'width': ['宽', '宽度', '宽度(cm)', 'width_cm'],
+    'height': ['高', '高度', '高度(cm)', 'height_cm'],
+}
+
+
+def replace_temp_file(state, key, path):
+    """
+    在 session_state（或任意字典）中登记新的临时文件，并删除同一键下原先登记的文件
+    path 为 None 时只删除旧文件；页面每次重新生成下载文件时调用，避免临时目录里堆积副本
+    """
+    previous = state.get(key)
+    if previous and previous != path:
+        remove_temp_file(previous)
+    if path is None:
+        state.pop(key, None)
+    else:
+        state[key] = path
+
+
+def remove_temp_file(path):
+    """删除临时文件（不存在时忽略）"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def read_temp_file(path):
+    """读取临时文件的全部内容（页面中用 partial 包装后传给 st.download_button，点击下载时才读取）"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def count_sheet_rows(uploaded_file):
+    """
+    估算上传商品表的数据行数（用于进度条）
+    XLSX 读取工作表维度信息，CSV 统计换行数，均不解析单元格
+    """
+    file_name = getattr(uploaded_file, 'name', '') or ''
+    try:
+        if file_name.lower().endswith(('.xlsx', '.xlsm')):
+            from openpyxl import load_workbook
+            workbook = load_workbook(uploaded_file, read_only=True, data_only=True)
+            try:
+                max_row = workbook.active.max_row
+            finally:
+                workbook.close()
+            return max(int(max_row or 1) - 1, 0)
+        
+        count = 0
+        for block in iter(lambda: uploaded_file.read(1024 * 1024), b''):
+            count += block.count(b'\n')
+        return max(count - 1, 0)
+    except Exception:
+        return 0
+    finally:
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+
+
+def iter_product_sheet_chunks(uploaded_file, chunk_size=5000):
+    """
+    分块读取商品表（CSV / XLSX）
+    XLSX 使用 openpyxl 只读流式模式逐行读取，任何时刻内存中只保留一个分块
+    
+    参数:
+        uploaded_file: 上传的文件对象（需带 name 属性区分格式）
+        chunk_size: 每块行数
+    
+    生成:
+        DataFrame: 列名已按 PRODUCT_COLUMN_ALIASES 统一的数据块
+    """
+    file_name = getattr(uploaded_file, 'name', '') or ''
+    
+    if file_name.lower().endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        
+        workbook = load_workbook(uploaded_file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            header = [str(h) if h is not None else f'column_{i}' for i, h in enumerate(header)]
+            
+            chunk = []
+            for row in rows:
+                if not any(value is not None for value in row):
+                    continue
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield normalize_columns(pd.DataFrame(chunk, columns=header), PRODUCT_COLUMN_ALIASES)
+                    chunk = []
+            if chunk:
+                yield normalize_columns(pd.DataFrame(chunk, columns=header), PRODUCT_COLUMN_ALIASES)
+        finally:
+            workbook.close()
+    else:
+        for chunk in pd.read_csv(uploaded_file, chunksize=chunk_size, encoding='utf-8-sig'):
+            yield normalize_columns(chunk, PRODUCT_COLUMN_ALIASES)
+
+
+def price_product_chunk(df, profit_rate, commission_rate, label_fee, exchange_rate, tiers=None):
+    """
+    对一个商品数据块计算计费重量并批量定价
+    
+    参数:
+        df: 至少包含 cost、weight 列；product_name、length、width、height 可选
+    
+    返回:
+        DataFrame: 定价结果（成本或重量无效的行被剔除）
+    """
+    missing = [c for c in ('cost', 'weight') if c not in df.columns]
+    if missing:
+        raise ValueError(f"缺少必要列: {', '.join(missing)}")
+    
+    chunk = pd.DataFrame({
+        'product_name': df['product_name'].fillna('未命名商品').astype(str) if 'product_name' in df.columns else '未命名商品',
+        'cost': pd.to_numeric(df['cost'], errors='coerce').astype(float),
+        'weight': pd.to_numeric(df['weight'], errors='coerce').astype(float),
+    })
+    for column in ('length', 'width', 'height'):
+        chunk[column] = pd.to_numeric(df[column], errors='coerce').astype(float).fillna(0) if column in df.columns else 0.0
+    
+    chunk = chunk.dropna(subset=['cost', 'weight']).reset_index(drop=True)
+    
+    charge_weight, volume_weight, is_bulky = get_charge_weight_batch(
+        chunk['weight'], chunk['length'], chunk['width'], chunk['height']
+    )
+    chunk['volume_weight'] = volume_weight
+    chunk['charge_weight'] = charge_weight
+    chunk['is_bulky'] = is_bulky
+    
+    return price_batch(chunk, profit_rate, commission_rate, label_fee, exchange_rate, tiers=tiers)
+
+
+def import_pricing_sheet(uploaded_file, output_path, profit_rate, commission_rate, label_fee, exchange_rate,
+                         tiers=None, save_history=True, chunk_size=5000, progress_callback=None):
+    """
+    批量定价导入：分块读取商品表 → 计费重量 + 档位匹配 → 追加写入结果 CSV（可选写入历史记录）
+    
+    参数:
+        uploaded_file: 上传的商品表（CSV / XLSX）
+        output_path: 定价结果 CSV 输出路径
+        profit_rate / commission_rate / label_fee / exchange_rate: 定价参数
+        tiers: 物流档位列表或编译后的 TierTable
+        save_history: 是否写入测款历史记录
+        chunk_size: 每块行数
+        progress_callback: 进度回调 callback(已处理行数)
+    
+    返回:
+        dict: {'rows': 定价行数, 'skipped': 无效行数, 'history_rows': 写入历史行数, 'preview': 前 200 行结果}
+    """
+    table = compile_logistics_tiers(tiers)
+    summary = {'rows': 0, 'skipped': 0, 'history_rows': 0, 'preview': None}
+    
+    with open(output_path, 'w', encoding='utf-8-sig', newline='') as output:
+        for i, chunk in enumerate(iter_product_sheet_chunks(uploaded_file, chunk_size=chunk_size)):
+            priced = price_product_chunk(chunk, profit_rate, commission_rate, label_fee, exchange_rate, tiers=table)
+            priced = priced.drop(columns=['tier_index'])
+            
+            priced.to_csv(output, index=False, header=(i == 0))
+            
+            if save_history and len(priced):
+                summary['history_rows'] += len(save_history_records(
+                    priced[list(HISTORY_COLUMNS)].itertuples(index=False, name=None), chunk_size=chunk_size
+                ))
+            
+            if summary['preview'] is None:
+                summary['preview'] = priced.head(200)
+            summary['rows'] += len(priced)
+            summary['skipped'] += len(chunk) - len(priced)
+            
+            if progress_callback:
+                progress_callback(summary['rows'] + summary['skipped'])
+    
+    return summary
 
 
 def get_current_product(default=None):
@@ -783,6 +3352,7 @@ def check_remote_config():
         # 保存新版本号
         if updated:
             save_local_version(remote_version)
+            bump_config_generation()
             return True
         
         return False